@@ -60,6 +60,41 @@ def get_hash(file_name):
         md5_returned = hashlib.md5(data).hexdigest()
     return md5_returned
 
+def array_key(*args):
+    """
+    SHA1 hex digest of args, for keying caches. Arrays contribute
+    their dtype, shape and contents, WCS objects their FITS header
+    and anything else its repr.
+    """
+    import hashlib
+    h = hashlib.sha1()
+    for arg in args:
+        if hasattr(arg,'to_header_string'):
+            h.update(arg.to_header_string().encode())
+        elif isinstance(arg,np.ndarray):
+            arr = np.ascontiguousarray(arg)
+            h.update(str((arr.dtype,arr.shape)).encode())
+            h.update(arr.tobytes())
+        else:
+            h.update(repr(arg).encode())
+    return h.hexdigest()
+
+def atomic_save(fname,arr=None,**arrs):
+    """
+    Save arr to fname with np.save, or the keyword arrays arrs with np.savez.
+    The data are written to a temporary file that then replaces fname, so
+    that readers in other processes never see a partially written file.
+    """
+    dirname = os.path.dirname(fname)
+    if dirname: os.makedirs(dirname,exist_ok=True)
+    tmpname = f"{fname}.{os.getpid()}.tmp"
+    with open(tmpname,'wb') as f:
+        if arr is None:
+            np.savez(f,**arrs)
+        else:
+            np.save(f,np.asarray(arr))
+    os.replace(tmpname,fname)
+
 ## PARSING
 
 def but_her_emails(string=None,filename=None):
@@ -14,7 +14,7 @@ from scipy.interpolate import splrep,splev
 
 from scipy.fftpack import fftshift,ifftshift,fftfreq
 from scipy.interpolate import interp1d
-from pixell.fft import fft,ifft
+from pixell.fft import fft,ifft,rfft,irfft
 
 from orphics.stats import bin2D
 
@@ -158,52 +158,48 @@ def mass_estimate(kappa_recon,kappa_noise_2d,mass_guess,concentration,z):
     mf.apply(kappa_recon,kmask=kmask)
 
 
-def flat_taylens(phi,imap,taylor_order = 5):
+def flat_taylens(phi,imap,taylor_order = 5,max_bytes=2**30):
     """
     Lens a map imap with lensing potential phi
     using the Taylens algorithm up to taylor_order.
+    imap can be (...,Ny,Nx), e.g. T,Q,U or a stack of sims,
+    all lensed by the same phi in one call.
+
+    Each field needs taylor_order*(taylor_order+1)/2-1 complex derivative maps
+    (14 at order 5). These are made with batched FFTs over as many fields at a time
+    as fit in max_bytes; peak memory is about three times max_bytes.
 
     The original routine is from Thibaut Louis.
     It has been modified here to work with pixell.
     """
-    f = lambda x: enmap.fft(x,normalize='phys')
-    invf = lambda x: enmap.ifft(x,normalize='phys')
-    def binomial(n,k):
-        "Compute n factorial by a direct multiplicative method"
-        if k > n-k: k = n-k  # Use symmetry of Pascal's triangle
-        accum = 1
-        for i in range(1,k+1):
-            accum *= (n - (k - i))
-            accum /= i
-        return accum
-    kmap = f(phi)
-    Ny,Nx = phi.shape
-    ly,lx = enmap.laxes(phi.shape,phi.wcs)
-
-    ly_array,lx_array = phi.lmap()
-    alphaX=np.real(invf(1j*lx_array*kmap))
-    alphaY=np.real(invf(1j*ly_array*kmap))
-    iy,ix = np.mgrid[0:Ny,0:Nx]
-    py,px = enmap.pixshape(phi.shape,phi.wcs)
+    from scipy.special import comb
+    Ny,Nx = phi.shape[-2:]
+    ly,lx = phi.lmap()
+    alphaY,alphaX = np.real(enmap.ifft(enmap.ndmap(1j*np.array([ly,lx])*enmap.fft(phi,normalize='phys'),phi.wcs),normalize='phys'))
+    # Signed pixel steps, matching the conventions of lmap
+    py,px = enmap.extent(phi.shape,phi.wcs,signed=True)/np.array(phi.shape[-2:])
     alphaX0 = np.array(np.round(alphaX/ px),dtype='int64')
     alphaY0 = np.array(np.round(alphaY/ py),dtype='int64')
+    delta_alphaX = (alphaX-alphaX0*px).reshape(-1)
+    delta_alphaY = (alphaY-alphaY0*py).reshape(-1)
 
-    delta_alphaX=alphaX-alphaX0*px
-    delta_alphaY=alphaY-alphaY0*py
-
-    lensed_T_Map = imap.copy()
-    cont = imap.copy()
-    lensed_T_Map = imap[(iy+alphaY0)%Ny, (ix+alphaX0)%Nx]
-    kmap=f(imap)
-
-    for n in range(1,taylor_order):
-        cont[:]=0
-        for k in range(n+1):
-            fac=1j**n*binomial(n,k)*lx_array**(n-k)*ly_array**k/(factorial(n))
-            T_add=np.real(invf(fac*kmap))[(iy+alphaY0)%Ny, (ix+alphaX0)%Nx]*delta_alphaX**(n-k)*delta_alphaY**k  
-            lensed_T_Map[:] += T_add
-            cont[:] += T_add
-    return lensed_T_Map
+    # Flat gather indices shared by every field and every Taylor term
+    iy,ix = np.mgrid[0:Ny,0:Nx]
+    index = (((iy+alphaY0)%Ny)*Nx + (ix+alphaX0)%Nx).reshape(-1)
+    fields = np.asarray(imap).reshape((-1,Ny*Nx))
+    lensed = fields[:,index]
+
+    terms = [(n,k) for n in range(1,taylor_order) for k in range(n+1)]
+    if len(terms)==0: return enmap.enmap(lensed.reshape(imap.shape),imap.wcs)
+    facs = np.array([1j**n*comb(n,k,exact=True)/factorial(n)*lx**(n-k)*ly**k for n,k in terms])[:,None]
+    nchunk = max(1,int(max_bytes//(len(terms)*Ny*Nx*16)))
+    for i in range(0,len(fields),nchunk):
+        kmap = enmap.fft(enmap.ndmap(fields[i:i+nchunk].reshape((-1,Ny,Nx)),imap.wcs),normalize='phys')
+        ders = np.real(enmap.ifft(enmap.ndmap(facs*kmap,imap.wcs),normalize='phys'))
+        ders = ders.reshape(ders.shape[:2]+(-1,))[...,index]
+        for (n,k),der in zip(terms,ders):
+            lensed[i:i+nchunk] += der*(delta_alphaX**(n-k)*delta_alphaY**k)
+    return enmap.enmap(lensed.reshape(imap.shape),imap.wcs)
 
 
 def alpha_from_kappa(kappa=None,posmap=None,phi=None):
@@ -243,6 +239,9 @@ class FlatLensingSims(object):
             self.kgen = maps.MapGen(shape[-2:],wcs,ps_kk)
             self.posmap = enmap.posmap(shape[-2:],wcs)
             self.ps_kk = ps_kk
+        # kappa -> phi filter, without the divergent l=0 mode of kappa_to_phi
+        self._kphi = np.zeros(self.modlmap.shape)
+        np.divide(2.,self.modlmap*(self.modlmap+1.),out=self._kphi,where=self.modlmap>0)
         self.kbeam = maps.gauss_beam(self.modlmap,beam_arcmin)
         ncomp = 3 if pol else 1
         ps_noise = np.zeros((ncomp,ncomp,Ny,Nx))
@@ -261,7 +260,9 @@ class FlatLensingSims(object):
         return self.mgen.get_map(seed=seed)
     def get_kappa(self,seed=None):
         return self.kgen.get_map(seed=seed)
-    def get_sim(self,seed_cmb=None,seed_kappa=None,seed_noise=None,lens_order=5,return_intermediate=False,skip_lensing=False,cfrac=None):
+    def get_sim(self,seed_cmb=None,seed_kappa=None,seed_noise=None,lens_order=5,return_intermediate=False,skip_lensing=False,cfrac=None,taylor_order=None):
+        """taylor_order -- if not None, lens all components with flat_taylens at this order
+        instead of spline interpolation with lens_order."""
         unlensed = self.get_unlensed(seed_cmb)
         if skip_lensing:
             lensed = unlensed
@@ -274,7 +275,11 @@ class FlatLensingSims(object):
             else:
                 kappa = None
                 assert seed_kappa is None
-            lensed = enlensing.displace_map(unlensed, self.alpha, order=lens_order)
+            if taylor_order is None:
+                lensed = enlensing.displace_map(unlensed, self.alpha, order=lens_order)
+            else:
+                phi = enmap.ifft(enmap.fft(self.kappa)*self._kphi).real
+                lensed = flat_taylens(phi,unlensed,taylor_order)
         beamed = maps.filter_map(lensed,self.kbeam)
         noise_map = self.ngen.get_map(seed=seed_noise)
         
@@ -284,9 +289,116 @@ class FlatLensingSims(object):
             return [ maps.get_central(x,cfrac) for x in [unlensed,kappa,lensed,beamed,noise_map,observed] ]
         else:
             return maps.get_central(observed,cfrac)
+
+    def get_sims(self,nsims,seed=None,lens_order=5,taylor_order=None,cfrac=None,nthread=0):
+        """
+        Like get_sim(return_intermediate=True), but for a batch of nsims sims, returning
+        (nsims,...) arrays unlensed,kappa,lensed,observed (kappa is None for a fixed kappa).
+        Everything is drawn with MapGen.get_maps and transformed with batched FFTs, and the
+        beam and noise are added in harmonic space. The batch is reproducible for a given seed
+        (an int or a sequence of ints).
+        """
+        base = list(np.atleast_1d(seed)) if seed is not None else [np.random.SeedSequence().entropy]
+        seed_cmb,seed_kappa,seed_noise = [base+[i] for i in range(3)]
+        unlensed = self.mgen.get_maps(nsims,seed=seed_cmb,nthread=nthread)
+        if self._fixed:
+            kappa = None
+            if taylor_order is None:
+                lensed = enlensing.displace_map(unlensed, self.alpha, order=lens_order)
+            else:
+                phi = enmap.ifft(enmap.fft(self.kappa)*self._kphi).real
+                lensed = flat_taylens(phi,unlensed,taylor_order)
+        else:
+            kappa = self.kgen.get_maps(nsims,seed=seed_kappa,scalar=True,nthread=nthread)
+            kphi = enmap.fft(kappa,nthread=nthread)*self._kphi
+            lensed = enmap.empty(unlensed.shape,unlensed.wcs,unlensed.dtype)
+            if taylor_order is None:
+                # grad(phi) for the whole batch in one inverse FFT
+                ly,lx = enmap.lmap(kappa.shape,kappa.wcs)
+                grad = enmap.ifft(kphi[:,None]*1j*np.array([ly,lx]),nthread=nthread).real
+                pos = self.posmap[:,None] + np.moveaxis(grad,1,0)
+                alpha = np.moveaxis(enmap.sky2pix(kappa.shape,kappa.wcs,pos,safe=False),0,1)
+                for i in range(nsims): lensed[i] = enlensing.displace_map(unlensed[i], alpha[i], order=lens_order)
+            else:
+                phi = enmap.ifft(kphi,nthread=nthread).real
+                for i in range(nsims): lensed[i] = flat_taylens(phi[i],unlensed[i],taylor_order)
+        knoise = self.ngen.get_maps(nsims,seed=seed_noise,harm=True,nthread=nthread)
+        if len(self.mgen.shape)>2:
+            observed = enmap.harm2map(enmap.map2harm(lensed,nthread=nthread)*self.kbeam + knoise,nthread=nthread)
+        else:
+            observed = enmap.ifft(enmap.fft(lensed,nthread=nthread)*self.kbeam + knoise,nthread=nthread).real
+        return [ x if x is None else maps.get_central(x,cfrac) for x in [unlensed,kappa,lensed,observed] ]
+
+    def iter_sims(self,nsims,batch_size,seed=None,prefetch=True,**kwargs):
+        """
+        Yield get_sims batches of up to batch_size sims until nsims sims have been made.
+        Batch i uses seed (*seed,i). With prefetch, the next batch is simulated in a
+        background thread while the caller works on the current one. Other keyword
+        arguments are passed to get_sims.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        base = list(np.atleast_1d(seed)) if seed is not None else [np.random.SeedSequence().entropy]
+        sizes = [min(batch_size,nsims-i) for i in range(0,nsims,batch_size)]
+        make = lambda i: self.get_sims(sizes[i],seed=base+[i],**kwargs)
+        if not(prefetch):
+            for i in range(len(sizes)): yield make(i)
+            return
+        with ThreadPoolExecutor(1) as pool:
+            future = pool.submit(make,0) if sizes else None
+            for i in range(len(sizes)):
+                batch = future.result()
+                if i+1<len(sizes): future = pool.submit(make,i+1)
+                yield batch
         
         
 
+def displacement_operator(shape,alpha_pix,lens_order=5):
+    """The spline interpolation done by enlensing.displace_map(imap,alpha_pix,order=lens_order)
+    (cyclic borders) as a linear operator.
+
+    Returns Py,Px,W -- (Ny,Ny) and (Nx,Nx) spline prefilter matrices and a sparse (Npix,Npix)
+    matrix of B-spline weights, such that the displaced map is W . (Py . imap . Px^T).ravel()
+
+    """
+    from scipy.interpolate import BSpline
+    from scipy import sparse
+    from pixell import interpol
+    ny,nx = shape[-2:]
+    n = lens_order
+    Py = interpol.spline_filter(np.eye(ny),order=n,border="cyclic",ndim=1).T
+    Px = interpol.spline_filter(np.eye(nx),order=n,border="cyclic",ndim=1).T
+    beta = BSpline.basis_element(np.arange(n+2)-(n+1)/2.,extrapolate=False)
+    def weights(pos,size):
+        # The n+1 nodes around each position and their B-spline weights
+        j = np.floor(pos-(n+1)/2.).astype(int)[:,None] + 1 + np.arange(n+1)
+        return j % size, np.nan_to_num(beta(pos[:,None]-j))
+    jy,wy = weights(np.asarray(alpha_pix[0]).reshape(-1),ny)
+    jx,wx = weights(np.asarray(alpha_pix[1]).reshape(-1),nx)
+    npix = ny*nx
+    cols = (jy[:,:,None]*nx + jx[:,None,:]).reshape((npix,-1))
+    vals = (wy[:,:,None]*wx[:,None,:]).reshape((npix,-1))
+    rows = np.repeat(np.arange(npix),cols.shape[1])
+    W = sparse.csr_matrix((vals.reshape(-1),(rows,cols.reshape(-1))),shape=(npix,npix))
+    return Py,Px,W
+
+def _lens_cov_apply(cov,shape,wcs,alpha_pix,lens_order,kbeam):
+    """B.L.cov.L^T.B^T for cov of shape (ncomp,Npix,ncomp,Npix), where L displaces
+    and B beam-filters each component."""
+    Py,Px,W = displacement_operator(shape,alpha_pix,lens_order)
+    ncomp = cov.shape[0]
+    ny,nx = shape[-2:]
+    npix = ny*nx
+    # Spline prefilter all four pixel axes
+    c = np.asarray(cov).reshape((ncomp,ny,nx,ncomp,ny,nx))
+    for axis,P in zip([1,2,4,5],[Py,Px,Py,Px]):
+        c = np.moveaxis(np.tensordot(P,c,axes=(1,axis)),0,axis)
+    # Interpolate (and beam) the last pixel axis, then swap sides and repeat
+    for side in range(2):
+        c = (W @ c.reshape((-1,npix)).T).T
+        if kbeam is not None: c = np.asarray(maps.filter_map(enmap.enmap(c.reshape((-1,ny,nx)),wcs),kbeam))
+        c = np.ascontiguousarray(c.reshape((ncomp,npix,ncomp,npix)).transpose((2,3,0,1)))
+    return c
+
 def lens_cov_pol(shape,wcs,iucov,alpha_pix,lens_order=5,kbeam=None,npixout=None,comm=None):
     """Given the pix-pix covariance matrix for the unlensed CMB,
     returns the lensed covmat for a given pixel displacement model.
@@ -295,9 +407,9 @@ def lens_cov_pol(shape,wcs,iucov,alpha_pix,lens_order=5,kbeam=None,npixout=None,
     alpha_pix -- (2,Ny,Nx) array of lensing displacements in pixel units
     kbeam -- (Ny,Nx) array of 2d beam wavenumbers
 
+    The displacement is applied as a sparse interpolation operator (see displacement_operator)
+    and the beam with batched FFTs, so comm is no longer needed and is ignored.
     """
-    from pixell import lensing as enlensing
-
     assert iucov.ndim==4
     ncomp = iucov.shape[0]
     assert ncomp==iucov.shape[1]
@@ -306,37 +418,9 @@ def lens_cov_pol(shape,wcs,iucov,alpha_pix,lens_order=5,kbeam=None,npixout=None,
     n = shape[-2]
     assert n==shape[-1]
 
-    ucov = iucov.copy()
-    ucov = np.transpose(ucov,(0,2,1,3))
-    ucov = ucov.reshape((ncomp*n**2,ncomp*n**2))
-
-    npix = ncomp*n**2
-
-    if comm is None:
-        from orphics import mpi
-        comm = mpi.MPI.COMM_WORLD
-
-    def efunc(vec):
-        unlensed = enmap.enmap(vec.reshape(shape),wcs)
-        lensed = enlensing.displace_map(unlensed, alpha_pix, order=lens_order)
-        if kbeam is not None: lensed = maps.filter_map(lensed,kbeam) # TODO: replace with convolution
-        # because for ~(60x60) arrays, it is probably much faster. >1 threads means worse performance
-        # with FFTs for these array sizes.
-        return np.asarray(lensed).reshape(-1)
-
-    
-    Scov = np.zeros(ucov.shape,dtype=ucov.dtype)
-    for i in range(comm.rank, npix, comm.size):
-        Scov[i,:] = efunc(ucov[i,:])
-    Scov2 = utils.allreduce(Scov, comm)
-
-    Scov = np.zeros(ucov.shape,dtype=ucov.dtype)
-    for i in range(comm.rank, npix, comm.size):
-        Scov[:,i] = efunc(Scov2[:,i])
-    Scov = utils.allreduce(Scov, comm)
-
+    ucov = np.transpose(np.asarray(iucov),(0,2,1,3))
+    Scov = _lens_cov_apply(ucov,shape,wcs,alpha_pix,lens_order,kbeam)
     
-    Scov = Scov.reshape((ncomp,n*n,ncomp,n*n))
     if (npixout is not None) and (npixout!=n):
         Scov = Scov.reshape((ncomp,n,n,ncomp,n,n))
         s = n//2-npixout//2
@@ -473,20 +557,8 @@ def lens_cov(shape,wcs,ucov,alpha_pix,lens_order=5,kbeam=None,bshape=None):
     kbeam -- (Ny,Nx) array of 2d beam wavenumbers
 
     """
-    from pixell import lensing as enlensing
-
-    Scov = ucov.copy()
-    
-    for i in range(ucov.shape[0]):
-        unlensed = enmap.enmap(Scov[i,:].copy().reshape(shape),wcs)
-        lensed = enlensing.displace_map(unlensed, alpha_pix, order=lens_order)
-        if kbeam is not None: lensed = maps.filter_map(lensed,kbeam)
-        Scov[i,:] = lensed.ravel()
-    for j in range(ucov.shape[1]):
-        unlensed = enmap.enmap(Scov[:,j].copy().reshape(shape),wcs)
-        lensed = enlensing.displace_map(unlensed, alpha_pix, order=lens_order)
-        if kbeam is not None: lensed = maps.filter_map(lensed,kbeam)
-        Scov[:,j] = lensed.ravel()
+    npix = ucov.shape[0]
+    Scov = _lens_cov_apply(np.asarray(ucov).reshape((1,npix,1,npix)),shape,wcs,alpha_pix,lens_order,kbeam).reshape((npix,npix))
 
     if (bshape is not None) and (bshape!=shape):
         ny,nx = shape
@@ -497,6 +569,7 @@ def lens_cov(shape,wcs,ucov,alpha_pix,lens_order=5,kbeam=None,bshape=None):
         sx = nx//2-bnx//2
         ex = sx + bnx
         Scov = Scov[sy:ey,sx:ex,sy:ey,sx:ex].reshape((np.prod(bshape),np.prod(bshape)))
+    if isinstance(ucov,enmap.ndmap): Scov = enmap.enmap(Scov,ucov.wcs)
     return Scov
 
 
@@ -511,21 +584,14 @@ def beam_cov(ucov,kbeam):
     kbeam -- (Ny,Nx) array of 2d beam wavenumbers
 
     """
-    Scov = ucov.copy()
     wcs = ucov.wcs
     shape = kbeam.shape[-2:]
-    for i in range(Scov.shape[0]):
-        lensed = enmap.enmap(Scov[i,:].copy().reshape(shape) ,wcs)
-        lensed = maps.filter_map(lensed,kbeam)
-        Scov[i,:] = lensed.ravel()
-    for j in range(Scov.shape[1]):
-        lensed = enmap.enmap(Scov[:,j].copy().reshape(shape),wcs)
-        lensed = maps.filter_map(lensed,kbeam)
-        Scov[:,j] = lensed.ravel()
-    return Scov
-
+    # Filter all the rows, then all the columns, with batched FFTs
+    Scov = maps.filter_map(enmap.enmap(np.asarray(ucov).reshape((-1,)+shape),wcs),kbeam).reshape(ucov.shape)
+    Scov = maps.filter_map(enmap.enmap(np.asarray(Scov).T.reshape((-1,)+shape),wcs),kbeam).reshape(ucov.shape).T
+    return enmap.enmap(np.ascontiguousarray(Scov),wcs)
 
-def qest(shape,wcs,theory,noise2d=None,beam2d=None,kmask=None,noise2d_P=None,kmask_P=None,kmask_K=None,pol=False,grad_cut=None,unlensed_equals_lensed=False,bigell=9000,noise2d_B=None,noiseX_is_total=False,noiseY_is_total=False):
+def qest(shape,wcs,theory,noise2d=None,beam2d=None,kmask=None,noise2d_P=None,kmask_P=None,kmask_K=None,pol=False,grad_cut=None,unlensed_equals_lensed=False,bigell=9000,noise2d_B=None,noiseX_is_total=False,noiseY_is_total=False,norm_cache_dir=None):
     # if beam2d is None, assumes input maps are beam deconvolved and noise2d is beam deconvolved
     # otherwise, it beam deconvolves itself
     if noise2d is None: noise2d = np.zeros(shape[-2:])
@@ -554,7 +620,8 @@ def qest(shape,wcs,theory,noise2d=None,beam2d=None,kmask=None,noise2d_P=None,kma
                      uEqualsL=unlensed_equals_lensed,
                      bigell=bigell,
                      mpi_comm=None,
-                     lEqualsU=False)
+                     lEqualsU=False,
+                     normCacheDir=norm_cache_dir)
 
 
 def kappa_to_phi(kappa,modlmap,return_fphi=False):
@@ -612,25 +679,40 @@ def getMax(polComb,tellmax,pellmax):
 class QuadNorm(object):
 
     
-    def __init__(self,shape,wcs,gradCut=None,verbose=False,bigell=9000,kBeamX=None,kBeamY=None,fmask=None):
+    def __init__(self,shape,wcs,gradCut=None,verbose=False,bigell=9000,kBeamX=None,kBeamY=None,fmask=None,cache_dir=None,real_fft=False):
+        """
+        If cache_dir is specified, normalizations calculated with getNlkk2d are
+        saved there, keyed by a hash of the geometry, theory spectra, noise, beams,
+        Fourier masks and gradCut. Later calls with identical inputs memory-map
+        the saved arrays instead of recalculating them.
+
+        If real_fft is True, all 2D Fourier arrays (lxMap, modLMap, the filters
+        and the returned normalizations) live on the non-redundant half-plane
+        [...,:Nx//2+1] of a real FFT. Full-plane spectra, noise, masks and
+        beams passed in are cut down to the half-plane automatically.
+        delensClBB is not available on the half-plane.
+        """
         
+        self.cache_dir = cache_dir
+        self.real_fft = real_fft
         self.shape = shape
         self.wcs = wcs
         self.verbose = verbose
         self.Ny,self.Nx = shape[-2:]
         self.lxMap,self.lyMap,self.modLMap,thetaMap,lx,ly = maps.get_ft_attributes(shape,wcs)
+        self.lxMap,self.lyMap,self.modLMap,thetaMap = [self._half(x) for x in [self.lxMap,self.lyMap,self.modLMap,thetaMap]]
         self.lxHatMap = self.lxMap*np.nan_to_num(1. / self.modLMap)
         self.lyHatMap = self.lyMap*np.nan_to_num(1. / self.modLMap)
 
-        self.fmask = fmask
+        self.fmask = self._half(fmask)
 
         if kBeamX is not None:           
-            self.kBeamX = kBeamX
+            self.kBeamX = self._half(kBeamX)
         else:
             self.kBeamX = 1.
             
         if kBeamY is not None:           
-            self.kBeamY = kBeamY
+            self.kBeamY = self._half(kBeamY)
         else:
             self.kBeamY = 1.
 
@@ -645,8 +727,8 @@ class QuadNorm(object):
 
         self.lmax_T=bigell
         self.lmax_P=bigell
-        self.defaultMaskT = maps.mask_kspace(self.shape,self.wcs,lmin=2,lmax=self.lmax_T)
-        self.defaultMaskP = maps.mask_kspace(self.shape,self.wcs,lmin=2,lmax=self.lmax_P)
+        self.defaultMaskT = self._half(maps.mask_kspace(self.shape,self.wcs,lmin=2,lmax=self.lmax_T))
+        self.defaultMaskP = self._half(maps.mask_kspace(self.shape,self.wcs,lmin=2,lmax=self.lmax_P))
         #del lx
         #del ly
         self.thetaMap = thetaMap
@@ -672,6 +754,32 @@ class QuadNorm(object):
         arr[mask<1.e-3] = 0.
         return arr
 
+    def _half(self,arr):
+        # Cut a full-plane Fourier array down to the real FFT half-plane
+        if not(self.real_fft) or arr is None or np.ndim(arr)<2 or arr.shape[-1]!=self.Nx: return arr
+        return arr[...,:self.Nx//2+1]
+
+    def _ifft(self,pre,phase=1.):
+        # With real FFTs, pre must be Hermitian after multiplying by phase.
+        # Anti-Hermitian legs (odd in l) are made Hermitian by a factor of
+        # -1j on the F leg and +1j on the G leg, whose product is 1.
+        if self.real_fft: return irfft(phase*pre,n=self.Nx,axes=[-2,-1],normalize=True)
+        return ifft(pre,axes=[-2,-1],normalize=True)
+
+    def _fft(self,rmap):
+        if self.real_fft: return rfft(rmap,axes=[-2,-1])
+        return fft(rmap,axes=[-2,-1])
+
+    def _norm_cache_key(self,XY,halo):
+        """Hash of all the inputs that determine the normalization of XY."""
+        from orphics import io
+        spectra = []
+        for d in [self.uClNow2d,self.uClFid2d,self.lClFid2d,self.noiseXX2d,self.noiseYY2d,self.fMaskXX,self.fMaskYY]:
+            for key in sorted(d.keys()): spectra += [key,np.asarray(d[key])]
+        return io.array_key((XY,halo,tuple(self.shape[-2:]),self.gradCut,self.bigell,self.lmax_T,self.lmax_P,
+                             self.noiseX_is_total,self.noiseY_is_total,self.real_fft),self.wcs,*spectra,
+                            np.asarray(self.kBeamX),np.asarray(self.kBeamY),self.fmask)
+
     def addUnlensedFilter2DPower(self,XY,power2dData):
         '''
         XY = TT, TE, EE, EB or TB
@@ -679,7 +787,7 @@ class QuadNorm(object):
         These Cls belong in the Wiener filters, and will not
         be perturbed if/when calculating derivatives.
         '''
-        self.uClFid2d[XY] = power2dData.copy()+0.j
+        self.uClFid2d[XY] = self._half(power2dData).copy()+0.j
     def addUnlensedNorm2DPower(self,XY,power2dData):
         '''
         XY = TT, TE, EE, EB or TB
@@ -687,7 +795,7 @@ class QuadNorm(object):
         These Cls belong in the CMB normalization, and will
         be perturbed if/when calculating derivatives.
         '''
-        self.uClNow2d[XY] = power2dData.copy()+0.j
+        self.uClNow2d[XY] = self._half(power2dData).copy()+0.j
     def addLensedFilter2DPower(self,XY,power2dData):
         '''
         XY = TT, TE, EE, EB or TB
@@ -695,7 +803,7 @@ class QuadNorm(object):
         These Cls belong in the Wiener filters, and will not
         be perturbed if/when calculating derivatives.
         '''
-        self.lClFid2d[XY] = power2dData.copy()+0.j
+        self.lClFid2d[XY] = self._half(power2dData).copy()+0.j
     def addNoise2DPowerXX(self,XX,power2dData,fourierMask=None,is_total=False):
         '''
         Noise power for the X leg of the quadratic estimator
@@ -707,7 +815,8 @@ class QuadNorm(object):
         '''
         # check if fourier mask is int!
         self.noiseX_is_total = is_total
-        self.noiseXX2d[XX] = power2dData.copy()+0.j
+        self.noiseXX2d[XX] = self._half(power2dData).copy()+0.j
+        fourierMask = self._half(fourierMask)
         if fourierMask is not None:
             self.noiseXX2d[XX][fourierMask==0] = np.inf
             self.fMaskXX[XX] = fourierMask
@@ -728,7 +837,8 @@ class QuadNorm(object):
         '''
         # check if fourier mask is int!
         self.noiseY_is_total = is_total
-        self.noiseYY2d[YY] = power2dData.copy()+0.j
+        self.noiseYY2d[YY] = self._half(power2dData).copy()+0.j
+        fourierMask = self._half(fourierMask)
         if fourierMask is not None:
             self.noiseYY2d[YY][fourierMask==0] = np.inf
             self.fMaskYY[YY] = fourierMask
@@ -744,7 +854,7 @@ class QuadNorm(object):
         Used if delensing
         power2d is a flipper power2d object            
         '''
-        self.clkk2d = power2dData.copy()+0.j
+        self.clkk2d = self._half(power2dData).copy()+0.j
         self.clpp2d = 0.j+np.nan_to_num(self.clkk2d.copy()*4./(self.modLMap**2.)/((self.modLMap+1.)**2.))
 
 
@@ -809,14 +919,14 @@ class QuadNorm(object):
         raise NotImplementedError
 
     def super_dumb_N0_TTTT(self,data_power_2d_TT):
-        ratio = np.nan_to_num(data_power_2d_TT*self.WY("TT")/self.kBeamY)
+        ratio = np.nan_to_num(self._half(data_power_2d_TT)*self.WY("TT")/self.kBeamY)
         lmap = self.modLMap
         replaced = np.nan_to_num(self.getNlkk2d("TT",halo=True,l1Scale=self.fmask_func(ratio,self.fMaskXX["TT"]),l2Scale=self.fmask_func(ratio,self.fMaskYY["TT"]),setNl=False) / (2. * np.nan_to_num(1. / lmap/(lmap+1.))))
         unreplaced = self.Nlkk["TT"].copy()
         return np.nan_to_num(unreplaced**2./replaced)
 
     def super_dumb_N0_EEEE(self,data_power_2d_EE):
-        ratio = np.nan_to_num(data_power_2d_EE*self.WY("EE")/self.kBeamY)
+        ratio = np.nan_to_num(self._half(data_power_2d_EE)*self.WY("EE")/self.kBeamY)
         lmap = self.modLMap
         replaced = np.nan_to_num(self.getNlkk2d("EE",halo=True,l1Scale=self.fmask_func(ratio,self.fMaskXX["EE"]),l2Scale=self.fmask_func(ratio,self.fMaskYY["EE"]),setNl=False) / (2. * np.nan_to_num(1. / lmap/(lmap+1.))))
         unreplaced = self.Nlkk["EE"].copy()
@@ -824,6 +934,15 @@ class QuadNorm(object):
     
     def getNlkk2d(self,XY,halo=True,l1Scale=1.,l2Scale=1.,setNl=True):
         if not(halo): raise NotImplementedError
+
+        # Only the standard normalization is cached, not rescaled versions
+        use_cache = (self.cache_dir is not None) and np.isscalar(l1Scale) and np.isscalar(l2Scale) and l1Scale==1 and l2Scale==1
+        if use_cache:
+            croot = f"{self.cache_dir}/qnorm_{XY}_{self._norm_cache_key(XY,halo)}"
+            if os.path.isfile(croot+"_nlkk.npy") and os.path.isfile(croot+"_al.npy"):
+                if self.verbose: print(("Loading cached norm for ", XY))
+                if setNl: self.Nlkk[XY] = np.load(croot+"_nlkk.npy",mmap_mode='r')
+                return np.load(croot+"_al.npy",mmap_mode='r')
         
         lx,ly = self.lxMap,self.lyMap
         lmap = self.modLMap
@@ -860,7 +979,7 @@ class QuadNorm(object):
                     preGX = ell2*clunlenTTArrNow*WY
                     
 
-                    calc = ell1*ell2*fft(ifft(preF,axes=[-2,-1],normalize=True)*ifft(preG,axes=[-2,-1],normalize=True)+ifft(preFX,axes=[-2,-1],normalize=True)*ifft(preGX,axes=[-2,-1],normalize=True),axes=[-2,-1])
+                    calc = ell1*ell2*self._fft(self._ifft(preF)*self._ifft(preG)+self._ifft(preFX,-1.j)*self._ifft(preGX,1.j))
                     allTerms += [calc]
                     
 
@@ -914,14 +1033,14 @@ class QuadNorm(object):
                     for trigfact in [cossqf,sinsqf,np.sqrt(2.)*sinf*cosf]:
                         preF = trigfact*ell1*ell2*clunlenEEArrNow*WXY
                         preG = trigfact*WY
-                        allTerms += [ell1*ell2*fft(ifft(preF,axes=[-2,-1],normalize=True)*ifft(preG,axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                        allTerms += [ell1*ell2*self._fft(self._ifft(preF)*self._ifft(preG))]
                         
                         #allTerms += [ell1*ell2*fft2(ifft2(preF)*ifft2(preG))]
                         
                         preFX = trigfact*ell1*clunlenEEArrNow*WY
                         preGX = trigfact*ell2*WXY
 
-                        allTerms += [ell1*ell2*fft(ifft(preFX,axes=[-2,-1],normalize=True)*ifft(preGX,axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                        allTerms += [ell1*ell2*self._fft(self._ifft(preFX,-1.j)*self._ifft(preGX,1.j))]
                         #allTerms += [ell1*ell2*fft2(ifft2(preFX)*ifft2(preGX))]
 
                 
@@ -974,8 +1093,8 @@ class QuadNorm(object):
                 preF = ellsq*clunlenEEArrNow*WXY
                 preG = WY
 
-                for termF,termG in zip(termsF,termsG):
-                    allTerms += [ellsq*fft(ifft(termF(preF,lxhat,lyhat),axes=[-2,-1],normalize=True)*ifft(termG(preG,lxhat,lyhat),axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                for termF,termG,phaseF,phaseG in zip(termsF,termsG,[1.,1.,-1.j],[1.,1.,1.j]):
+                    allTerms += [ellsq*self._fft(self._ifft(termF(preF,lxhat,lyhat),phaseF)*self._ifft(termG(preG,lxhat,lyhat),phaseG))]
 
         elif XY == 'BE':
 
@@ -1009,8 +1128,8 @@ class QuadNorm(object):
                 preF = WXY
                 preG = ellsq*clunlenEEArrNow*WY
 
-                for termF,termG in zip(termsF,termsG):
-                    allTerms += [ellsq*fft(ifft(termF(preF,lxhat,lyhat),axes=[-2,-1],normalize=True)*ifft(termG(preG,lxhat,lyhat),axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                for termF,termG,phaseF,phaseG in zip(termsF,termsG,[1.,1.,-1.j],[1.,1.,1.j]):
+                    allTerms += [ellsq*self._fft(self._ifft(termF(preF,lxhat,lyhat),phaseF)*self._ifft(termG(preG,lxhat,lyhat),phaseG))]
 
 
         elif XY=='ET':
@@ -1041,13 +1160,13 @@ class QuadNorm(object):
                 for ell1,ell2 in [(lx,lx),(ly,ly),(rfact*lx,rfact*ly)]:
                     preF = ell1*ell2*clunlenTEArrNow*WXY
                     preG = WY
-                    allTerms += [ell1*ell2*fft(ifft(preF,axes=[-2,-1],normalize=True)*ifft(preG,axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                    allTerms += [ell1*ell2*self._fft(self._ifft(preF)*self._ifft(preG))]
                     for trigfact in [cosf,sinf]:
 
                         preFX = trigfact*ell1*clunlenTEArrNow*WY
                         preGX = trigfact*ell2*WXY
 
-                        allTerms += [ell1*ell2*fft(ifft(preFX,axes=[-2,-1],normalize=True)*ifft(preGX,axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                        allTerms += [ell1*ell2*self._fft(self._ifft(preFX,-1.j)*self._ifft(preGX,1.j))]
 
 
             # else:
@@ -1117,13 +1236,13 @@ class QuadNorm(object):
                     for trigfact in [cossqf,sinsqf,np.sqrt(2.)*sinf*cosf]:
                         preF = trigfact*ell1*ell2*clunlenTEArrNow*WXY
                         preG = trigfact*WY
-                        allTerms += [ell1*ell2*fft(ifft(preF,axes=[-2,-1],normalize=True)*ifft(preG,axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                        allTerms += [ell1*ell2*self._fft(self._ifft(preF)*self._ifft(preG))]
                     for trigfact in [cosf,sinf]:
                         
                         preFX = trigfact*ell1*clunlenTEArrNow*WY
                         preGX = trigfact*ell2*WXY
 
-                        allTerms += [ell1*ell2*fft(ifft(preFX,axes=[-2,-1],normalize=True)*ifft(preGX,axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                        allTerms += [ell1*ell2*self._fft(self._ifft(preFX,-1.j)*self._ifft(preGX,1.j))]
 
                 
             # else:
@@ -1196,8 +1315,8 @@ class QuadNorm(object):
                 preF = ellsq*clunlenTEArrNow*WXY
                 preG = WY
 
-                for termF,termG in zip(termsF,termsG):
-                    allTerms += [ellsq*fft(ifft(termF(preF,lxhat,lyhat),axes=[-2,-1],normalize=True)*ifft(termG(preG,lxhat,lyhat),axes=[-2,-1],normalize=True),axes=[-2,-1])]
+                for termF,termG,phaseF,phaseG in zip(termsF,termsG,[1.,1.,-1.j],[1.,1.,1.j]):
+                    allTerms += [ellsq*self._fft(self._ifft(termF(preF,lxhat,lyhat),phaseF)*self._ifft(termG(preG,lxhat,lyhat),phaseG))]
                     
 
             
@@ -1235,8 +1354,14 @@ class QuadNorm(object):
         # sys.exit()
 
 
+
+        alval = retval * 2. * np.nan_to_num(1. / lmap/(lmap+1.))
+        if use_cache:
+            from orphics import io
+            io.atomic_save(croot+"_nlkk.npy",retval)
+            io.atomic_save(croot+"_al.npy",alval)
             
-        return retval * 2. * np.nan_to_num(1. / lmap/(lmap+1.))
+        return alval
         
         
                   
@@ -1249,6 +1374,7 @@ class QuadNorm(object):
         """
         Delens ClBB with input Nlkk curve
         """
+        if self.real_fft: raise ValueError("delensClBB needs full-plane FFTs; its unmasked Clpp legs extend to the Nyquist modes, which are not even in l. Use real_fft=False.")
 
         # Set the phi noise = Clpp + Nlpp
         Nlppnow = Nlkk*4./(self.modLMap**2.)/((self.modLMap+1.)**2.)
@@ -1691,7 +1817,9 @@ class Estimator(object):
                  uEqualsL=False,
                  bigell=9000,
                  mpi_comm=None,
-                 lEqualsU=False):
+                 lEqualsU=False,
+                 normCacheDir=None,
+                 realFFT=False):
 
         '''
         All the 2d fourier objects below are pre-fftshifting. They must be of the same dimension.
@@ -1709,6 +1837,10 @@ class Estimator(object):
         halo=False: use the halo lensing estimators?
         gradCut=None: if using halo lensing estimators, specify an integer up to what L the X map will be retained
         verbose=False: print some occasional output?
+        normCacheDir=None: directory for an on-disk cache of the normalization (see QuadNorm)
+        realFFT=False: use real FFTs throughout. All 2d fourier objects (noise, masks, beams, 
+        norms and Fourier-space inputs/outputs) are then on the half-plane [...,:Nx//2+1], 
+        which halves memory and FFT cost. Full-plane noise, masks and beams are cut down automatically.
 
         '''
 
@@ -1717,13 +1849,14 @@ class Estimator(object):
         # initialize norm and filters
 
         self.doCurl = doCurl
-
+        self.realFFT = realFFT
 
 
         if loadPickledNormAndFilters is not None:
             if verbose: print("Unpickling...")
             with open(loadPickledNormAndFilters,'rb') as fin:
                 self.N,self.AL,self.OmAL,self.fmaskK,self.phaseY = pickle.load(fin)
+            self.realFFT = getattr(self.N,'real_fft',False)
             return
 
 
@@ -1752,6 +1885,7 @@ class Estimator(object):
             self.fmaskK = fmaps.fourierMask(self.N.lx,self.N.ly,self.N.modLMap,lmin=ellMinK,lmax=ellMaxK)
         else:
             self.fmaskK = fmaskKappa
+        if realFFT and self.fmaskK.shape[-1]==shape[-1]: self.fmaskK = self.fmaskK[...,:shape[-1]//2+1]
 
         
         self.fmaskX2dTEB = fmaskX2dTEB
@@ -1768,7 +1902,7 @@ class Estimator(object):
 
         self.wcs = wcs
         if rank==0:
-            self.N = QuadNorm(shape,wcs,gradCut=gradCut,verbose=verbose,kBeamX=self.kBeamX,kBeamY=self.kBeamY,bigell=bigell,fmask=self.fmaskK)
+            self.N = QuadNorm(shape,wcs,gradCut=gradCut,verbose=verbose,kBeamX=self.kBeamX,kBeamY=self.kBeamY,bigell=bigell,fmask=self.fmaskK,cache_dir=normCacheDir,real_fft=realFFT)
 
 
             if TOnly: 
@@ -1849,6 +1983,8 @@ class Estimator(object):
         Masking and windowing and apodizing and beam deconvolution has to be done beforehand!
 
         Maps must have units corresponding to those of theory Cls and noise power
+
+        If alreadyFTed and realFFT, the maps must be half-plane real FFTs.
         '''
         self._hasX = True
 
@@ -1861,7 +1997,7 @@ class Estimator(object):
         if alreadyFTed:
             self.kT = T2DData
         else:
-            self.kT = fft(T2DData,axes=[-2,-1])
+            self.kT = self._fft(T2DData)
         self.kGradx['T'] = lx*self.kT.copy()*1j
         self.kGrady['T'] = ly*self.kT.copy()*1j
 
@@ -1869,14 +2005,14 @@ class Estimator(object):
             if alreadyFTed:
                 self.kE = E2DData
             else:
-                self.kE = fft(E2DData,axes=[-2,-1])
+                self.kE = self._fft(E2DData)
             self.kGradx['E'] = 1.j*lx*self.kE.copy()
             self.kGrady['E'] = 1.j*ly*self.kE.copy()
         if B2DData is not None:
             if alreadyFTed:
                 self.kB = B2DData
             else:
-                self.kB = fft(B2DData,axes=[-2,-1])
+                self.kB = self._fft(B2DData)
             self.kGradx['B'] = 1.j*lx*self.kB.copy()
             self.kGrady['B'] = 1.j*ly*self.kB.copy()
         
@@ -1892,14 +2028,14 @@ class Estimator(object):
             if alreadyFTed:
                 self.kHigh['T']=T2DData
             else:
-                self.kHigh['T']=fft(T2DData,axes=[-2,-1])
+                self.kHigh['T']=self._fft(T2DData)
         else:
             self.kHigh['T']=self.kT.copy()
         if E2DData is not None:
             if alreadyFTed:
                 self.kHigh['E']=E2DData
             else:
-                self.kHigh['E']=fft(E2DData,axes=[-2,-1])
+                self.kHigh['E']=self._fft(E2DData)
         else:
             try:
                 self.kHigh['E']=self.kE.copy()
@@ -1910,7 +2046,7 @@ class Estimator(object):
             if alreadyFTed:
                 self.kHigh['B']=B2DData
             else:
-                self.kHigh['B']=fft(B2DData,axes=[-2,-1])
+                self.kHigh['B']=self._fft(B2DData)
         else:
             try:
                 self.kHigh['B']=self.kB.copy()
@@ -1925,9 +2061,28 @@ class Estimator(object):
         
     def fmask_func(self,arr):
         fMask = self.fmaskK
-        arr[fMask<1.e-3] = 0.
+        arr[...,fMask<1.e-3] = 0.
         return arr
 
+    def _fft(self,imap):
+        if self.realFFT: return rfft(imap,axes=[-2,-1])
+        return fft(imap,axes=[-2,-1])
+
+    def _ifft(self,kmap):
+        # Real part of the normalized inverse FFT
+        if self.realFFT: return irfft(kmap,n=self.N.Nx,axes=[-2,-1],normalize=True)
+        return ifft(kmap,axes=[-2,-1],normalize=True).real
+
+    def _real_legs(self,kmap,Y,phaseB=1.):
+        """Real and imaginary parts of the inverse FFT of kmap*phaseY*phaseB
+        using real FFTs, for Hermitian half-plane kmap. The polarization phase is
+        split into its cosine and sine, which are both even in l. The imaginary
+        part is None for Y=='T'."""
+        if Y not in ['E','B']: return self._ifft(kmap),None
+        re,im = self._ifft(kmap*self.phaseY.real),self._ifft(kmap*self.phaseY.imag)
+        if phaseB==1.j: return -im,re
+        return re,im
+
     def coadd_nlkk(self,ests):
         ninvtot = 0.
         for est in ests:
@@ -1941,57 +2096,105 @@ class Estimator(object):
             ktot += self.fmask_func(np.nan_to_num(rkappa/self.N.Nlkk[est]))
         kft = ktot*self.coadd_nlkk(ests)
         if returnFt: return kft
-        return ifft(kft,axes=[-2,-1],normalize=True).real
+        return self._ifft(kft)
     
-    def get_kappa(self,XY,returnFt=False):
-
-        assert self._hasX and self._hasY
-        assert XY in ['TT','TE','ET','EB','TB','EE','BE']
+    def _high_leg(self,Y,kHighY):
+        """Inverse FFT of the (conjugated) Wiener filtered high-pass Y leg.
+        kHighY can be a single (Ny,Nx) Fourier map or a (nsims,Ny,Nx) stack.
+        With realFFT, this is a (real,imaginary) tuple of real maps."""
+        WY = self.N.WY(Y+Y)
+        phaseY = self.phaseY if Y in ['E','B'] else 1.
+        phaseB = (int(Y=='B')*1.j)+(int(Y!='B'))
+        if self.realFFT:
+            re,im = self._real_legs(kHighY*WY,Y,phaseB)
+            return re,(None if im is None else -im)
+        return ifft((kHighY*WY*phaseY*phaseB),axes=[-2,-1],normalize=True).conjugate()
+
+    def _kappaft_from_legs(self,XY,kGradx,kGrady,HighMapStar):
+        """Normalized Fourier-space reconstruction given the x and y gradients of
+        the X leg and the output of _high_leg for the Y leg. The two gradient
+        components (and any leading stack dimension) are transformed in a single call."""
         X,Y = XY
-
         WXY = self.N.WXY(XY)
-        WY = self.N.WY(Y+Y)
-
-
-
+        phaseY = self.phaseY if Y in ['E','B'] else 1.
         lx = self.N.lxMap
         ly = self.N.lyMap
-
-        if Y in ['E','B']:
-            phaseY = self.phaseY
+        kGrad = np.stack([kGradx,kGrady])*WXY
+        if self.realFFT:
+            # Only the real part of the product is needed
+            hre,him = HighMapStar
+            gre,gim = self._real_legs(kGrad,Y)
+            kP = self._fft(gre*hre if gim is None else gre*hre-gim*him)
         else:
-            phaseY = 1.
+            kP = fft(ifft(kGrad*phaseY,axes=[-2,-1],normalize=True)*HighMapStar,axes=[-2,-1])
+        rawKappa = self._ifft((1.j*lx*kP[0]) + (1.j*ly*kP[1]))
+        assert not(np.any(np.isnan(rawKappa)))
+        AL = np.nan_to_num(self.AL[XY])
+        return -self.fmask_func(AL*self._fft(rawKappa))
 
-        phaseB = (int(Y=='B')*1.j)+(int(Y!='B'))
-        
-        fMask = self.fmaskK
+    def kappa_from_maps(self,XYs,T2DData,E2DData=None,B2DData=None,T2DDataY=None,E2DDataY=None,B2DDataY=None,alreadyFTed=False,returnFt=False):
+        '''
+        Batched version of kappa_from_map for many simulations and estimators at once.
 
-        if self.verbose: startTime = time.time()
+        The maps are stacks of shape (nsims,Ny,Nx) (in real space, or Fourier space
+        if alreadyFTed). XYs is a list of estimators, e.g. ['TT','TE','EE','EB'].
+        The whole stack is transformed with one FFT call per leg, and the filtered
+        high-pass Y legs are shared between estimators with the same Y.
+        The results are identical to calling kappa_from_map on each map.
 
-        HighMapStar = ifft((self.kHigh[Y]*WY*phaseY*phaseB),axes=[-2,-1],normalize=True).conjugate()
-        kPx = fft(ifft(self.kGradx[X]*WXY*phaseY,axes=[-2,-1],normalize=True)*HighMapStar,axes=[-2,-1])
-        kPy = fft(ifft(self.kGrady[X]*WXY*phaseY,axes=[-2,-1],normalize=True)*HighMapStar,axes=[-2,-1])        
-        rawKappa = ifft((1.j*lx*kPx) + (1.j*ly*kPy),axes=[-2,-1],normalize=True).real
+        Returns a dictionary mapping each XY to a (nsims,Ny,Nx) stack of
+        reconstructed kappa maps (or their Fourier transforms if returnFt).
+        '''
+        if isinstance(XYs,str): XYs = [XYs]
+        for XY in XYs: assert XY in ['TT','TE','ET','EB','TB','EE','BE']
 
-        AL = np.nan_to_num(self.AL[XY])
+        def _ft(imaps):
+            if imaps is None: return None
+            return imaps if alreadyFTed else self._fft(np.asarray(imaps))
 
+        kX = {'T':_ft(T2DData),'E':_ft(E2DData),'B':_ft(B2DData)}
+        kY = {'T':_ft(T2DDataY),'E':_ft(E2DDataY),'B':_ft(B2DDataY)}
+        for key in kY.keys():
+            if kY[key] is None: kY[key] = kX[key]
 
-        assert not(np.any(np.isnan(rawKappa)))
-        lmap = self.N.modLMap
+        lx = self.N.lxMap
+        ly = self.N.lyMap
+        highs = {}
+        kappas = {}
+        for XY in XYs:
+            X,Y = XY
+            if Y not in highs: highs[Y] = self._high_leg(Y,kY[Y])
+            kappaft = self._kappaft_from_legs(XY,1.j*lx*kX[X],1.j*ly*kX[X],highs[Y])
+            if returnFt:
+                kappas[XY] = kappaft
+            else:
+                kappas[XY] = enmap.enmap(self._ifft(kappaft),self.wcs)
+        return kappas
 
-        kappaft = -self.fmask_func(AL*fft(rawKappa,axes=[-2,-1]))
+    def get_kappa(self,XY,returnFt=False):
+
+        assert self._hasX and self._hasY
+        assert XY in ['TT','TE','ET','EB','TB','EE','BE']
+        X,Y = XY
+
+        if self.verbose: startTime = time.time()
+
+        HighMapStar = self._high_leg(Y,self.kHigh[Y])
+        kappaft = self._kappaft_from_legs(XY,self.kGradx[X],self.kGrady[X],HighMapStar)
         
         if returnFt:
             return kappaft
         
-        self.kappa = enmap.enmap(ifft(kappaft,axes=[-2,-1],normalize=True).real,self.wcs)
+        self.kappa = enmap.enmap(self._ifft(kappaft),self.wcs)
         try:
             assert not(np.any(np.isnan(self.kappa)))
         except:
             import orphics.tools.io as io
             import orphics.tools.stats as stats
+            AL = np.nan_to_num(self.AL[XY])
+            lmap = self.N.modLMap
             io.quickPlot2d(np.fft.fftshift(np.abs(kappaft)),"ftkappa.png")
-            io.quickPlot2d(np.fft.fftshift(fMask),"fmask.png")
+            io.quickPlot2d(np.fft.fftshift(self.fmaskK),"fmask.png")
             io.quickPlot2d(self.kappa.real,"nankappa.png")
             debug_edges = np.arange(20,20000,100)
             dbinner = stats.bin2D(self.N.modLMap,debug_edges)
@@ -2445,14 +2648,12 @@ class QE(object):
         else:
             phaseY = 1.
         phaseB = (int(Y=='B')*1.j)+(int(Y!='B'))
-        fMask = self.fmaskK
         HighMapStar = ifft((self.kHigh[Y]*WY*phaseY*phaseB),axes=[-2,-1],normalize=True).conjugate()
         kPx = fft(ifft(self.kGradx[X]*WXY*phaseY,axes=[-2,-1],normalize=True)*HighMapStar,axes=[-2,-1])
         kPy = fft(ifft(self.kGrady[X]*WXY*phaseY,axes=[-2,-1],normalize=True)*HighMapStar,axes=[-2,-1])        
         rawKappa = ifft((1.j*lx*kPx) + (1.j*ly*kPy),axes=[-2,-1],normalize=True).real
         AL = np.nan_to_num(self.AL[XY])
         assert not(np.any(np.isnan(rawKappa)))
-        lmap = self.N.modLMap
         kappaft = -self.fmask_func(AL*fft(rawKappa,axes=[-2,-1]))
         if return_ft:
             return kappaft
@@ -2,10 +2,11 @@ from __future__ import print_function
 from pixell import enmap, utils, resample, curvedsky as cs, reproject,pointsrcs
 import numpy as np
 from pixell.fft import fft,ifft
+from pixell import fft as pfft
 from scipy.interpolate import interp1d
 import yaml,six
 from orphics import io,cosmology,stats
-import math
+import math,os
 from scipy.interpolate import RectBivariateSpline,interp2d,interp1d
 import warnings
 import healpy as hp
@@ -551,7 +552,6 @@ def binned_power(imap,bin_edges=None,binner=None,fc=None,modlmap=None,imap2=None
     """Get the binned power spectrum of a map in one line of code.
     (At the cost of flexibility and reusability of expensive parts)"""
     
-    from orphics import stats
     shape,wcs = imap.shape,imap.wcs
     modlmap = enmap.modlmap(shape,wcs) if modlmap is None else modlmap
     fc = FourierCalc(shape,wcs) if fc is None else fc
@@ -560,6 +560,86 @@ def binned_power(imap,bin_edges=None,binner=None,fc=None,modlmap=None,imap2=None
     cents,p1d = binner.bin(p2d)
     return cents,p1d/np.mean(mask**2.)
 
+
+class ModeCoupling(object):
+    """
+    Flat-sky MASTER-style mode coupling of a mask. The binned mode-coupling matrix
+    is calculated once with FFTs (and optionally cached on disk), after which
+    decoupled bandpowers of any number of maps are cheap.
+    """
+
+    def __init__(self,mask,bin_edges,apod_deg=None,fl2d=None,fc=None,cache_dir=None,nbatch=8,nthread=0):
+        """
+        mask is an (Ny,Nx) ndmap. Every bin must contain Fourier modes, otherwise a
+        ValueError is raised. If apod_deg is specified, the mask is apodized with
+        cosine_apodize and that is the window applied to the maps (self.window).
+        fl2d is an optional (Ny,Nx) transfer function (e.g. beam squared) of the power
+        to include in the coupling. Bandpowers are assumed constant within bins, and power
+        outside of bin_edges is neglected, so the bins should cover the signal.
+        The coupling is for spin-0 fields, so E/B mixing of polarization is not included.
+        If cache_dir is specified, the coupling matrix is saved to and loaded from there.
+        Coupling matrix columns are calculated nbatch bins at a time.
+        """
+        self.shape,self.wcs = mask.shape[-2:],mask.wcs
+        self.window = cosine_apodize(mask,apod_deg) if apod_deg is not None else mask
+        self.bin_edges = np.asarray(bin_edges)
+        self.fl2d = fl2d
+        self.nthread = nthread
+        self.cache_dir = cache_dir
+        self.fc = FourierCalc(self.shape,self.wcs,nthread=nthread) if fc is None else fc
+        self.modlmap = enmap.modlmap(self.shape,self.wcs)
+        self.binner = stats.bin2D(self.modlmap,self.bin_edges)
+        self.cents = self.binner.centers
+        # Empty bins would make the coupling matrix singular (and every bandpower NaN)
+        empty = np.nonzero(self.binner.bin(np.ones(self.shape),get_count=True)[2]==0)[0]
+        if empty.size: raise ValueError(f"Bins {empty.tolist()} of bin_edges contain no Fourier modes "
+                                        f"(modlmap ranges from {self.modlmap[self.modlmap>0].min():.1f} to {self.modlmap.max():.1f}). "
+                                        "Use wider bins or drop them.")
+
+        fname = f"{cache_dir}/mcm_{self._cache_key()}.npy" if cache_dir is not None else None
+        if fname is not None and os.path.exists(fname):
+            self.mcm = np.load(fname)
+        else:
+            self.mcm = self._coupling(nbatch)
+            if fname is not None: io.atomic_save(fname,self.mcm)
+        self.imcm = np.linalg.inv(self.mcm)
+
+    def _cache_key(self):
+        """Hash of all the inputs that determine the coupling matrix."""
+        return io.array_key(np.asarray(self.window),np.asarray(self.bin_edges),self.fl2d if self.fl2d is None else np.asarray(self.fl2d),self.wcs)
+
+    def _coupling(self,nbatch):
+        # The 2D power of the windowed map is the circular convolution of the
+        # 2D power with K = |FFT(window)|^2/N^2, so column b' of the coupling matrix
+        # is the binned convolution of K with the indicator of bin b'.
+        npix = np.prod(self.shape)
+        fK = fft(np.abs(fft(np.asarray(self.window)+0j,axes=[-2,-1],nthread=self.nthread))**2./npix**2.+0j,
+                 axes=[-2,-1],nthread=self.nthread)
+        edges = self.bin_edges
+        nbins = edges.size-1
+        fl2d = 1. if self.fl2d is None else np.asarray(self.fl2d)
+        mcm = np.zeros((nbins,nbins))
+        for i in range(0,nbins,nbatch):
+            bins = np.arange(i,min(i+nbatch,nbins))
+            chi = ((self.modlmap>edges[bins,None,None]) & (self.modlmap<=edges[bins+1,None,None])) * fl2d
+            conv = ifft(fft(chi+0j,axes=[-2,-1],nthread=self.nthread)*fK,axes=[-2,-1],normalize=True,nthread=self.nthread).real
+            mcm[:,bins] = self.binner.bin(conv)[1].T
+        return mcm
+
+    def decouple(self,p1d):
+        """Decouple (...,nbins) binned pseudo-spectra of maps multiplied by self.window."""
+        return np.dot(p1d,self.imcm.T)
+
+    def power(self,imaps,imaps2=None):
+        """
+        Decoupled bandpowers of (...,Ny,Nx) maps imaps (crossed with imaps2 if specified),
+        which are multiplied by self.window. Returns cents and (...,nbins) bandpowers.
+        """
+        k1 = fft(np.asarray(imaps*self.window)+0j,axes=[-2,-1],nthread=self.nthread)
+        k2 = fft(np.asarray(imaps2*self.window)+0j,axes=[-2,-1],nthread=self.nthread) if imaps2 is not None else k1
+        cents,p1d = self.binner.bin(self.fc.f2power(k1,k2))
+        return cents,self.decouple(p1d)
+
 def interp(x,y,bounds_error=False,fill_value=0.,**kwargs):
     return interp1d(x,y,bounds_error=bounds_error,fill_value=fill_value,**kwargs)
 
@@ -754,14 +834,29 @@ class MapGen(object):
         """
         Once you know the shape and wcs of an ndmap and the input power spectra, you can 
         pre-calculate some things to speed up random map generation.
+
+        If cache_dir is specified, the square root of the covariance is saved to and
+        loaded from disk. With memory_cache=True, it is also kept in memory for the most
+        recent cache_size inputs, so that re-creating a MapGen for the same geometry and
+        spectra is cheap. Cached arrays are shared between MapGens and so are read-only;
+        clear them with MapGen._cache.clear().
         """
-        
-        def __init__(self,shape,wcs,cov=None,covsqrt=None,pixel_units=False,smooth="auto",ndown=None,order=1):
+        _cache = {}
+        cache_size = 4
+
+        def __init__(self,shape,wcs,cov=None,covsqrt=None,pixel_units=False,smooth="auto",ndown=None,order=1,cache_dir=None,memory_cache=False):
                 self.shape = shape
                 self.wcs = wcs
-                assert cov.ndim>=3 , "Power spectra have to be of shape (ncomp,ncomp,lmax) or (ncomp,ncomp,Ny,Nx)."
                 if covsqrt is not None:
                     self.covsqrt = covsqrt
+                    return
+                assert cov.ndim>=3 , "Power spectra have to be of shape (ncomp,ncomp,lmax) or (ncomp,ncomp,Ny,Nx)."
+                key = self._cache_key(shape,wcs,cov,pixel_units,smooth,ndown,order) if (memory_cache or cache_dir is not None) else None
+                fname = f"{cache_dir}/mapgen_covsqrt_{key}.npy" if cache_dir is not None else None
+                if memory_cache and key in MapGen._cache:
+                    self.covsqrt = MapGen._cache.pop(key)
+                elif fname is not None and os.path.exists(fname):
+                    self.covsqrt = enmap.enmap(np.load(fname),wcs)
                 else:
                     if cov.ndim==4:
                             if not(pixel_units): cov = cov * np.prod(shape[-2:])/enmap.area(shape,wcs )
@@ -771,6 +866,16 @@ class MapGen(object):
                                 self.covsqrt = enmap.multi_pow(cov, 0.5)
                     else:
                             self.covsqrt = enmap.spec2flat(shape, wcs, cov, 0.5, mode="constant",smooth=smooth)
+                    if fname is not None: io.atomic_save(fname,self.covsqrt)
+                if not(memory_cache): return
+                self.covsqrt.setflags(write=False)
+                MapGen._cache[key] = self.covsqrt
+                while len(MapGen._cache)>MapGen.cache_size: MapGen._cache.pop(next(iter(MapGen._cache)))
+
+        @staticmethod
+        def _cache_key(shape,wcs,cov,pixel_units,smooth,ndown,order):
+                """Hash of all the inputs that determine covsqrt."""
+                return io.array_key((tuple(shape),pixel_units,smooth,ndown,order),wcs,np.asarray(cov))
 
 
         def get_map(self,seed=None,scalar=False,iau=False,real=False,harm=False):
@@ -786,6 +891,44 @@ class MapGen(object):
                     else:
                             return enmap.harm2map(kmap,iau=iau)
 
+        def get_maps(self,nsims,seed=None,scalar=False,iau=False,real=False,harm=False,nthread=0):
+                """
+                Like get_map, but returns an (nsims,...) batch of realizations transformed
+                with one batched FFT. Each realization is drawn from its own np.random.Generator
+                spawned from np.random.SeedSequence(seed), so the batch is reproducible for a
+                given seed. With nthread>1, the random numbers are drawn in that many threads.
+                A (Ny,Nx) shape is treated as a single component, giving (nsims,Ny,Nx) maps.
+                """
+                shape = tuple(self.shape) if len(self.shape)>2 else (1,)+tuple(self.shape)
+                streams = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(nsims)]
+                rand = np.empty((nsims,)+shape,dtype=np.float64 if real else np.complex128)
+                def draw(i):
+                        # Complex draws fill the real and imaginary parts with independent normals
+                        streams[i].standard_normal(out=rand[i].view(np.float64))
+                if nthread>1:
+                        from concurrent.futures import ThreadPoolExecutor
+                        with ThreadPoolExecutor(nthread) as pool: list(pool.map(draw,range(nsims)))
+                else:
+                        for i in range(nsims): draw(i)
+                rand = enmap.ndmap(rand,self.wcs)
+                if real: rand = enmap.fft(rand,nthread=nthread)
+                # covsqrt . rand, accumulated per component pair to avoid einsum temporaries
+                kmaps = enmap.ndmap(np.zeros(rand.shape,dtype=np.result_type(self.covsqrt.dtype,rand.dtype)), self.wcs)
+                tmp = np.empty(kmaps.shape[:1]+kmaps.shape[-2:],dtype=kmaps.dtype)
+                ncomp = self.covsqrt.shape[0]
+                for i in range(ncomp):
+                        for j in range(ncomp):
+                                np.multiply(self.covsqrt[i,j],rand[:,j],out=tmp)
+                                kmaps[:,i] += tmp
+                if len(self.shape)==2: kmaps = kmaps[:,0]
+                if harm:
+                    return kmaps
+                else:
+                    if scalar or len(self.shape)==2:
+                            return enmap.ifft(kmaps,nthread=nthread).real
+                    else:
+                            return enmap.harm2map(kmaps,iau=iau,nthread=nthread)
+
         
         
 def spec1d_to_2d(shape,wcs,ps):
@@ -797,31 +940,91 @@ class FourierCalc(object):
     to speed up fourier transforms and power spectra.
     """
 
-    def __init__(self,shape,wcs,iau=False):
-        """Initialize with a geometry shape and wcs."""
+    def __init__(self,shape,wcs,iau=False,nthread=0,flags=None):
+        """Initialize with a geometry shape and wcs.
+
+        nthread is the default number of FFT threads (0 uses pixell's default)
+        and flags are the planner flags for the FFT engine, e.g. ['FFTW_MEASURE'].
+        Forward FFT plans and the aligned buffers they work on are created once
+        per input shape and dtype and reused by all later transforms.
+        """
         
         self.shape = shape
         self.wcs = wcs
+        self.nthread = nthread
+        self.flags = flags
+        self._plans = {}
+        self._work = {}
         self.normfact = enmap.area(self.shape,self.wcs )/ np.prod(self.shape[-2:])**2.         
         if len(shape) > 2 and shape[-3] > 1:
             self.rot = enmap.queb_rotmat(enmap.lmap(shape,wcs),iau=iau)
 
-    def iqu2teb(self,emap, nthread=0, normalize=True, rot=True):
+    def workspace(self,name,shape,dtype=np.float64):
+        """A persistent aligned array allocated once per name, shape and dtype.
+        Its contents are overwritten by the next user of the same workspace."""
+        key = (name,tuple(shape),np.dtype(dtype).str)
+        if key not in self._work: self._work[key] = pfft.empty(tuple(shape),dtype)
+        return self._work[key]
+
+    def fft_plan(self,ishape,dtype=np.float64):
+        """Cached forward 2d FFT plan for arrays of shape ishape and the given dtype.
+        Returns (plan,ibuf,obuf); calling plan() transforms ibuf into obuf."""
+        ctype = np.result_type(dtype,0j)
+        key = (tuple(ishape),ctype.str)
+        if key not in self._plans:
+            ibuf = self.workspace('fft_in',ishape,ctype)
+            obuf = self.workspace('fft_out',ishape,ctype)
+            engine = pfft.engines[pfft.get_engine("auto")]
+            plan = engine.FFTW(ibuf,obuf,flags=self.flags or pfft.default_flags,
+                               threads=self.nthread or pfft.nthread_fft,axes=[-2,-1],direction='FFTW_FORWARD')
+            self._plans[key] = (plan,ibuf,obuf)
+        return self._plans[key]
+
+    def _pooled_fft(self,emap,nthread=0):
+        """Unnormalized FFT of emap. Unless a non-default nthread is requested,
+        the result is the pooled output buffer of the cached plan, which is
+        overwritten by the next transform of the same shape."""
+        # The intel wrapper needs its own reshaping workaround, so it isn't pooled
+        if (nthread and nthread!=self.nthread) or pfft.get_engine("auto")=='intel':
+            return enmap.fft(emap,nthread=nthread,normalize=False)
+        plan,ibuf,obuf = self.fft_plan(emap.shape,emap.dtype)
+        ibuf[...] = emap
+        plan()
+        return obuf
+
+    def iqu2teb(self,emap, nthread=0, normalize=True, rot=True, out=None):
         """Performs the 2d FFT of the enmap pixels, returning a complex enmap.
         Similar to harm2map, but uses a pre-calculated self.rot matrix.
+        If out is specified, the result is written into it.
         """
-        emap = enmap.samewcs(enmap.fft(emap,nthread=nthread,normalize=normalize), emap)
+        kmap = self._pooled_fft(emap,nthread)
+        if out is None: out = pfft.empty(kmap.shape,kmap.dtype)
+        out[...] = kmap
+        norm = 1
+        if normalize: norm /= np.prod(emap.shape[-2:])**0.5
+        if normalize in ["phy","phys","physical"]: norm *= emap.pixsize()**0.5
+        if norm != 1: out *= norm
+        emap = enmap.samewcs(out, emap)
         if emap.ndim > 2 and emap.shape[-3] > 1 and rot:
             emap[...,-2:,:,:] = enmap.map_mul(self.rot, emap[...,-2:,:,:])
 
         return emap
 
 
-    def f2power(self,kmap1,kmap2,pixel_units=False):
-        """Similar to power2d, but assumes both maps are already FFTed """
+    def f2power(self,kmap1,kmap2,pixel_units=False,out=None):
+        """Similar to power2d, but assumes both maps are already FFTed.
+        If out is specified, the result is written into it without
+        allocating temporary arrays."""
         norm = 1. if pixel_units else self.normfact
-        res = np.real(np.conjugate(kmap1)*kmap2)*norm
-        return res
+        if out is None:
+            res = np.real(np.conjugate(kmap1)*kmap2)*norm
+            return res
+        tmp = self.workspace('f2power',out.shape,out.dtype)
+        np.multiply(kmap1.real,kmap2.real,out=out)
+        np.multiply(kmap1.imag,kmap2.imag,out=tmp)
+        out += tmp
+        out *= norm
+        return out
 
     def f1power(self,map1,kmap2,pixel_units=False,nthread=0):
         """Similar to power2d, but assumes map2 is already FFTed """
@@ -833,7 +1036,7 @@ class FourierCalc(object):
         return enmap.enmap(ifft(kmap,axes=[-2,-1],normalize=True),self.wcs)
     
     def fft(self,emap):
-        return enmap.samewcs(enmap.fft(emap,normalize=False), emap)
+        return self.iqu2teb(emap,normalize=False,rot=False)
         
 
     def power2d(self,emap=None, emap2=None,nthread=0,pixel_units=False,skip_cross=False,rot=True, kmap=None, kmap2=None, dtype=None):
@@ -1037,7 +1240,51 @@ def get_lnlike(covinv,instamp):
 
 
 
-def pixcov_sim(shape,wcs,ps,Nsims,seed=None,mean_sub=True,pad=0):
+def stationary_pixcov(shape,wcs,ps,mean_sub=True,pad=0,dtype=None):
+    """
+    Exact pixel covariance of the maps that pixcov_sim draws with MapGen, built from
+    the 2D power with one inverse FFT and a gather of the lags between pixels.
+    shape is (ncomp,Ny,Nx) and ps is the MapGen input power. Maps are generated on the
+    geometry padded by pad pixels, and mean_sub removes the mean of the (padded) map
+    over all components. Returns an (ncomp*Ny*Nx,ncomp*Ny*Nx) matrix of type dtype.
+    """
+    if pad>0:
+        retmap = enmap.pad(enmap.zeros(shape,wcs), pad, return_slice=False, wrap=False)
+        oshape,owcs = retmap.shape,retmap.wcs
+    else:
+        oshape,owcs = shape,wcs
+    ncomp = oshape[0]
+    # 2D power in pixel units, as used for MapGen.covsqrt
+    if ps.ndim==4:
+        p2d = np.asarray(ps) * np.prod(oshape[-2:])/enmap.area(oshape,owcs)
+    else:
+        p2d = np.asarray(enmap.spec2flat(oshape,owcs,ps))
+    if ncomp>1:
+        # harm2map rotates E,B to Q,U
+        rot = np.zeros((ncomp,ncomp)+oshape[-2:])
+        rot[0,0] = 1
+        rot[1:3,1:3] = enmap.queb_rotmat(enmap.lmap(oshape,owcs),inverse=True)
+        p2d = np.einsum('ab...,bc...,dc...->ad...',rot,p2d,rot)
+    if mean_sub:
+        proj = np.eye(ncomp) - 1./ncomp
+        p2d = p2d.copy()
+        p2d[...,0,0] = proj @ p2d[...,0,0] @ proj.T
+    corr = np.fft.ifft2(p2d).real
+    Ny,Nx = shape[-2:]
+    dy = (np.arange(Ny)[None,:]-np.arange(Ny)[:,None]) % oshape[-2]
+    dx = (np.arange(Nx)[None,:]-np.arange(Nx)[:,None]) % oshape[-1]
+    cov = np.asarray(corr,dtype=dtype)[...,dy[:,None,:,None],dx[None,:,None,:]]
+    return cov.transpose((0,2,3,1,4,5)).reshape((ncomp*Ny*Nx,ncomp*Ny*Nx))
+
+def pixcov_sim(shape,wcs,ps,Nsims,seed=None,mean_sub=True,pad=0,exact=False,dtype=None,nbatch=1000,cache_dir=None,memory_cache=True):
+    """
+    Monte Carlo estimate of the (ncomp*Ny*Nx,ncomp*Ny*Nx) pixel covariance of maps of
+    geometry shape,wcs and power ps from Nsims simulations. If exact, the covariance
+    is instead calculated exactly with stationary_pixcov (and Nsims and seed are ignored).
+    The simulations are drawn with MapGen.get_maps in batches of nbatch, and the
+    square root of the covariance is cached as described in MapGen.
+    """
+    if exact: return stationary_pixcov(shape,wcs,ps,mean_sub=mean_sub,pad=pad,dtype=dtype)
     if pad>0:
         retmap = enmap.pad(enmap.zeros(shape,wcs), pad, return_slice=False, wrap=False)
         oshape,owcs = retmap.shape,retmap.wcs
@@ -1045,20 +1292,17 @@ def pixcov_sim(shape,wcs,ps,Nsims,seed=None,mean_sub=True,pad=0):
         oshape,owcs = shape,wcs
         
     
-    mg = MapGen(oshape,owcs,ps)
-    np.random.seed(seed)
+    mg = MapGen(oshape,owcs,ps,cache_dir=cache_dir,memory_cache=memory_cache)
     umaps = []
-    for i in range(Nsims):
-        cmb = mg.get_map()
-        if mean_sub: cmb -= cmb.mean()
+    for i,start in enumerate(range(0,Nsims,nbatch)):
+        cmbs = mg.get_maps(min(nbatch,Nsims-start),seed=None if seed is None else [seed,i])
+        if mean_sub: cmbs -= cmbs.reshape((cmbs.shape[0],-1)).mean(axis=1).reshape((-1,)+(1,)*(cmbs.ndim-1))
 
         if pad>0:
-            ocmb = enmap.extract(cmb, shape, wcs)
-        else:
-            ocmb = cmb
-        umaps.append(ocmb.ravel())
+            cmbs = enmap.extract(cmbs, shape, wcs)
+        umaps.append(np.asarray(cmbs).reshape((cmbs.shape[0],-1)))
         
-    pixcov = np.cov(np.array(umaps).T)
+    pixcov = np.cov(np.concatenate(umaps).T)
     return pixcov
 
 
@@ -1248,6 +1492,118 @@ def ilc_comb_a_b(response_a,response_b,cinv):
     return np.nan_to_num(np.einsum('l,l...->...',response_a,np.einsum('k,kl...->l...',response_b,cinv)))
 
 
+def _ilc_block_weights(cov,A,big=1e90):
+    """
+    Weights (npix,nfreq) and noise (npix,) of the ILC of the first column of the
+    responses A (nfreq,nresp), deprojecting the others, for covariances cov (npix,nfreq,nfreq).
+    Channels with a non-finite or >= big diagonal (as set by ilc_cov) are excluded.
+    """
+    npix,nfreq,_ = cov.shape
+    diag = np.diagonal(cov,axis1=1,axis2=2)
+    keep = np.isfinite(diag) & (np.abs(diag)<big)
+    cov = np.where(keep[:,:,None] & keep[:,None,:],np.nan_to_num(cov),0.)
+    cov[:,np.arange(nfreq),np.arange(nfreq)] += ~keep
+    Ak = A[None] * keep[:,:,None]
+    try:
+        X = np.linalg.solve(cov,Ak)
+    except np.linalg.LinAlgError:
+        X = np.einsum('pij,pjb->pib',np.linalg.pinv(cov,hermitian=True),Ak)
+    G = np.einsum('pfa,pfb->pab',Ak,X)
+    y = np.linalg.pinv(G,hermitian=True)[...,0]
+    return np.einsum('pfa,pa->pf',X,y),y[:,0]
+
+def ilc_weights(cov,response_a=None,response_b=None,hermitian=True,nblock=2**16):
+    """
+    Per-pixel ILC weights from a covariance, solving C x = response for the weights with
+    batched linear solves instead of inverting C (compare silc/cilc, which need Cinv).
+
+    Accepts
+    -------
+
+    cov -- (nfreq,nfreq,...) array of the covariance (e.g. from ilc_cov or ilc_empirical_cov)
+    response_a -- (nfreq,) array of f_nu response factors for the component of interest. Defaults to unity for CMB.
+    response_b -- (nfreq,) or (nfreq,ndeproj) array of f_nu response factors of components to project out.
+    hermitian -- if cov is (nfreq,nfreq,Ny,Nx) in numpy FFT order and symmetric under k -> -k
+                 (as the covariance of real maps is), only half of the Fourier plane is solved for.
+    nblock -- number of pixels solved for at a time, which bounds the temporary memory.
+
+    Returns
+    -------
+
+    weights -- (nfreq,...) array of weights, such that the ILC is (weights*kmaps).sum(axis=0)
+    noise -- (...) array of the ILC variance
+    """
+    nfreq = cov.shape[0]
+    pshape = cov.shape[2:]
+    response_a = ilc_def_response(response_a,cov)
+    A = np.asarray(response_a,dtype=np.float64).reshape((nfreq,1))
+    if response_b is not None: A = np.concatenate([A,np.asarray(response_b,dtype=np.float64).reshape((nfreq,-1))],axis=1)
+    half = hermitian and len(pshape)==2
+    if half:
+        Ny,Nx = pshape
+        nxh = Nx//2+1
+        cov = cov[...,:nxh]
+    cflat = cov.reshape((nfreq,nfreq,-1))
+    npix = cflat.shape[-1]
+    weights = np.zeros((nfreq,npix))
+    noise = np.zeros(npix)
+    for i in range(0,npix,nblock):
+        sel = slice(i,i+nblock)
+        w,noise[sel] = _ilc_block_weights(np.moveaxis(cflat[...,sel],-1,0),A)
+        weights[:,sel] = w.T
+    if half:
+        weights = weights.reshape((nfreq,Ny,nxh))
+        noise = noise.reshape((Ny,nxh))
+        # Fill the other half using w(-k) = w(k)
+        iy = (-np.arange(Ny)) % Ny
+        ix = Nx - np.arange(nxh,Nx)
+        weights = np.concatenate([weights,weights[:,iy][...,ix]],axis=-1)
+        noise = np.concatenate([noise,noise[iy][:,ix]],axis=-1)
+    return weights.reshape((nfreq,)+pshape),noise.reshape(pshape)
+
+def ilc_weights_to_2d(ells,weights,modlmap):
+    """Map (nfreq,...,nells) weights (or (nells,) noise) defined at multipoles ells
+    to 2D by linear interpolation on modlmap. Outside the range of ells, the values at
+    the nearest end are used, with a warning if modlmap extends beyond max(ells)
+    (e.g. the modes between the last bin center and the corner of Fourier space)."""
+    weights = np.asarray(weights)
+    if np.max(modlmap)>np.max(ells):
+        warnings.warn(f"ilc_weights_to_2d: extrapolating weights from l={np.max(ells):.1f} up to l={np.max(modlmap):.1f} with their last values.")
+    flat = weights.reshape((-1,weights.shape[-1]))
+    out = np.array([np.interp(modlmap,ells,w) for w in flat])
+    return out.reshape(weights.shape[:-1]+modlmap.shape)
+
+def ilc(kmaps,cov,response_a=None,response_b=None,hermitian=True,nblock=2**16,ells=None,modlmap=None):
+    """Standard (response_b None) or constrained ILC of the (nfreq,Ny,Nx) fourier space maps kmaps
+    from their covariance cov, using ilc_weights. Returns the ILC fourier space map and its variance.
+    If the covariance is isotropic, it can be provided as (nfreq,nfreq,nells) at multipoles ells
+    (e.g. from ilc_cov with 1D inputs or ilc_empirical_cov_1d). The weights
+    are then solved for in 1D and mapped to the modlmap of kmaps with ilc_weights_to_2d."""
+    if cov.ndim==3:
+        if ells is None: raise ValueError("ells must be specified for a 1D covariance.")
+        modlmap = enmap.modlmap(kmaps.shape,kmaps.wcs) if modlmap is None else modlmap
+        weights,noise = ilc_weights(cov,response_a,response_b,nblock=nblock)
+        weights = ilc_weights_to_2d(ells,weights,modlmap)
+        noise = ilc_weights_to_2d(ells,noise,modlmap)
+    else:
+        weights,noise = ilc_weights(cov,response_a,response_b,hermitian=hermitian,nblock=nblock)
+    return np.einsum('k...,k...->...',weights,kmaps),noise
+
+def ilc_empirical_cov_1d(kmaps,bin_edges):
+    """
+    Binned empirical covariance of (ncomp,Ny,Nx) fourier space maps. Returns the bin
+    centers and the (ncomp,ncomp,nbins) covariance (including the diagonal), for use
+    with ilc(...,ells=cents) without going back to 2D.
+    """
+    assert kmaps.ndim==3
+    ncomp = kmaps.shape[0]
+    binner = stats.bin2D(enmap.modlmap(kmaps[0].shape,kmaps.wcs),bin_edges)
+    cov = np.zeros((ncomp,ncomp,binner.centers.size))
+    for i in range(ncomp):
+        cents,cov[i,i:] = binner.bin(np.real(kmaps[i]*kmaps[i:].conj()))
+        cov[i:,i] = cov[i,i:]
+    return cents,cov
+
 def ilc_empirical_cov(kmaps,bin_edges=None,ndown=16,order=1,fftshift=True,method="isotropic"):
     assert method in ['isotropic','downsample']
     
@@ -1379,6 +1735,19 @@ def minimum_ell(shape,wcs):
 def resolution(shape,wcs):
     return np.abs(wcs.wcs.cdelt[1])*utils.degree
 
+def get_ft_attributes(shape,wcs):
+    """
+    Fourier-space coordinates of a geometry, consistent with enmap.fft.
+    Returns lxMap,lyMap,modLMap,thetaMap,lx,ly where thetaMap is the
+    angle of each wavevector in radians and lx,ly are the 1D axes.
+    """
+    shape = shape[-2:]
+    ly,lx = enmap.laxes(shape,wcs)
+    lyMap,lxMap = enmap.lmap(shape,wcs)
+    modLMap = enmap.modlmap(shape,wcs)
+    thetaMap = np.arctan2(lyMap,lxMap)
+    return lxMap,lyMap,modLMap,thetaMap,lx,ly
+
 
 def inpaint_cg(imap,rand_map,mask,power2d,eps=1.e-8):
 
@@ -1502,27 +1871,31 @@ def split_calc(isplits,jsplits,icoadd,jcoadd,fourier_calc=None,alt=True):
     """
     shape,wcs = isplits.shape,isplits.wcs
     assert isplits.ndim==3
-    fc = fourier_calc if fourier_calc is not None else maps.FourierCalc(shape[-2:],wcs)
+    fc = fourier_calc if fourier_calc is not None else FourierCalc(shape[-2:],wcs)
     total = fc.f2power(icoadd,jcoadd)
     insplits = isplits.shape[0]
     jnsplits = jsplits.shape[0] 
+    # Per-split temporaries live in the FourierCalc workspace
+    pwork = fc.workspace('split_power',total.shape,total.dtype)
 
     if alt:
         assert insplits==jnsplits
-        noise = 0.
+        noise = np.zeros(total.shape,total.dtype)
+        diff1 = fc.workspace('split_diff1',icoadd.shape,np.result_type(isplits,icoadd))
+        diff2 = fc.workspace('split_diff2',jcoadd.shape,np.result_type(jsplits,jcoadd))
         for i in range(insplits):
-            diff1 = isplits[i] - icoadd
-            diff2 = jsplits[i] - jcoadd
-            noise = noise + fc.f2power(diff1,diff2)
+            np.subtract(isplits[i],icoadd,out=diff1)
+            np.subtract(jsplits[i],jcoadd,out=diff2)
+            noise += fc.f2power(diff1,diff2,out=pwork)
         noise = noise / ((1.-1./insplits)*insplits**2)
         crosses = total - noise
     else:
         ncrosses = 0.
-        totcross = 0.
+        totcross = np.zeros(total.shape,total.dtype)
         for i in range(insplits):
             for j in range(jnsplits):
                 if i==j: continue # FIXME: REALLY?! What about for independent experiments?
-                totcross += fc.f2power(isplits[i],jsplits[j])
+                totcross += fc.f2power(isplits[i],jsplits[j],out=pwork)
                 ncrosses += 1.
         crosses = totcross / ncrosses
         noise = total - crosses
@@ -1565,38 +1938,48 @@ def noise_from_splits(splits,fourier_calc=None,nthread=0,do_cross=True):
     if do_cross: assert ncomp==3 or ncomp==1
 
 
-    # Get fourier transforms of I,Q,U
-    ksplits = [fourier_calc.iqu2teb(split, nthread=nthread, normalize=False, rot=False) for split in splits]
+    # Get fourier transforms of I,Q,U of all splits in one call. This is the
+    # pooled buffer of fourier_calc, so it is only valid until its next transform.
+    ksplits = fourier_calc._pooled_fft(splits,nthread)
     del splits
     
     if do_cross:
-        kteb_splits = []
         # Rotate I,Q,U to T,E,B for cross power (not necssary for noise)
-        for ksplit in ksplits:
-            kteb_splits.append( ksplit.copy())
-            if (ndim==3 and ncomp==3):
-                kteb_splits[-1][...,-2:,:,:] = enmap.map_mul(fourier_calc.rot, kteb_splits[-1][...,-2:,:,:])
-            
+        kteb_splits = fourier_calc.workspace('kteb_splits',ksplits.shape,ksplits.dtype)
+        kteb_splits[...] = ksplits
+        if (ndim==3 and ncomp==3):
+            kteb_splits[...,-2:,:,:] = enmap.map_mul(fourier_calc.rot, kteb_splits[...,-2:,:,:])
+
+    # Accumulate the same (ncomp,ncomp,Ny,Nx) (or (Ny,Nx) if ncomp==1) spectra
+    # as power2d, writing each pair into a reusable workspace
+    pshape = ksplits.shape[-2:]
+    pwork = fourier_calc.workspace('noise_power',pshape,np.float64)
+    def _power_sum(kmaps1,kmaps2,pairs):
+        ret = np.zeros((ncomp,ncomp)+pshape) if ncomp>1 else np.zeros(pshape)
+        for s1,s2 in pairs:
+            if ncomp==1:
+                ret += fourier_calc.f2power(kmaps1[s1,0],kmaps2[s2,0],out=pwork)
+                continue
+            for i in range(ncomp):
+                for j in range(i,ncomp):
+                    fourier_calc.f2power(kmaps1[s1,i],kmaps2[s2,j],out=pwork)
+                    ret[i,j] += pwork
+                    if j>i: ret[j,i] += pwork
+        return enmap.enmap(ret,wcs)
+    cross_pairs = [(i,j) for i in range(Nsplits) for j in range(i+1,Nsplits)]
+
     # get auto power of I,Q,U
-    auto = 0.
-    for ksplit in ksplits:
-        auto += fourier_calc.power2d(kmap=ksplit)[0]
+    auto = _power_sum(ksplits,ksplits,[(i,i) for i in range(Nsplits)])
     auto /= Nsplits
 
     # do cross powers of I,Q,U
     Ncrosses = (Nsplits*(Nsplits-1)/2)
-    cross = 0.
-    for i in range(len(ksplits)):
-        for j in range(i+1,len(ksplits)):
-            cross += fourier_calc.power2d(kmap=ksplits[i],kmap2=ksplits[j])[0]
+    cross = _power_sum(ksplits,ksplits,cross_pairs)
     cross /= Ncrosses
         
     if do_cross:
         # do cross powers of T,E,B
-        cross_teb = 0.
-        for i in range(len(ksplits)):
-            for j in range(i+1,len(ksplits)):
-                cross_teb += fourier_calc.power2d(kmap=kteb_splits[i],kmap2=kteb_splits[j])[0]
+        cross_teb = _power_sum(kteb_splits,kteb_splits,cross_pairs)
         cross_teb /= Ncrosses
     else:
         cross_teb = None
@@ -1710,22 +2093,160 @@ def flux(thumbs,aperture_radius,annulus_width=None,modrmap=None,pixsizemap=None)
         Defaults to sqrt(2)-1 times the aperture inner radius.
     modrmap : ndmap, optional
         An (Ny,Nx) ndmap containing distances of each pixel from the center in radians.
-    modrmap : ndmap, optional
-        An (Ny,Nx) ndmap containing pixel areas in steradians.
+        Can also be any array that broadcasts against thumbs, e.g. one per thumbnail.
+    pixsizemap : ndmap, optional
+        An (Ny,Nx) ndmap containing pixel areas in steradians, broadcastable like modrmap.
 
     Returns
     -------
     flux : ndarray
-        (...,) array of aperture photometry fluxes.
+        (...,) array of aperture photometry fluxes. The background of each
+        thumbnail is the mean of its own annulus.
 
     """
     if modrmap is None: modrmap = thumbs.modrmap()
     if annulus_width is None: annulus_width = (np.sqrt(2.)-1.) * aperture_radius
     # Get the mean background level from the annulus
-    mean = thumbs[...,np.logical_and(modrmap>aperture_radius,modrmap<(aperture_radius+annulus_width))].mean()
+    annulus = np.logical_and(modrmap>aperture_radius,modrmap<(aperture_radius+annulus_width))
+    mean = (thumbs*annulus).sum(axis=(-2,-1),keepdims=True) / annulus.sum(axis=(-2,-1),keepdims=True)
     if pixsizemap is None: pixsizemap = thumbs.pixsizemap()
     # Subtract the mean, multiply by pixel areas and sum
-    return (((thumbs-mean)*pixsizemap)[...,modrmap<=aperture_radius]).sum(axis=-1)
+    return np.asarray(((thumbs-mean)*pixsizemap*(modrmap<=aperture_radius)).sum(axis=(-2,-1)))
+
+
+def catalog_stamps(imap,decs,ras,npix,wrap="auto"):
+    """
+    Extract (2*npix+1,2*npix+1) pixel stamps of imap centered on the pixels nearest
+    to decs,ras (in degrees) with one vectorized gather (no reprojection).
+
+    Returns stamps, used where stamps is a (nused,...,2*npix+1,2*npix+1) array
+    and used is a boolean array selecting the objects whose stamps lie fully
+    inside the map (after wrapping in RA if the map covers the full circle
+    and wrap is "auto" or True).
+    """
+    Ny,Nx = imap.shape[-2:]
+    iy,ix = utils.nint(enmap.sky2pix(imap.shape,imap.wcs,np.array([decs,ras])*utils.degree))
+    if wrap=="auto": wrap = utils.nint(360./np.abs(imap.wcs.wcs.cdelt[0]))==Nx
+    d = np.arange(-npix,npix+1)
+    Y = iy[:,None] + d
+    X = ix[:,None] + d
+    if wrap: X = X % Nx
+    used = np.all((Y>=0)&(Y<Ny),axis=1) & np.all((X>=0)&(X<Nx),axis=1)
+    Y = Y[used]
+    X = X[used]
+    stamps = np.asarray(imap)[...,Y[:,:,None],X[:,None,:]]
+    return np.moveaxis(stamps,-3,0),used
+
+
+def stack_catalog(imap,ras,decs,npix,weights=None,aperture_radius=None,annulus_width=None,
+                  error=None,nsamples=100,groups=None,chunk_size=10000,seed=None,wrap="auto",
+                  mstats=None,label="stack"):
+    """
+    Weighted stack of imap on a catalog of objects in a single pass over chunks
+    of objects, with optional jackknife or bootstrap errors and per-object
+    aperture photometry fluxes. Memory is bounded by chunk_size stamps.
+
+    Parameters
+    ----------
+    imap : ndmap
+        An (...,Ny,Nx) ndmap to stack.
+    ras, decs : array_like
+        (nobj,) object coordinates in degrees.
+    npix : int
+        Stamps are (2*npix+1,2*npix+1) pixels centered on the pixel nearest each object.
+        Objects whose stamps leave the map are dropped (see catalog_stamps).
+    weights : array_like, optional
+        (nobj,) object weights. Defaults to uniform weights.
+    aperture_radius, annulus_width : float, optional
+        If aperture_radius is specified, the fluxes of each object are calculated
+        with flux, with distances and pixel areas evaluated at the declination of the object.
+    error : string, optional
+        "jackknife" for a delete-one-group jackknife over nsamples groups (groups[nobj]
+        can be specified, e.g. for spatial regions; by default objects are assigned
+        cyclically), or "bootstrap" for nsamples Poisson bootstrap resamples.
+    seed : int, optional
+        Seed for the bootstrap resamples.
+    mstats : orphics.stats.Stats, optional
+        If specified, the weighted sum and total weight are added to the stacks
+        f"{label}_sum" and f"{label}_weights" with add_to_stack, so that the stack
+        over all MPI cores is mstats.stacks[f"{label}_sum"]/mstats.stacks[f"{label}_weights"]
+        after mstats.get_stacks().
+
+    Returns
+    -------
+    result : dict
+        'stack': (...,2*npix+1,2*npix+1) ndmap of the weighted mean stamp,
+        'error': its jackknife or bootstrap standard deviation (if error is not None),
+        'weights': the total weight, 'nobj': the number of objects stacked,
+        'used': (nobj,) boolean array of stacked objects,
+        'fluxes': (nused,...) aperture fluxes (if aperture_radius is not None).
+    """
+    ras = np.asarray(ras)
+    decs = np.asarray(decs)
+    nobj = ras.size
+    weights = np.ones(nobj) if weights is None else np.asarray(weights,dtype=np.float64)
+    if error=="jackknife":
+        groups = np.arange(nobj) % nsamples if groups is None else np.asarray(groups)
+        ngroups = groups.max()+1
+    elif error=="bootstrap":
+        rng = np.random.default_rng(seed)
+    elif error is not None:
+        raise ValueError(f"Unknown error type {error}")
+    n = 2*npix+1
+    oshape = imap.shape[:-2]+(n,n)
+    res = np.abs(imap.wcs.wcs.cdelt[::-1])*utils.degree
+    if aperture_radius is not None:
+        d = np.arange(-npix,npix+1)
+        dy = (d*res[0])[:,None]
+        dx = (d*res[1])[None,:]
+        plain = enmap.wcsutils.is_plain(imap.wcs)
+    bcast = (slice(None),)+(None,)*(imap.ndim-2)+(None,None)
+
+    ssum = np.zeros(oshape)
+    wsum = 0.
+    if error is not None:
+        nsets = ngroups if error=="jackknife" else nsamples
+        ssums = np.zeros((nsets,)+oshape)
+        wsums = np.zeros(nsets)
+    used = np.zeros(nobj,dtype=bool)
+    fluxes = []
+    for i in range(0,nobj,chunk_size):
+        sl = slice(i,i+chunk_size)
+        stamps,cused = catalog_stamps(imap,decs[sl],ras[sl],npix,wrap=wrap)
+        used[sl] = cused
+        if not(cused.any()): continue
+        w = weights[sl][cused]
+        flat = stamps.reshape((stamps.shape[0],-1))
+        ssum += np.dot(w,flat).reshape(oshape)
+        wsum += w.sum()
+        if error is not None:
+            if error=="jackknife":
+                wmat = np.zeros((ngroups,w.size))
+                wmat[groups[sl][cused],np.arange(w.size)] = w
+            else:
+                wmat = rng.poisson(1.,size=(nsamples,w.size)) * w
+            ssums += np.dot(wmat,flat).reshape((nsets,)+oshape)
+            wsums += wmat.sum(axis=1)
+        if aperture_radius is not None:
+            cosdec = np.ones(w.size) if plain else np.cos(decs[sl][cused]*utils.degree)
+            modrmap = np.sqrt(dy**2+(dx*cosdec[:,None,None])**2)[bcast[:-2]]
+            pixsizemap = (res[0]*res[1]*cosdec)[bcast]
+            fluxes.append(flux(stamps,aperture_radius,annulus_width,modrmap=modrmap,pixsizemap=pixsizemap))
+
+    swcs = enmap.geometry(pos=(0,0),shape=(n,n),res=res,proj='car')[1]
+    result = {'stack':enmap.enmap(ssum/wsum,swcs),'weights':wsum,'nobj':int(used.sum()),'used':used}
+    if error=="jackknife":
+        samples = (ssum-ssums)/(wsum-wsums)[bcast]
+        result['error'] = enmap.enmap(np.sqrt((ngroups-1.)/ngroups*((samples-samples.mean(axis=0))**2).sum(axis=0)),swcs)
+    elif error=="bootstrap":
+        samples = ssums/wsums[bcast]
+        result['error'] = enmap.enmap(samples.std(axis=0,ddof=1),swcs)
+    if aperture_radius is not None:
+        result['fluxes'] = np.concatenate(fluxes) if fluxes else np.zeros((0,)+imap.shape[:-2])
+    if mstats is not None:
+        mstats.add_to_stack(f"{label}_sum",ssum)
+        mstats.add_to_stack(f"{label}_weights",np.array(wsum))
+    return result
 
 
 
@@ -2019,8 +2540,8 @@ def get_grf_cmb(shape,wcs,theory,spec,seed=None):
     return get_grf_realization(shape,wcs,interp(ells,theory.gCl(spec,ells))(modlmap).reshape((1,1,Ny,Nx)),seed=None)
     
         
-def get_grf_realization(shape,wcs,power2d,seed=None):
-    mg = MapGen(shape,wcs,power2d)
+def get_grf_realization(shape,wcs,power2d,seed=None,cache_dir=None,memory_cache=False):
+    mg = MapGen(shape,wcs,power2d,cache_dir=cache_dir,memory_cache=memory_cache)
     return mg.get_map(seed=seed)
 
 
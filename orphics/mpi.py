@@ -45,6 +45,165 @@ class fakeMpiComm:
         return x
 
 
+class ProcessComm(object):
+    """
+    A communicator for processes on a single machine, for when MPI is not
+    available. Create it with ProcessComm.fork(nprocs) (or comm_world), which
+    forks the current process like mpirun would launch it, so that the rest of
+    the script runs once on each rank.
+
+    It implements the subset of the mpi4py communicator API used in orphics
+    (Get_rank, Get_size, Barrier, send/recv, Send/Recv, bcast, gather, allgather,
+    allgatherv, Allgather, Allgatherv, Gather, Gatherv, Reduce, Allreduce).
+    Numpy arrays are passed through shared memory and other objects are pickled.
+    Reductions support op=None, ProcessComm.SUM or MPI.SUM (summation), or a python function
+    op(inbuf,outbuf,datatype) that combines inbuf into outbuf in place,
+    with the same signature as the functions accepted by mpi4py's MPI.Op.Create.
+    Only available where fork is (i.e. not on Windows).
+    """
+    ANY = -1
+    SUM = 'sum'
+    def __init__(self,rank,size,queues,barrier):
+        self.rank = rank
+        self.size = size
+        self._queues = queues
+        self._barrier = barrier
+        self._pending = []
+
+    @classmethod
+    def fork(cls,nprocs=None):
+        import multiprocessing as mp
+        from multiprocessing import resource_tracker
+        import atexit
+        nprocs = os.cpu_count() if nprocs is None else nprocs
+        ctx = mp.get_context('fork')
+        queues = [ctx.Queue() for i in range(nprocs)]
+        barrier = ctx.Barrier(nprocs)
+        counter = ctx.Value('q',0)
+        # Share one tracker for the shared memory blocks of all ranks
+        resource_tracker.ensure_running()
+        sys.stdout.flush()
+        rank = 0
+        children = []
+        for i in range(1,nprocs):
+            pid = os.fork()
+            if pid==0:
+                rank = i
+                children = []
+                break
+            children.append(pid)
+        comm = cls(rank,nprocs,queues,barrier)
+        comm._counter = counter
+        if rank==0: atexit.register(comm._wait,children)
+        return comm
+
+    def _wait(self,children):
+        for pid in children: os.waitpid(pid,0)
+
+    def Get_rank(self):
+        return self.rank
+    def Get_size(self):
+        return self.size
+    def Barrier(self):
+        self._barrier.wait()
+    def fetch_and_add(self,n=1):
+        """Atomically add n to a counter shared by all ranks and return its old value."""
+        with self._counter.get_lock():
+            old = self._counter.value
+            self._counter.value += n
+        return old
+    def reset_counter(self):
+        """Collectively reset the shared counter to zero."""
+        self.Barrier()
+        if self.rank==0: self._counter.value = 0
+        self.Barrier()
+    def Abort(self,errorcode=1):
+        os._exit(errorcode)
+
+    def _post(self,dest,tag,obj):
+        if isinstance(obj,np.ndarray):
+            from multiprocessing import shared_memory
+            arr = np.ascontiguousarray(obj)
+            shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+            np.ndarray(arr.shape,arr.dtype,buffer=shm.buf)[...] = arr
+            self._queues[dest].put((self.rank,tag,'shm',(shm.name,arr.shape,arr.dtype.str)))
+            shm.close()
+        else:
+            self._queues[dest].put((self.rank,tag,'obj',obj))
+
+    def _take(self,source,tag):
+        def _match(msg): return (source in [None,self.ANY] or msg[0]==source) and (tag in [None,self.ANY] or msg[1]==tag)
+        msg = None
+        for i,m in enumerate(self._pending):
+            if _match(m):
+                msg = self._pending.pop(i)
+                break
+        while msg is None:
+            m = self._queues[self.rank].get()
+            if _match(m): msg = m
+            else: self._pending.append(m)
+        if msg[2]=='obj': return msg[3]
+        from multiprocessing import shared_memory
+        name,shape,dtype = msg[3]
+        shm = shared_memory.SharedMemory(name=name)
+        arr = np.ndarray(shape,dtype,buffer=shm.buf).copy()
+        shm.close()
+        shm.unlink()
+        return arr
+
+    def send(self,obj,dest,tag=0):
+        self._post(dest,tag,obj)
+    def recv(self,buf=None,source=ANY,tag=ANY):
+        return self._take(source,tag)
+    def Send(self,buf,dest,tag=0):
+        self._post(dest,tag,np.asarray(buf))
+    def Recv(self,buf,source=ANY,tag=ANY):
+        arr = self._take(source,tag)
+        buf[...] = arr.reshape(buf.shape)
+
+    # Collectives use negative tags so that they don't match user messages
+    def bcast(self,obj,root=0):
+        if self.rank==root:
+            for r in range(self.size):
+                if r!=root: self._post(r,-2,obj)
+            return obj
+        return self._take(root,-2)
+    def gather(self,obj,root=0):
+        if self.rank!=root:
+            self._post(root,-3,obj)
+            return None
+        return [obj if r==root else self._take(r,-3) for r in range(self.size)]
+    def allgather(self,obj):
+        return self.bcast(self.gather(obj,root=0),root=0)
+    def allgatherv(self,x):
+        return np.concatenate(self.allgather(np.asarray(x)),axis=0)
+    def Allgather(self,sendbuf,recvbuf):
+        recvbuf[...] = np.asarray(self.allgather(np.asarray(sendbuf))).reshape(recvbuf.shape)
+    def Allgatherv(self,sendbuf,recvspec):
+        # recvspec is (recvbuf,(counts,offsets)) or [recvbuf,counts]
+        recvbuf = recvspec[0]
+        recvbuf.reshape(-1)[:] = np.concatenate([a.reshape(-1) for a in self.allgather(np.asarray(sendbuf))])
+    def Gather(self,sendbuf,recvbuf,root=0):
+        arrs = self.gather(np.asarray(sendbuf),root=root)
+        if arrs is not None: recvbuf[...] = np.asarray(arrs).reshape(recvbuf.shape)
+    def Gatherv(self,sendbuf,recvspec,root=0):
+        arrs = self.gather(np.asarray(sendbuf),root=root)
+        if arrs is not None: recvspec[0].reshape(-1)[:] = np.concatenate([a.reshape(-1) for a in arrs])
+    def Reduce(self,sendbuf,recvbuf,op=None,root=0):
+        arrs = self.gather(np.asarray(sendbuf),root=root)
+        if arrs is None: return
+        res = arrs[root].copy()
+        for r in range(self.size):
+            if r==root: continue
+            if op is None or op is self.SUM or op is getattr(MPI,'SUM',None):
+                res += arrs[r]
+            else:
+                op(arrs[r],res,None)
+        recvbuf[...] = res.reshape(recvbuf.shape)
+    def Allreduce(self,sendbuf,recvbuf,op=None):
+        res = np.empty_like(np.asarray(sendbuf))
+        self.Reduce(sendbuf,res,op=op,root=0)
+        recvbuf[...] = self.bcast(res if self.rank==0 else None,root=0)
 
 
 try:
@@ -61,6 +220,27 @@ except:
     MPI.COMM_WORLD = fakeMpiComm()
     
 
+_local_comm = None
+
+def comm_world(nlocal=None):
+    """
+    MPI.COMM_WORLD if mpi4py is available. Otherwise, a ProcessComm forked over
+    nlocal processes (by default the ORPHICS_LOCAL_PROCS environment variable),
+    or the fakeMpiComm for a single process. The fork happens on the first call
+    only, so call this near the start of a script, before any expensive work.
+    """
+    global _local_comm
+    if not(isinstance(MPI.COMM_WORLD,fakeMpiComm)): return MPI.COMM_WORLD
+    if _local_comm is None:
+        if nlocal is None:
+            try:
+                nlocal = int(os.environ['ORPHICS_LOCAL_PROCS'])
+            except (KeyError,ValueError):
+                nlocal = 1
+        _local_comm = ProcessComm.fork(nlocal) if nlocal>1 else MPI.COMM_WORLD
+    return _local_comm
+    
+
 def mpi_distribute(num_tasks,avail_cores,allow_empty=False):
     # copied to mapsims.convert_noise_templates
     if not(allow_empty): assert avail_cores<=num_tasks
@@ -78,8 +258,12 @@ def mpi_distribute(num_tasks,avail_cores,allow_empty=False):
     
 
 
-def distribute(njobs,verbose=True,**kwargs):
-    comm = MPI.COMM_WORLD
+def distribute(njobs,verbose=True,comm=None,**kwargs):
+    """
+    Split njobs tasks evenly over the cores of comm (by default comm_world()).
+    Returns comm,rank,my_tasks.
+    """
+    comm = comm_world() if comm is None else comm
     rank = comm.Get_rank()
     numcores = comm.Get_size()
     num_each,each_tasks = mpi_distribute(njobs,numcores,**kwargs)
@@ -88,6 +272,75 @@ def distribute(njobs,verbose=True,**kwargs):
     return comm,rank,my_tasks
 
 
+class DynamicTasks(object):
+    """
+    An iterator over task indices 0..njobs-1 that are handed out on demand,
+    so that cores that finish early keep pulling tasks until none are left.
+    The next free task is held in a shared counter on rank 0 that is
+    incremented atomically with MPI one-sided communication (no master
+    core is needed). A ProcessComm uses its own shared counter instead, and
+    a single core or fakeMpiComm falls back to a plain loop.
+
+    The time spent on each task (between it being handed out and the next
+    request) is recorded in self.timings and printed if verbose.
+    The counter is freed collectively once the tasks run out, so every core
+    must iterate until the end.
+    """
+    def __init__(self,njobs,comm,verbose=False):
+        self.njobs = njobs
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.verbose = verbose
+        self.timings = {}
+        self._next = 0
+        self.win = None
+        self.local = isinstance(comm,ProcessComm)
+        if self.local:
+            comm.reset_counter()
+        elif comm.Get_size()>1:
+            self._counter = np.zeros(1,dtype=np.int64)
+            self.win = MPI.Win.Create(self._counter if self.rank==0 else None,disp_unit=self._counter.itemsize,comm=comm)
+
+    def _fetch(self):
+        if self.local: return self.comm.fetch_and_add(1)
+        if self.win is None:
+            task = self._next
+            self._next += 1
+            return task
+        one = np.ones(1,dtype=np.int64)
+        task = np.zeros(1,dtype=np.int64)
+        self.win.Lock(0,MPI.LOCK_SHARED)
+        self.win.Fetch_and_op(one,task,0,0,MPI.SUM)
+        self.win.Unlock(0)
+        return int(task[0])
+
+    def __iter__(self):
+        while True:
+            task = self._fetch()
+            if task>=self.njobs: break
+            t0 = time.time()
+            yield task
+            self.timings[task] = time.time()-t0
+            if self.verbose: print(f"Rank {self.rank} finished task {task} in {self.timings[task]:.2f} s")
+        if self.win is not None:
+            self.win.Free()
+            self.win = None
+
+
+def distribute_dynamic(njobs,verbose=False,comm=None):
+    """
+    Same call pattern as distribute, but my_tasks is a DynamicTasks iterator
+    that hands out tasks on demand, for tasks with very uneven costs.
+    comm defaults to comm_world().
+    """
+    comm = comm_world() if comm is None else comm
+    rank = comm.Get_rank()
+    numcores = comm.Get_size()
+    if rank==0 and verbose: print (njobs, " tasks distributed dynamically over ", numcores , " cores...")
+    my_tasks = DynamicTasks(njobs,comm,verbose=verbose)
+    return comm,rank,my_tasks
+
+
 class MPIDict(object):
 
     def __init__(self,init_dict,comm):
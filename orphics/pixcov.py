@@ -1,7 +1,6 @@
 from __future__ import print_function
 import numpy as np
 from pixell import enmap,utils
-from enlib import bench
 import os,sys
 from time import time
 
@@ -23,20 +22,18 @@ def corrfun_thumb(corr, ny, nx=None):
     tmp = np.roll(np.roll(corr, nx, -1)[...,:2*nx], ny, -2)[...,:2*ny,:]
     return np.roll(np.roll(tmp, -nx, -1), -ny, -2)
 
-def corr_to_mat(corr, ny,nx=None):
+def corr_to_mat(corr, ny,nx=None,dtype=None):
+    """(...,ny,nx,ny,nx) covariance res[...,i,j,k,l] = corr[...,(k-i)%Ly,(l-j)%Lx] of a stationary
+    field with periodic (...,Ly,Lx) correlation function corr, gathered in one indexing operation."""
     if nx is None: nx = ny
-    res = enmap.zeros([ny,nx,ny,nx],dtype=corr.dtype)
-    for i in range(ny):
-        tmp = np.roll(corr, i, 0)[:ny,:]
-        for j in range(nx):
-            res[i,j] = np.roll(tmp, j, 1)[:,:nx]
-    return res
-def ps2d_to_mat(ps2d, ny,nx):
+    dy = (np.arange(ny)[None,:]-np.arange(ny)[:,None]) % corr.shape[-2]
+    dx = (np.arange(nx)[None,:]-np.arange(nx)[:,None]) % corr.shape[-1]
+    corr = np.asarray(corr,dtype=dtype)
+    return enmap.enmap(corr[...,dy[:,None,:,None],dx[None,:,None,:]],copy=False)
+def ps2d_to_mat(ps2d, ny,nx=None,dtype=None):
     if nx is None: nx = ny
     corrfun = map_ifft(ps2d+0j)/(ps2d.shape[-2]*ps2d.shape[-1])**0.5
-    thumb   = corrfun_thumb(corrfun, ny, nx)
-    mat     = corr_to_mat(thumb, ny, nx)
-    return mat
+    return corr_to_mat(corrfun, ny, nx, dtype=dtype)
 
 ###########
 
@@ -85,18 +82,19 @@ def stamp_pixcov_from_theory(cmb2d_TEB,n2d_IQU=0.,beam2d=1.,iau=False,return_pow
     if not(return_pow): return fcov_to_rcorr(shape,wcs,p2d,Ny,Nx)
     return fcov_to_rcorr(shape,wcs,p2d,Ny,Nx), cmb2d
 
-def fcov_to_rcorr(shape,wcs,p2d,Ny,Nx=None):
-    """Convert a 2D PS into a pix-pix covariance
+def fcov_to_rcorr(shape,wcs,p2d,Ny,Nx=None,dtype=None):
+    """Convert a 2D PS into a pix-pix covariance (optionally of type dtype, e.g. np.float32)
     """
     if Nx is None: Nx = Ny
     ncomp = p2d.shape[0]
-    p2d *= np.prod(shape[-2:])/enmap.area(shape,wcs)
-    ocorr = enmap.zeros((ncomp,ncomp,Ny*Nx,Ny*Nx),wcs)
-    for i in range(ncomp):
-        for j in range(i,ncomp):
-            dcorr = ps2d_to_mat(p2d[i,j].copy(), Ny,Nx).reshape((Ny*Nx,Ny*Nx))
-            ocorr[i,j] = dcorr.copy()
-            if i!=j: ocorr[j,i] = dcorr.copy()
+    iu,ju = np.triu_indices(ncomp)
+    p2d = p2d[iu,ju] * (np.prod(shape[-2:])/enmap.area(shape,wcs))
+    # All the upper-triangle correlation functions in one batched FFT
+    corrfun = map_ifft(p2d+0j)/(p2d.shape[-2]*p2d.shape[-1])**0.5
+    dcorr = corr_to_mat(corrfun, Ny, Nx, dtype=dtype).reshape((iu.size,Ny*Nx,Ny*Nx))
+    ocorr = enmap.zeros((ncomp,ncomp,Ny*Nx,Ny*Nx),wcs,dtype=dcorr.dtype)
+    ocorr[iu,ju] = dcorr
+    ocorr[ju,iu] = dcorr
     return ocorr
 
 
@@ -459,14 +457,16 @@ def cinv_inpaint(imap,
                  mask=None,lpower_total=None,lpower_cmb=None,
                  beam_fn=None,ivar=None,
                  geometry=None,
-                 add_noise=True):
+                 add_noise=True,seed=None):
     """
     Inpaint a small map. You can specify a pre-calculated
     geometry object, or you can specify a mask
     and power specification. The power can be
     the total power in harmonic space lpower_total
     or the CMB power, beam and inverse variance
-    pixel maps.
+    pixel maps. If seed is specified, the random
+    realization is drawn from np.random.default_rng(seed)
+    instead of the global numpy random state.
     """
 
     if geometry is None:
@@ -487,14 +487,13 @@ def cinv_inpaint(imap,
     # Get the mean infill
     sim = np.dot(mean_mul,cstamp[m2])
     if add_noise:
-        # Get a random realization (this could be moved outside the loop)
-        r = np.random.normal(0.,1.,size=(m1.size))
+        # Get a random realization
+        r = np.random.normal(0.,1.,size=(m1.size)) if seed is None else np.random.default_rng(seed).standard_normal(m1.size)
         rand = np.dot(cov_root,r)
         sim = sim + rand
 
     # Paste into returned map
-    rstamp = paste(stamp,m1,sim)
-    stamp[:,:,:] = rstamp[:,:,:]
+    return paste(imap,m1,sim)
 
 
 def get_regions(ncomp,modrmap,hole_radius):
@@ -506,10 +505,195 @@ def get_regions(ncomp,modrmap,hole_radius):
     return m1,m2
     
 
+def constrained_realization_matrices(pcov,m1,m2,ncomp,deproject=True):
+    """
+    Get the matrices for the maxlike infill of the pixels m1 given the pixels m2
+    (Eq 3 of arXiv:1109.0286) for a pixel covariance pcov of shape (ncomp*npix,ncomp*npix)
+    in vector(I,Q,U) order, optionally deprojecting a common mode in each component.
+
+    This is equivalent to inverting pcov and using the Woodbury identity as in make_geometry,
+    but only needs a Cholesky factorization of the context block of pcov.
+    The infill is mean_mul . x[m2] + cov_root . r for unit normal r.
+
+    Returns mean_mul, cov_root, where cov_root is a Cholesky factor of the infill covariance
+    (or its symmetric square root if that is not positive definite).
+    """
+    from scipy.linalg import cho_factor,cho_solve
+    n1 = m1.size
+    c11 = pcov[np.ix_(m1,m1)]
+    c21 = pcov[np.ix_(m2,m1)]
+    cf = cho_factor(pcov[np.ix_(m2,m2)],lower=True,check_finite=False)
+    if deproject:
+        # Marginalize over the amplitude of a constant offset in each component
+        npix = pcov.shape[0]//ncomp
+        u = np.zeros((ncomp*npix,ncomp))
+        for i in range(ncomp):
+            u[i*npix:(i+1)*npix,i] = 1
+        z = cho_solve(cf,np.concatenate([c21,u[m2]],axis=1),check_finite=False)
+        k = z[:,:n1].T
+        cu = z[:,n1:]
+        mf = cho_factor(np.dot(u[m2].T,cu))
+        d = u[m1] - np.dot(k,u[m2])
+        mean_mul = k + np.dot(d,cho_solve(mf,cu.T))
+        cov = c11 - np.dot(k,c21) + np.dot(d,cho_solve(mf,d.T))
+    else:
+        k = cho_solve(cf,c21,check_finite=False).T
+        mean_mul = k
+        cov = c11 - np.dot(k,c21)
+    cov = (cov + cov.T)/2.
+    try:
+        cov_root = np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        cov_root = utils.eigpow(cov,0.5)
+    return mean_mul,cov_root
+
+def _quantize(arr,rtol):
+    # Integer labels of arr in steps of rtol times its maximum absolute value
+    arr = np.asarray(arr,dtype=np.float64)
+    scale = np.abs(arr).max()
+    if scale==0: return np.zeros(arr.shape,dtype=np.int64)
+    return np.round(arr/(rtol*scale)).astype(np.int64)
+
+def _stamp_key(rtol,*arrs):
+    # Floating point arrays are quantized with rtol (if specified), all others are hashed exactly
+    from . import io
+    arrs = [np.asarray(arr) for arr in arrs]
+    return io.array_key(*[_quantize(arr,rtol) if (rtol is not None and np.issubdtype(arr.dtype,np.floating)) else arr for arr in arrs])
+
+# Packed geometry archive: one raw file of 8-byte words with, for each source,
+# m1 and m2 (int64) followed by meanmul and covsqrt (float64), plus an index
+GEOMETRY_ARCHIVE = 'source_inpaint_geometries.bin'
+GEOMETRY_INDEX = 'source_inpaint_geometries_index.npy'
+_index_cols = ['task','Ny','Nx','n1','n2','offset','size']
+
+def _geometry_words(geometry):
+    words = [np.asarray(geometry['m1'],dtype=np.int64).view(np.float64),
+             np.asarray(geometry['m2'],dtype=np.int64).view(np.float64),
+             np.asarray(geometry['meanmul'],dtype=np.float64).reshape(-1),
+             np.asarray(geometry['covsqrt'],dtype=np.float64).reshape(-1)]
+    return np.concatenate(words)
+
+class GeometryArchive(object):
+    """
+    Memory-mapped reader for the single-file geometry archive written by
+    inpaint_uncorrelated_save_geometries (with packed=True). archive[task] is
+    a dictionary with keys 'covsqrt', 'meanmul', 'shape', 'm1', 'm2' like
+    the ones returned by preload_geometries, whose arrays are read-only views
+    into the memory map. Only one file is opened for all sources.
+    """
+    def __init__(self,output_dir):
+        self.output_dir = output_dir
+        self.index = np.load(f'{output_dir}/{GEOMETRY_INDEX}')
+        self.rows = {int(task):i for i,task in enumerate(self.index[:,0])}
+        fname = f'{output_dir}/{GEOMETRY_ARCHIVE}'
+        self.data = np.memmap(fname,dtype=np.float64,mode='r') if os.path.getsize(fname)>0 else np.zeros(0)
+
+    @staticmethod
+    def exists(output_dir):
+        return os.path.isfile(f'{output_dir}/{GEOMETRY_INDEX}')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self,task):
+        return int(task) in self.rows
+
+    def keys(self):
+        return self.rows.keys()
+
+    def __getitem__(self,task):
+        task,Ny,Nx,n1,n2,offset,size = self.index[self.rows[int(task)]]
+        words = self.data[offset:offset+size]
+        geometry = {}
+        geometry['shape'] = np.asarray((Ny,Nx))
+        geometry['m1'] = words[:n1].view(np.int64)
+        geometry['m2'] = words[n1:n1+n2].view(np.int64)
+        geometry['meanmul'] = words[n1+n2:n1+n2+n1*n2].reshape((n1,n2))
+        geometry['covsqrt'] = words[n1+n2+n1*n2:].reshape((n1,n1))
+        return geometry
+
+
+class GeometryCache(object):
+    """
+    Loads saved geometries (from a packed archive or per-source files) on demand,
+    keeping the most recently used ones in memory up to a budget of max_bytes and
+    evicting the least recently used ones beyond that. If float32 is True, covsqrt
+    and meanmul are kept in single precision, halving the memory they need.
+    cache[task] is a dictionary with keys 'covsqrt', 'meanmul', 'shape', 'm1', 'm2'.
+    """
+    def __init__(self,output_dir,max_bytes=2**30,float32=False):
+        from collections import OrderedDict
+        import threading
+        self.output_dir = output_dir
+        self.max_bytes = max_bytes
+        self.float32 = float32
+        self.archive = GeometryArchive(output_dir) if GeometryArchive.exists(output_dir) else None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self,task):
+        if self.archive is not None:
+            geometry = self.archive[task]
+        else:
+            import h5py
+            with h5py.File(f'{self.output_dir}/source_inpaint_geometry_{task}.hdf','r') as f:
+                geometry = {key:f[key][:] for key in ['covsqrt','meanmul','shape','m1','m2']}
+        dtype = np.float32 if self.float32 else np.float64
+        return {'covsqrt':np.array(geometry['covsqrt'],dtype=dtype),
+                'meanmul':np.array(geometry['meanmul'],dtype=dtype),
+                'shape':np.array(geometry['shape']),
+                'm1':np.array(geometry['m1']),
+                'm2':np.array(geometry['m2'])}
+
+    def __contains__(self,task):
+        return task in self._cache
+
+    def __getitem__(self,task):
+        with self._lock:
+            if task in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(task)
+                return self._cache[task]
+            self.misses += 1
+            geometry = self._load(task)
+            size = sum(val.nbytes for val in geometry.values())
+            if size<=self.max_bytes:
+                self._cache[task] = geometry
+                self.nbytes += size
+                while self.nbytes>self.max_bytes:
+                    _,old = self._cache.popitem(last=False)
+                    self.nbytes -= sum(val.nbytes for val in old.values())
+            return geometry
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+
+_geometry_caches = {}
+def get_geometry_cache(output_dir,max_bytes=2**30,float32=False):
+    """
+    Get a GeometryCache for output_dir that is shared between calls (and
+    remade if the saved geometries or the cache settings change), so that
+    inpainting many maps keeps the hot geometries in memory.
+    """
+    stamp = os.path.getmtime(f'{output_dir}/source_inpaint_task_indices.txt')
+    key = os.path.abspath(output_dir)
+    if key in _geometry_caches:
+        cache,ostamp = _geometry_caches[key]
+        if ostamp==stamp and cache.max_bytes==max_bytes and cache.float32==float32: return cache
+    cache = GeometryCache(output_dir,max_bytes=max_bytes,float32=float32)
+    _geometry_caches[key] = (cache,stamp)
+    return cache
+
+
 def inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,output_dir,
                                          theory_fn=None,beam_fn=None,include_signal=True,
                                          pol=True,context_fraction=2./3.,
-                                         deproject=True,verbose_every_nsrcs=1,comm=None,skip_zero_ivar=False):
+                                         deproject=True,verbose_every_nsrcs=1,comm=None,skip_zero_ivar=False,
+                                         cache_rtol=None,max_cached=256,packed=True):
     """
     This MPI-parallelized function will pre-calculate quantities required to inpaint a map with circular holes.
     The results will be saved to disk in output_dir. The MPI parallelization is done over the number of sources.
@@ -550,10 +734,22 @@ def inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,output_dir,
 
     comm: MPI communicator object
 
-    
+    cache_rtol: float, optional
+    Sources whose stamps have the same shape and hole pixels, and whose ivar and Fourier-space
+    distance maps are identical (if None) or agree in steps of cache_rtol times their maximum
+    (if specified), share one geometry calculation. The signal covariance is similarly shared
+    between stamps with the same Fourier geometry.
+
+    max_cached: int, optional
+    The maximum number of geometries and signal covariances kept in memory for sharing.
+
+    packed: bool, optional
+    If True, all geometries are written to a single archive file (see GeometryArchive)
+    that the MPI ranks fill in parallel. Otherwise, one HDF file is written per source.
 
     """
     import h5py
+    from collections import OrderedDict
     from . import mpi,io
     
     if not(coords.ndim==2): raise ValueError
@@ -568,6 +764,7 @@ def inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,output_dir,
         my_tasks = each_tasks[rank]
     else:
         comm = mpi.MPI.COMM_WORLD
+        rank = 0
         my_tasks = range(nsrcs)
 
     if pol:
@@ -583,6 +780,10 @@ def inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,output_dir,
         np.savetxt(f'{output_dir}/source_inpaint_attributes.dat',np.asarray([[ncomp,hole_radius/utils.arcmin,context_fraction],]),fmt='%d,%.15f,%.15f',header='ncomp,hole_radius (arcmin),context_fraction')
         if os.path.isfile(empty_file):
             os.remove_file(empty_file)
+        # Remove the index (and archive) of an earlier packed run, so that the readers
+        # never mix it up with the geometries written here
+        for fname in [GEOMETRY_INDEX] + ([] if packed else [GEOMETRY_ARCHIVE]):
+            if os.path.isfile(f'{output_dir}/{fname}'): os.remove(f'{output_dir}/{fname}')
 
     pixboxes = enmap.neighborhood_pixboxes(ivar.shape[-2:], ivar.wcs, coords, rtot)
 
@@ -591,6 +792,24 @@ def inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,output_dir,
     ocoords = []
     oinds = []
 
+    def _cache(cache,key,val):
+        cache[key] = val
+        if len(cache)>max_cached: cache.popitem(last=False)
+        return val
+
+    # Signal covariances (already in vector(I,Q,U) order) and geometries
+    # shared between sources
+    scovs = OrderedDict()
+    geometries = OrderedDict()
+
+    if packed:
+        # Each rank streams its geometries to a scratch file and copies
+        # them into its part of the archive at the end
+        scratch_name = f'{output_dir}/.{GEOMETRY_ARCHIVE}.rank_{rank}'
+        scratch = open(scratch_name,'wb')
+        my_index = []
+        my_size = 0
+
     for ind,task in enumerate(my_tasks):
 
         pixbox = pixboxes[task]
@@ -616,56 +835,56 @@ def inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,output_dir,
         modlmap = ithumb.modlmap()
         modrmap = ithumb.modrmap()
 
-        if include_signal:
-            scov = scov_from_theory(modlmap,theory_fn,beam_fn,iau=False,ncomp=ncomp)
-        else:
-            scov = 0
-
-        ncov = ncov_from_ivar(ithumb,ncomp=ncomp)
-        pcov = scov + ncov
-
         m1,m2 = get_regions(ncomp,modrmap,hole_radius)
 
-
-        # --- Make sure that the pcov is in the right order vector(I,Q,U) ---
-        # It is currently in (ncomp,ncomp,n,n) order
-        # We transpose it to (ncomp,n,ncomp,n) order
-        # so that when it is reshaped into a 2D array, a row/column will correspond to an (I,Q,U) vector
-        pcov = np.transpose(pcov,(0,2,1,3))
-        pcov = pcov.reshape((ncomp*Ny*Nx,ncomp*Ny*Nx))
-
-        # Invert
-        Cinv = np.linalg.inv(pcov)
-
-        # Woodbury deproject common mode
-        if deproject:
-            # Deproject I,Q,U common mode separately
-            u = np.zeros((Ny*Nx*ncomp,ncomp))
-            for i in range(ncomp):
-                u[i*Ny*Nx:(i+1)*Ny*Nx,i] = 1
-            #u = np.ones((ncomp*n**2,1)) # Deproject mode common to all of I,Q,U
-            Cinvu = np.linalg.solve(pcov,u)
-            precalc = np.dot(Cinvu,np.linalg.solve(np.dot(u.T,Cinvu),u.T))
-            correction = np.dot(precalc,Cinv)
-            Cinv -= correction
-
-        # Get matrices for maxlike solution Eq 3 of arXiv:1109.0286
-        cslice = Cinv[m1][:,m1]
-        mul2 = Cinv[m1][:,m2]
-        mean_mul = -np.linalg.solve(cslice,mul2)
-        cov = np.linalg.inv(Cinv[m1][:,m1])
-        cov_root = utils.eigpow(cov,0.5)
-
-        geometry = {}
-        geometry['covsqrt'] = cov_root
-        geometry['meanmul'] = mean_mul
-        geometry['shape'] = np.asarray((Ny,Nx))
-        geometry['m1'] = m1
-        geometry['m2'] = m2
-
-        with h5py.File(f'{output_dir}/source_inpaint_geometry_{task}.hdf','w') as f:
-            for key in geometry:
-                f.create_dataset(key,data=geometry[key])
+        gkey = _stamp_key(None,m1) + _stamp_key(cache_rtol,ithumb,modlmap)
+        if gkey in geometries:
+            geometries.move_to_end(gkey)
+            geometry = geometries[gkey]
+        else:
+            if include_signal:
+                skey = _stamp_key(cache_rtol,modlmap)
+                if skey in scovs:
+                    scovs.move_to_end(skey)
+                else:
+                    # --- Make sure that the pcov is in the right order vector(I,Q,U) ---
+                    # It is currently in (ncomp,ncomp,n,n) order
+                    # We transpose it to (ncomp,n,ncomp,n) order
+                    # so that when it is reshaped into a 2D array, a row/column will correspond to an (I,Q,U) vector
+                    scov = scov_from_theory(modlmap,theory_fn,beam_fn,iau=False,ncomp=ncomp)
+                    _cache(scovs,skey,np.transpose(scov,(0,2,1,3)).reshape((ncomp*Ny*Nx,ncomp*Ny*Nx)))
+                pcov = scovs[skey].copy()
+            else:
+                pcov = np.zeros((ncomp*Ny*Nx,ncomp*Ny*Nx))
+
+            # Add the diagonal white noise covariance (see ncov_from_ivar)
+            var = 1./ithumb
+            var[~np.isfinite(var)] = 1./ithumb[ithumb>0].max() # this is not ideal; but needed to prevent singular matrices
+            var = np.asarray(var).reshape(-1)
+            pdiag = np.einsum('ii->i',pcov)
+            pdiag[:Ny*Nx] += var
+            for i in range(1,ncomp): pdiag[i*Ny*Nx:(i+1)*Ny*Nx] += var * 2.
+
+            # Get matrices for maxlike solution Eq 3 of arXiv:1109.0286
+            mean_mul,cov_root = constrained_realization_matrices(pcov,m1,m2,ncomp,deproject=deproject)
+
+            geometry = {}
+            geometry['covsqrt'] = cov_root
+            geometry['meanmul'] = mean_mul
+            geometry['shape'] = np.asarray((Ny,Nx))
+            geometry['m1'] = m1
+            geometry['m2'] = m2
+            _cache(geometries,gkey,geometry)
+
+        if packed:
+            words = _geometry_words(geometry)
+            scratch.write(words.tobytes())
+            my_index.append([task,Ny,Nx,geometry['m1'].size,geometry['m2'].size,my_size,words.size])
+            my_size += words.size
+        else:
+            with h5py.File(f'{output_dir}/source_inpaint_geometry_{task}.hdf','w') as f:
+                for key in geometry:
+                    f.create_dataset(key,data=geometry[key])
 
         ocoords.append(coords[task])
         oinds.append(task)
@@ -674,6 +893,28 @@ def inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,output_dir,
             if (ind+1)%verbose_every_nsrcs==0: print(f"Done with {ind+1} / {len(my_tasks)}...")
 
 
+    if packed:
+        scratch.close()
+        sizes = utils.allgatherv(np.asarray([my_size],dtype=np.int64),comm)
+        start = int(np.sum(sizes[:rank]))
+        my_index = np.asarray(my_index,dtype=np.int64).reshape((-1,len(_index_cols)))
+        my_index[:,5] += start
+        index = utils.allgatherv(my_index,comm)
+        fname = f'{output_dir}/{GEOMETRY_ARCHIVE}'
+        if rank==0:
+            with open(fname,'wb') as f:
+                f.truncate(int(np.sum(sizes))*8)
+        comm.Barrier()
+        with open(fname,'r+b') as f, open(scratch_name,'rb') as g:
+            f.seek(start*8)
+            while True:
+                chunk = g.read(1<<26)
+                if not(chunk): break
+                f.write(chunk)
+        os.remove(scratch_name)
+        comm.Barrier()
+        if rank==0: np.save(f'{output_dir}/{GEOMETRY_INDEX}',index[np.argsort(index[:,0])])
+
     ocoords = utils.allgatherv(ocoords,comm)
     oinds = utils.allgatherv(oinds,comm)
     if rank==0:
@@ -720,6 +961,14 @@ def preload_geometries(output_dir,verbose_every_nsrcs=100):
     if len(coords)!=len(tasks): raise ValueError
 
     geometries = {}
+    if GeometryArchive.exists(output_dir):
+        archive = GeometryArchive(output_dir)
+        for i,task in enumerate(tasks):
+            geometries[task] = {key:np.array(val) for key,val in archive[task].items()}
+            if verbose_every_nsrcs:
+                if (i+1)%verbose_every_nsrcs==0: print(f"Done with {i+1} / {len(tasks)}...")
+        return geometries
+
     for i,task in enumerate(tasks):
         geometries[task] = {}
         with h5py.File(f'{output_dir}/source_inpaint_geometry_{task}.hdf','r') as f:
@@ -736,7 +985,8 @@ def preload_geometries(output_dir,verbose_every_nsrcs=100):
     return geometries
     
 
-def inpaint_uncorrelated_from_saved_geometries(imap,output_dir,inplace=False,verbose_every_nsrcs=100,geometries=None,do_random=True):
+def inpaint_uncorrelated_from_saved_geometries(imap,output_dir,inplace=False,verbose_every_nsrcs=100,geometries=None,do_random=True,
+                                               cache_bytes=2**30,cache_float32=False,seed=None,nthreads=1):
     """
     Inpaint an ndmap imap with pre-calculated quantities from the directory output_dir.
 
@@ -758,11 +1008,27 @@ def inpaint_uncorrelated_from_saved_geometries(imap,output_dir,inplace=False,ver
 
     geometries: dict, optional
     If provided, this dictionary will be used for pre-calculated geometries instead
-    of loading each source geometry file from disk. This can be much faster if
-    many maps (e.g. simulations) need to be inpainted with the same geometries.
-    However, the geometry dictionary may be very large in memory. This object
+    of loading each source geometry file from disk. If not provided, geometries are
+    loaded on demand through a GeometryCache for output_dir that persists between calls.
+    A pre-loaded dictionary can be faster if many maps (e.g. simulations) need to be
+    inpainted with the same geometries, but may be very large in memory. This object
     can be pre-loaded using the preload_geometries function.
 
+    cache_bytes: int, optional
+    Memory budget in bytes of the geometry cache used if geometries is not provided.
+
+    cache_float32: bool, optional
+    Whether the geometry cache stores the matrices in single precision.
+
+    seed: int or sequence of ints, optional
+    If provided, the random realization for each source is drawn from source_rng(seed,task),
+    so results are reproducible and do not depend on nthreads. Otherwise the global numpy
+    random state is used.
+
+    nthreads: int, optional
+    Number of threads to inpaint sources with. Sources whose stamps overlap are always
+    inpainted in catalog order, so the result does not depend on nthreads.
+
     Returns
     -------
 
@@ -772,14 +1038,89 @@ def inpaint_uncorrelated_from_saved_geometries(imap,output_dir,inplace=False,ver
 
 
     """
-    import h5py
-    from . import maps
-
     if not(inplace): imap = imap.copy()
+    inpaint_stack_from_saved_geometries(imap[None],output_dir,inplace=True,verbose_every_nsrcs=verbose_every_nsrcs,
+                                        geometries=geometries,do_random=do_random,
+                                        cache_bytes=cache_bytes,cache_float32=cache_float32,
+                                        seed=seed,nthreads=nthreads)
+    return imap
+
+
+def _pixbox_slices(shape,pixboxes):
+    """
+    Slices into the last two axes of a map of given shape for each pixbox, or None
+    where the pixbox is not fully inside the map (and needs extract_pixbox/insert_at).
+    """
+    Ny,Nx = shape[-2:]
+    slices = []
+    for (y0,x0),(y1,x1) in np.asarray(pixboxes,dtype=int):
+        if y0>=0 and x0>=0 and y1<=Ny and x1<=Nx:
+            slices.append((Ellipsis,slice(y0,y1),slice(x0,x1)))
+        else:
+            slices.append(None)
+    return slices
+
+
+def _pixbox_waves(pixboxes,slices):
+    """
+    Split sources into waves that can each be inpainted concurrently. Sources in a wave
+    have non-overlapping pixboxes, and every source comes in a later wave than the earlier
+    sources it overlaps, so the result is the same as inpainting them in order. Pixboxes
+    not fully inside the map (slices None) are treated as overlapping all others.
+    """
+    pixboxes = np.asarray(pixboxes,dtype=int)
+    y0,x0 = pixboxes[:,0].T
+    y1,x1 = pixboxes[:,1].T
+    edge = np.array([sel is None for sel in slices])
+    level = np.zeros(len(pixboxes),dtype=int)
+    for i in range(1,len(pixboxes)):
+        if edge[i]:
+            level[i] = level[:i].max()+1
+            continue
+        over = edge[:i] | ((y0[:i]<y1[i]) & (y1[:i]>y0[i]) & (x0[:i]<x1[i]) & (x1[:i]>x0[i]))
+        if over.any(): level[i] = level[:i][over].max()+1
+    return [np.where(level==l)[0] for l in range(level.max()+1)] if len(level) else []
+
+
+def source_rng(seed,task):
+    """
+    Random generator for the source with index task that depends only on (seed,task),
+    so that draws do not depend on the order or the threads in which sources are processed.
+    """
+    return np.random.default_rng([int(x) for x in np.atleast_1d(seed)]+[int(task)])
+
+
+def inpaint_stack_from_saved_geometries(imaps,output_dir,inplace=False,verbose_every_nsrcs=100,geometries=None,do_random=True,
+                                        cache_bytes=2**30,cache_float32=False,seed=None,nthreads=1):
+    """
+    Inpaint a stack of ndmaps imaps (e.g. simulations) with pre-calculated quantities from
+    the directory output_dir. For each source, the mean infill and the random realization
+    are obtained for all the maps at once with matrix-matrix products, and stamps are read
+    and written back with pixel slices computed once for the stack.
+
+    Arguments
+    ---------
+
+    imaps: ndmap
+    (nmaps,...,Ny,Nx) stack of ndmaps. The (...,Ny,Nx) shape of each map is as in
+    inpaint_uncorrelated_from_saved_geometries.
+
+    The remaining arguments are as in inpaint_uncorrelated_from_saved_geometries. With a seed,
+    the (nmaps,nhole) draws for a source come from one source_rng(seed,task) stream, so the
+    first map of a stack gets the same realization (up to rounding) as when inpainted on its own.
+
+    Returns
+    -------
+
+    imaps: ndmap
+    (nmaps,...,Ny,Nx) stack of inpainted ndmaps.
+
+    """
+    if not(inplace): imaps = imaps.copy()
     empty_file = f'{output_dir}/empty_catalog'
     if os.path.isfile(empty_file):
-        print("WARNING: Empty catalog detected. Skipping and returning original map.")
-        return imap
+        print("WARNING: Empty catalog detected. Skipping and returning original maps.")
+        return imaps
     
     coords = np.loadtxt(f'{output_dir}/source_inpaint_coords.txt')
     tasks = np.loadtxt(f'{output_dir}/source_inpaint_task_indices.txt').astype(int)
@@ -796,64 +1137,148 @@ def inpaint_uncorrelated_from_saved_geometries(imap,output_dir,inplace=False,ver
             print("Missing inpaint model files. Please remake the model.")
         raise
     rtot = hole_radius * (1 + context_fraction)
-    pixboxes = enmap.neighborhood_pixboxes(imap.shape[-2:], imap.wcs, coords, rtot)
+    pixboxes = enmap.neighborhood_pixboxes(imaps.shape[-2:], imaps.wcs, coords, rtot)
 
-    for i,task in enumerate(tasks):
-        pixbox = pixboxes[i]
-        ithumb = imap.extract_pixbox(pixbox)
-        Ny,Nx = ithumb.shape[-2:]
+    if geometries is None:
+        geometries = get_geometry_cache(output_dir,max_bytes=cache_bytes,float32=cache_float32)
 
-        oshape = ithumb.shape
+    nmaps = imaps.shape[0]
+    slices = _pixbox_slices(imaps.shape,pixboxes)
 
-        if geometries is None:
-            with h5py.File(f'{output_dir}/source_inpaint_geometry_{task}.hdf','r') as f:
-                cov_root = f['covsqrt'][:]
-                mean_mul = f['meanmul'][:]
-                shape = f['shape'][:]
-                m1 = f['m1'][:]
-                m2 = f['m2'][:]
-        else:
-            cov_root = geometries[task]['covsqrt']
-            mean_mul = geometries[task]['meanmul']
-            shape = geometries[task]['shape']
-            m1 = geometries[task]['m1']
-            m2 = geometries[task]['m2']
+    def inpaint_source(i):
+        task = tasks[i]
+        pixbox = pixboxes[i]
+        sel = slices[i]
+        thumbs = imaps[sel] if sel is not None else enmap.extract_pixbox(imaps,pixbox)
+        Ny,Nx = thumbs.shape[-2:]
+
+        geometry = geometries[task]
+        cov_root = geometry['covsqrt']
+        mean_mul = geometry['meanmul']
+        shape = geometry['shape']
+        m1 = geometry['m1']
+        m2 = geometry['m2']
 
         if not(Ny==shape[0]) or not(Nx==shape[1]): 
             print(f'{output_dir}/source_inpaint_geometry_{task}.hdf')
             print(shape)
             print(Ny,Nx)
             print(task, i, coords[i]/utils.degree)
-            print(imap.wcs)
-            print(imap.shape)
+            print(imaps.wcs)
+            print(imaps.shape)
             print(pixbox)
             raise ValueError
 
-        # # Get the mean infill
-        cstamp = ithumb.reshape(-1)
-        mean = np.dot(mean_mul,cstamp[m2])
-        # Get a random realization (this could be moved outside the loop)
-        r = np.random.normal(0.,1.,size=(m1.size)) # FIXME: seed?
-        rand = np.dot(cov_root,r) if do_random else 0.
-
-        
-        # Total
-        sim = mean + rand
-
-
-        ithumb.reshape(-1)[m1] = sim
-        ithumb.reshape(oshape)
+        # Mean infill and random realization for all maps, (nmaps,npix)
+        cstamps = np.array(thumbs).reshape((nmaps,-1))
+        sims = np.dot(cstamps[:,m2],mean_mul.T)
+        if do_random:
+            r = np.random.normal(0.,1.,size=(nmaps,m1.size)) if seed is None else source_rng(seed,task).standard_normal((nmaps,m1.size))
+            sims += np.dot(r,cov_root.T)
+        cstamps[:,m1] = sims
 
-        imap = enmap.insert_at(imap,pixbox,ithumb)
+        if sel is not None:
+            imaps[sel] = cstamps.reshape(thumbs.shape)
+        else:
+            enmap.insert_at(imaps,pixbox,enmap.enmap(cstamps.reshape(thumbs.shape),thumbs.wcs))
 
-        if verbose_every_nsrcs:
-            if (i+1)%verbose_every_nsrcs==0: print(f"Done with {i+1} / {len(tasks)}...")
+    if nthreads>1:
+        from concurrent.futures import ThreadPoolExecutor
+        waves = _pixbox_waves(pixboxes,slices)
+        pool = ThreadPoolExecutor(nthreads)
+        mapper = pool.map
+    else:
+        waves = [range(len(tasks))]
+        mapper = map
+    done = 0
+    try:
+        for wave in waves:
+            for _ in mapper(inpaint_source,wave):
+                done += 1
+                if verbose_every_nsrcs:
+                    if done%verbose_every_nsrcs==0: print(f"Done with {done} / {len(tasks)}...")
+    finally:
+        if nthreads>1: pool.shutdown()
 
-    return imap
+    return imaps
 
 def extract_cutouts(imap,coords,radius):
     pixboxes = enmap.neighborhood_pixboxes(imap.shape[-2:], imap.wcs, coords, radius)    
     for pixbox in pixboxes:
         ithumb = imap.extract_pixbox(pixbox)
         yield ithumb
+
+
+def uniform_pixboxes(pixboxes):
+    """
+    Grow the pixboxes[nsrc,{from,to},{y,x}] about their centers to the largest
+    (ny,nx) among them, so that their stamps can share a (nsrc,...,ny,nx) buffer.
+    """
+    pixboxes = np.array(pixboxes,dtype=int)
+    sizes = pixboxes[:,1]-pixboxes[:,0]
+    nmax = sizes.max(axis=0)
+    pixboxes[:,0] -= (nmax-sizes)//2
+    pixboxes[:,1] = pixboxes[:,0] + nmax
+    return pixboxes
+
+
+def _thread_chunks(func,n,nthreads):
+    # Call func(indices) for chunks of range(n), in a thread pool if nthreads>1
+    if nthreads<=1 or n<2:
+        func(np.arange(n))
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(nthreads) as pool:
+        list(pool.map(func,np.array_split(np.arange(n),min(n,4*nthreads))))
+
+
+def extract_pixboxes(imap,pixboxes,nthreads=1,out=None,wrap="auto"):
+    """
+    Extract the stamps of imap in pixboxes[nsrc,{from,to},{y,x}], which must all
+    have the same shape, into a contiguous (nsrc,...,ny,nx) array. Pixboxes that
+    are not fully inside the map are handled by enmap.extract_pixbox, so wrapping
+    follows wrap and pixels off the map are zero. Stamps are extracted with nthreads
+    threads. out can be a pre-allocated buffer to extract into.
+    """
+    pixboxes = np.asarray(pixboxes,dtype=int)
+    sizes = pixboxes[:,1]-pixboxes[:,0]
+    if np.any(sizes!=sizes[0]): raise ValueError("Pixboxes must have the same shape. Use uniform_pixboxes.")
+    nsrc = len(pixboxes)
+    if out is None: out = np.empty((nsrc,)+imap.shape[:-2]+tuple(sizes[0]),dtype=imap.dtype)
+    slices = _pixbox_slices(imap.shape,pixboxes)
+    def extract(inds):
+        for i in inds:
+            out[i] = imap[slices[i]] if slices[i] is not None else enmap.extract_pixbox(imap,pixboxes[i],wrap=wrap)
+    _thread_chunks(extract,nsrc,nthreads)
+    return out
+
+
+def insert_pixboxes(imap,stamps,pixboxes,nthreads=1,wrap="auto"):
+    """
+    Inverse of extract_pixboxes: paste stamps (nsrc,...,ny,nx) back into imap (in place)
+    at pixboxes[nsrc,{from,to},{y,x}] with nthreads threads. Where pixboxes overlap,
+    later stamps win, as when pasting in order.
+    """
+    pixboxes = np.asarray(pixboxes,dtype=int)
+    slices = _pixbox_slices(imap.shape,pixboxes)
+    waves = _pixbox_waves(pixboxes,slices) if nthreads>1 else [np.arange(len(pixboxes))]
+    def insert(inds):
+        for i in inds:
+            if slices[i] is not None:
+                imap[slices[i]] = stamps[i]
+            else:
+                enmap.insert_at(imap,pixboxes[i],enmap.enmap(stamps[i],imap.wcs),wrap=wrap)
+    for wave in waves:
+        _thread_chunks(lambda inds: insert(wave[inds]),len(wave),nthreads)
+    return imap
+
+
+def extract_cutouts_array(imap,coords,radius,nthreads=1,wrap="auto"):
+    """
+    Like extract_cutouts, but extracts all the stamps within radius of coords[nsrc,{dec,ra}]
+    into one (nsrc,...,ny,nx) array using nthreads threads. The pixboxes are made uniform
+    with uniform_pixboxes. Returns the stamps and the pixboxes (e.g. for insert_pixboxes).
+    """
+    pixboxes = uniform_pixboxes(enmap.neighborhood_pixboxes(imap.shape[-2:], imap.wcs, coords, radius))
+    return extract_pixboxes(imap,pixboxes,nthreads=nthreads,wrap=wrap),pixboxes
     
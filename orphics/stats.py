@@ -1,6 +1,7 @@
 from __future__ import print_function
 import numpy as np
 import time, warnings
+import os
 import itertools
 import scipy
 from scipy.stats import binned_statistic as binnedstat,chi2
@@ -553,10 +554,25 @@ class Stats(object):
     of 1d measurements or 2d stacks.
     """
     
-    def __init__(self,comm=None,root=0,loopover=None,tag_start=333):
+    def __init__(self,comm=None,root=0,loopover=None,tag_start=333,online=False,collective=False,
+                 checkpoint_dir=None,checkpoint_every=1):
         """
         comm - MPI.COMM_WORLD object
         tag_start - MPI comm tags start at this integer
+        online - if True, don't keep the 1d measurements. Only a running
+        count, mean and co-moment matrix is kept for each label (Welford),
+        so memory does not grow with the number of measurements. get_stats
+        then merges these across all cores of comm with a reduction (Chan et al.),
+        so it must be called by every core. The individual vectors are not available.
+        collective - if True, get_stacks and get_stats use collective communication
+        (one Reduce for all stacks, one Gatherv for all vectors) on buffers that pack
+        every label together, instead of point-to-point messages for each core and label.
+        They must then be called by every core of comm. Cores that are neither the root
+        nor in loopover contribute nothing.
+        checkpoint_dir - if specified, each core saves its accumulators to binary files
+        in this directory every checkpoint_every calls to task_done, and reloads them here
+        if they already exist. Task ids must be hashable and picklable (e.g. ints or tuples, not lists or arrays). Use remaining_tasks to skip the tasks finished before a
+        restart. The number of cores must be the same as in the run that was checkpointed.
         """
 
         if comm is not None:
@@ -571,6 +587,9 @@ class Stats(object):
         self.columns = {}
             
         self.vectors = {}
+        self.online = online
+        self.collective = collective
+        self.moments = {}
         self.little_stack = {}
         self.little_stack_count = {}
         self.tag_start = tag_start
@@ -580,6 +599,93 @@ class Stats(object):
         else:
             self.loopover = loopover
 
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.finished_tasks = []
+        self._nshards = 0
+        self._nsaved = {}
+        if checkpoint_dir is not None: self.load_checkpoint()
+
+    def _checkpoint_file(self,shard=None):
+        root = f"{self.checkpoint_dir}/mstats_checkpoint_rank_{self.rank}"
+        return f"{root}.npz" if shard is None else f"{root}_vectors_{shard}.npz"
+
+    def task_done(self,task):
+        """
+        Record that task (e.g. an element of my_tasks from mpi.distribute)
+        has been fully added, checkpointing every checkpoint_every tasks.
+        """
+        self.finished_tasks.append(task)
+        if self.checkpoint_dir is not None and len(self.finished_tasks)%self.checkpoint_every==0:
+            self.checkpoint()
+
+    def remaining_tasks(self,tasks):
+        """The subset of tasks not already finished (before a restart). Task ids must be hashable."""
+        done = set(self.finished_tasks)
+        return [task for task in tasks if task not in done]
+
+    def checkpoint(self):
+        """
+        Save the state of this core to checkpoint_dir. The vectors added since the
+        previous checkpoint are written to a new shard file, so the total I/O grows
+        linearly with the number of vectors. The stacks, counts, running moments and
+        finished tasks (pickled) are rewritten to a small state file that also records
+        how many shards belong to the checkpoint.
+        """
+        import json,pickle
+        from orphics import io
+        new = [label for label in self.vectors.keys() if len(self.vectors[label])>self._nsaved.get(label,0)]
+        if new:
+            arrs = {'labels':np.array(json.dumps(new))}
+            for k,label in enumerate(new):
+                arrs[f'vectors_{k}'] = np.asarray(self.vectors[label][self._nsaved.get(label,0):]).reshape((-1,)+tuple(self.columns[label]))
+            io.atomic_save(self._checkpoint_file(self._nshards),**arrs)
+            self._nshards += 1
+            for label in new: self._nsaved[label] = len(self.vectors[label])
+        vlabels = list(self.vectors.keys())
+        slabels = list(self.little_stack.keys())
+        mlabels = list(self.moments.keys())
+        meta = {'numcores':self.numcores,'online':self.online,'nshards':self._nshards,
+                'vlabels':vlabels,'slabels':slabels,'mlabels':mlabels,
+                'columns':[[label,list(self.columns[label])] for label in self.columns.keys()],
+                'counts':[self.little_stack_count[label] for label in slabels],
+                'nmoments':[int(self.moments[label][0]) for label in mlabels]}
+        arrs = {'meta':np.array(json.dumps(meta)),
+                'finished_tasks':np.frombuffer(pickle.dumps(self.finished_tasks),dtype=np.uint8)}
+        for k,label in enumerate(slabels):
+            arrs[f'stack_{k}'] = np.asarray(self.little_stack[label])
+        for k,label in enumerate(mlabels):
+            arrs[f'mean_{k}'] = self.moments[label][1]
+            arrs[f'comoment_{k}'] = self.moments[label][2]
+        io.atomic_save(self._checkpoint_file(),**arrs)
+
+    def load_checkpoint(self):
+        """
+        Restore the state saved by checkpoint for this core, if any.
+        Returns True if a checkpoint was loaded.
+        """
+        import json,pickle
+        fname = self._checkpoint_file()
+        if not(os.path.isfile(fname)): return False
+        with np.load(fname) as f:
+            meta = json.loads(str(f['meta']))
+            if meta['numcores']!=self.numcores: raise ValueError(f"Checkpoint {fname} was written with {meta['numcores']} cores, not {self.numcores}.")
+            if meta['online']!=self.online: raise ValueError(f"Checkpoint {fname} has online={meta['online']}.")
+            self.columns = {label:tuple(cols) for label,cols in meta['columns']}
+            self.little_stack = {label:f[f'stack_{k}'] for k,label in enumerate(meta['slabels'])}
+            self.little_stack_count = dict(zip(meta['slabels'],meta['counts']))
+            self.moments = {label:[n,f[f'mean_{k}'],f[f'comoment_{k}']] for k,(label,n) in enumerate(zip(meta['mlabels'],meta['nmoments']))}
+            self.finished_tasks = pickle.loads(f['finished_tasks'].tobytes())
+        # Shards beyond nshards are from a checkpoint that was interrupted, and are ignored
+        self.vectors = {label:[] for label in meta['vlabels']}
+        self._nshards = meta['nshards']
+        for shard in range(self._nshards):
+            with np.load(self._checkpoint_file(shard)) as f:
+                for k,label in enumerate(json.loads(str(f['labels']))):
+                    self.vectors[label].extend(f[f'vectors_{k}'])
+        self._nsaved = {label:len(self.vectors[label]) for label in self.vectors}
+        return True
+
     def add_to_stats(self,label,vector,exclude=False):
         """
         Append the 1d vector to a statistic named "label".
@@ -593,6 +699,19 @@ class Stats(object):
             print("ERROR: stats on complex arrays not supported. Do the real and imaginary parts separately.")
             raise TypeError
         
+        if self.online:
+            vector = vector.reshape(-1).astype(np.float64)
+            if not(label in self.moments):
+                self.moments[label] = [0,np.zeros(vector.size),np.zeros((vector.size,vector.size))]
+                self.columns[label] = vector.shape
+            if not(exclude):
+                mom = self.moments[label]
+                mom[0] += 1
+                delta = vector - mom[1]
+                mom[1] += delta/mom[0]
+                mom[2] += np.outer(delta,vector-mom[1])
+            return
+
         if not(label in list(self.vectors.keys())):
             self.vectors[label] = []
             self.columns[label] = vector.shape
@@ -619,11 +738,80 @@ class Stats(object):
             self.little_stack_count[label] += 1
 
 
+    def _reduce_stacks(self):
+        """
+        Sum the stacks and counts of all cores onto the root with a single
+        Reduce of one packed float64 buffer. Returns None on other cores.
+        """
+        labels = list(self.little_stack.keys())
+        take = (self.rank in self.loopover) or self.rank==self.root
+        counts = np.array([self.little_stack_count[label] if take else 0 for label in labels],dtype=np.float64)
+        buf = np.concatenate([counts]+[np.asarray(self.little_stack[label],dtype=np.float64).reshape(-1)*take for label in labels])
+        if self.numcores>1:
+            from orphics.mpi import MPI,ProcessComm
+            rbuf = np.empty_like(buf) if self.rank==self.root else None
+            self.comm.Reduce(buf,rbuf,op=ProcessComm.SUM if isinstance(self.comm,ProcessComm) else MPI.SUM,root=self.root)
+            buf = rbuf
+        return buf
+
+    def _gather_vectors(self):
+        """
+        Gather the vectors of all cores onto the root with a single Gatherv
+        of one packed float64 buffer. Sets self.vectors and self.numobj in
+        the same order as the point-to-point version (root first, then loopover)
+        and returns True on the root.
+        """
+        labels = list(self.vectors.keys())
+        take = (self.rank in self.loopover) or self.rank==self.root
+        mine = [np.asarray(self.vectors[label],dtype=np.float64).reshape((-1,)+self.columns[label]) if take \
+                else np.zeros((0,)+self.columns[label]) for label in labels]
+        ncols = np.array([int(np.prod(self.columns[label])) for label in labels],dtype=np.int64)
+        nobj = np.array([m.shape[0] for m in mine],dtype=np.int64)
+        sendbuf = np.concatenate([m.reshape(-1) for m in mine]+[np.zeros(0)])
+        if self.numcores>1:
+            isroot = self.rank==self.root
+            allnobj = np.empty((self.numcores,len(labels)),dtype=np.int64) if isroot else None
+            self.comm.Gather(nobj,allnobj,root=self.root)
+            sizes = allnobj @ ncols if isroot else None
+            recvbuf = np.empty(sizes.sum()) if isroot else None
+            self.comm.Gatherv(sendbuf,[recvbuf,sizes] if isroot else None,root=self.root)
+            if not(isroot): return False
+        else:
+            allnobj = nobj[None]
+            sizes = allnobj @ ncols
+            recvbuf = sendbuf
+        offsets = np.append(0,np.cumsum(sizes))
+        order = [self.root]+[core for core in self.loopover if core!=self.root]
+        self.numobj = {}
+        for k,label in enumerate(labels):
+            self.numobj[label] = [int(allnobj[core,k]) for core in order]
+            blocks = []
+            for core in order:
+                i = offsets[core] + allnobj[core,:k] @ ncols[:k]
+                blocks.append(recvbuf[i:i+allnobj[core,k]*ncols[k]].reshape((allnobj[core,k],)+self.columns[label]))
+            self.vectors[label] = np.concatenate(blocks,axis=0)
+        return True
+
     def get_stacks(self,verbose=True):
         """
         Collect from all MPI cores and calculate stacks.
         """
 
+        if self.collective:
+            buf = self._reduce_stacks()
+            if buf is None: return
+            self.stacks = {}
+            self.stack_count = {}
+            labels = list(self.little_stack.keys())
+            i = len(labels)
+            for k,label in enumerate(labels):
+                shape = np.shape(self.little_stack[label])
+                size = int(np.prod(shape))
+                self.stack_count[label] = int(round(buf[k]))
+                self.stacks[label] = buf[i:i+size].reshape(shape) / self.stack_count[label]
+                i += size
+            return
+
         if self.rank in self.loopover:
 
             for k,label in enumerate(self.little_stack.keys()):
@@ -659,12 +847,69 @@ class Stats(object):
             for k,label in enumerate(self.little_stack.keys()):                
                 self.stacks[label] /= self.stack_count[label]
                 
+    def _reduce_moments(self):
+        """
+        Merge the running moments of all cores onto the root with a single
+        Reduce of one packed float64 buffer. Returns None on other cores.
+        """
+        labels = list(self.moments.keys())
+        sizes = [self.moments[label][1].size for label in labels]
+        buf = np.concatenate([pack_moments(*self.moments[label]) for label in labels]+[np.zeros(0)])
+        if self.numcores>1:
+            from orphics.mpi import MPI,ProcessComm
+            def _merge(inmem,outmem,datatype):
+                a = np.frombuffer(inmem,dtype=np.float64)
+                b = np.frombuffer(outmem,dtype=np.float64)
+                i = 0
+                for nc in sizes:
+                    sl = slice(i,i+1+nc+nc*nc)
+                    b[sl] = pack_moments(*merge_moments(*unpack_moments(a[sl],nc),*unpack_moments(b[sl],nc)))
+                    i = sl.stop
+            rbuf = np.empty_like(buf) if self.rank==self.root else None
+            if isinstance(self.comm,ProcessComm):
+                self.comm.Reduce(buf,rbuf,op=_merge,root=self.root)
+            else:
+                # The whole buffer is a single element so that MPI never
+                # applies the merge to a partial record
+                rtype = MPI.DOUBLE.Create_contiguous(buf.size).Commit()
+                op = MPI.Op.Create(_merge,commute=True)
+                self.comm.Reduce([buf,1,rtype],[rbuf,1,rtype] if rbuf is not None else None,op=op,root=self.root)
+                op.Free()
+                rtype.Free()
+            buf = rbuf
+        if self.rank!=self.root: return None
+        ret = {}
+        i = 0
+        for label,nc in zip(labels,sizes):
+            ret[label] = unpack_moments(buf[i:i+1+nc+nc*nc],nc)
+            i += 1+nc+nc*nc
+        return ret
+                
     def get_stats(self,verbose=True,skip_stats=False):
         """
         Collect from all MPI cores and calculate statistics for
         1d measurements.
         """
 
+        if self.online:
+            moments = self._reduce_moments()
+            if moments is None: return
+            self.stats = {}
+            self.numobj = {}
+            for label in moments.keys():
+                n,mean,comoment = moments[label]
+                self.numobj[label] = [n]
+                if not(skip_stats): self.stats[label] = get_stats_from_moments(n,mean,comoment)
+            return
+
+        if self.collective:
+            if not(self._gather_vectors()): return
+            self.stats = {}
+            if not(skip_stats):
+                for k,label in enumerate(self.vectors.keys()):
+                    self.stats[label] = get_stats(self.vectors[label])
+            return
+
         if self.rank in self.loopover:
             for k,label in enumerate(self.vectors.keys()):
                 self.comm.send(np.array(self.vectors[label]).shape[0], dest=self.root, tag=self.tag_start*2000+k)
@@ -750,34 +995,87 @@ def npspace(minim,maxim,num,scale="lin"):
 
 
 class bin2D(object):
+    """
+    Bin (...,Ny,Nx) arrays in annuli of modrmap with edges bin_edges (right-inclusive).
+    The pixels are sorted by bin once, and the sorted indices and per-bin offsets are
+    cached by geometry (modrmap and bin_edges), so that re-creating a binner for the same
+    geometry is cheap. The most recent cache_size geometries are kept.
+
+    All bin_edges.size-1 bins are returned (matching centers), with NaN for bins that
+    have no pixels, e.g. those beyond modrmap.max(). Older versions dropped the trailing
+    bins when no pixels lay beyond the last edge.
+    """
+    _cache = {}
+    cache_size = 8
+
     def __init__(self, modrmap, bin_edges):
         self.centers = (bin_edges[1:]+bin_edges[:-1])/2.
-        self.digitized = np.digitize(modrmap.reshape(-1), bin_edges,right=True)
         self.bin_edges = bin_edges
         self.modrmap = modrmap
+        self.digitized,self._order,self._offsets = self._sorted_bins(np.asarray(modrmap),np.asarray(bin_edges))
+        self._counts = np.diff(self._offsets)
+        self._starts = self._offsets[:-1][self._counts>0]
+
+    @classmethod
+    def _sorted_bins(cls,modrmap,bin_edges):
+        from orphics import io
+        key = io.array_key(modrmap,np.asarray(bin_edges,dtype=np.float64))
+        if key in cls._cache:
+            cls._cache[key] = cls._cache.pop(key)
+            return cls._cache[key]
+        digitized = np.digitize(modrmap.reshape(-1), bin_edges,right=True)
+        nbins = bin_edges.size-1
+        order = np.argsort(digitized,kind='stable')
+        # Pixels in bin i (digitized==i+1) are order[offsets[i]:offsets[i+1]]
+        offsets = np.searchsorted(digitized[order],np.arange(1,nbins+2))
+        order = order[offsets[0]:offsets[-1]]
+        offsets = offsets - offsets[0]
+        cls._cache[key] = (digitized,order,offsets)
+        while len(cls._cache)>cls.cache_size: cls._cache.pop(next(iter(cls._cache)))
+        return cls._cache[key]
+
+    def _bin_sums(self,sdata):
+        # Sums of the (nbatch,npix_in_range) bin-sorted sdata in each bin
+        out = np.zeros(sdata.shape[:-1]+(self.centers.size,),dtype=np.result_type(sdata.dtype,np.float64))
+        if self._starts.size: out[...,self._counts>0] = np.add.reduceat(sdata,self._starts,axis=-1)
+        return out
 
     def bin(self,data2d,weights=None,err=False,get_count=False,mask_nan=False):
-        if weights is None:
-            if mask_nan:
-                keep = ~np.isnan(data2d.reshape(-1))
+        """
+        Bin data2d of shape (...,Ny,Nx), returning centers and the (...,nbins) binned
+        means, followed by their errors if err and then the (weighted) counts if get_count.
+        With weights, the errors use the effective number of pixels (sum w)^2/sum(w^2).
+        """
+        data2d = np.asarray(data2d)
+        bshape = data2d.shape[:-2]
+        sdata = data2d.reshape((-1,data2d.shape[-2]*data2d.shape[-1]))[:,self._order]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if weights is None:
+                if mask_nan:
+                    keep = ~np.isnan(sdata)
+                    sdata = np.where(keep,sdata,0.)
+                    count = self._bin_sums(keep.astype(np.float64))
+                else:
+                    keep = None
+                    count = np.broadcast_to(self._counts.astype(np.float64),(sdata.shape[0],self.centers.size))
+                res = self._bin_sums(sdata)/count
+                if err:
+                    dev = (sdata-np.repeat(res,self._counts,axis=-1))**2.
+                    if keep is not None: dev = dev*keep
+                    std = np.sqrt(self._bin_sums(dev)/(count-1)/count)
             else:
-                keep = np.ones((data2d.size,),dtype=bool)
-            count = np.bincount(self.digitized[keep])[1:-1]
-            res = np.bincount(self.digitized[keep],(data2d).reshape(-1)[keep])[1:-1]/count
-            if err:
-                meanmap = self.modrmap.copy().reshape(-1) * 0
-                for i in range(self.centers.size): meanmap[self.digitized==i] = res[i]
-                std = np.sqrt(np.bincount(self.digitized[keep],((data2d-meanmap.reshape(self.modrmap.shape))**2.).reshape(-1)[keep])[1:-1]/(count-1)/count)
-        else:
-            count = np.bincount(self.digitized,weights.reshape(-1))[1:-1]
-            res = np.bincount(self.digitized,(data2d*weights).reshape(-1))[1:-1]/count
-        if get_count:
-            assert not(err) # need to make more general
-            return self.centers,res,count
-        if err:
-            assert not(get_count)
-            return self.centers,res,std
-        return self.centers,res
+                sweights = np.broadcast_to(weights,data2d.shape).reshape(sdata.shape[0],-1)[:,self._order]
+                count = self._bin_sums(sweights)
+                res = self._bin_sums(sdata*sweights)/count
+                if err:
+                    dev = sweights*(sdata-np.repeat(res,self._counts,axis=-1))**2.
+                    neff = count**2./self._bin_sums(sweights**2.)
+                    std = np.sqrt(self._bin_sums(dev)/count/(neff-1))
+        oshape = bshape+(self.centers.size,)
+        out = (self.centers,res.reshape(oshape))
+        if err: out = out + (std.reshape(oshape),)
+        if get_count: out = out + (count.reshape(oshape),)
+        return out
 
 
 
@@ -866,6 +1164,42 @@ def get_stats(binned_vectors):
         
     return ret
 
+def merge_moments(na,meana,comoma,nb,meanb,comomb):
+    """
+    Combine the count, mean and co-moment matrix (sum of outer products
+    of deviations from the mean) of two independent sets of samples
+    (Chan, Golub & LeVeque).
+    """
+    n = na+nb
+    if n==0: return 0,meana.copy(),comoma.copy()
+    delta = meanb-meana
+    mean = meana + delta*(nb/n)
+    comom = comoma + comomb + np.outer(delta,delta)*(na*nb/n)
+    return n,mean,comom
+
+def pack_moments(n,mean,comoment):
+    """Flatten count, mean and co-moment into one float64 buffer."""
+    return np.concatenate([[n],mean,np.asarray(comoment).reshape(-1)]).astype(np.float64)
+
+def unpack_moments(buf,ncols):
+    """Inverse of pack_moments for vectors of length ncols."""
+    return int(round(buf[0])),buf[1:1+ncols].copy(),buf[1+ncols:1+ncols+ncols*ncols].reshape((ncols,ncols)).copy()
+
+def get_stats_from_moments(n,mean,comoment):
+    """
+    Same statistics as get_stats, but from the count, mean and
+    co-moment matrix of the samples instead of the samples themselves.
+    """
+    ret = {}
+    ret['mean'] = mean.copy()
+    cov = comoment / (n-1.)
+    ret['cov'] = cov[0,0] if cov.shape==(1,1) else cov
+    ret['covmean'] = ret['cov'] / n
+    ret['err'] = np.sqrt(ret['cov']) if cov.shape==(1,1) else np.sqrt(np.diagonal(cov))
+    ret['errmean'] = ret['err'] / np.sqrt(n)
+    ret['corr'] = 1. if cov.shape==(1,1) else cov2corr(cov)
+    return ret
+
 
 
 def timeit(method):
@@ -0,0 +1,179 @@
+import numpy as np
+import pytest
+import os
+from pixell import enmap, utils, lensing as enlensing
+from orphics import lensing, maps
+
+def _fields(n=128,res=1.,seed=0):
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(n,n),res=res*utils.arcmin,proj='car')
+    rng = np.random.default_rng(seed)
+    modlmap = enmap.modlmap(shape,wcs)
+    # Deflections of about an arcminute, so the integer pixel part is exercised
+    kappa = maps.filter_map(enmap.enmap(rng.standard_normal(shape),wcs),maps.gauss_beam(modlmap,3.))*1.0
+    kphi = np.zeros(shape)
+    np.divide(2.,modlmap*(modlmap+1.),out=kphi,where=modlmap>0)
+    phi = enmap.ifft(enmap.fft(kappa)*kphi).real
+    imap = maps.filter_map(enmap.enmap(rng.standard_normal((3,)+shape),wcs),maps.gauss_beam(modlmap,3.))
+    return phi,imap
+
+def test_flat_taylens_matches_displace_map():
+    phi,imap = _fields()
+    assert imap.wcs.wcs.cdelt[0]<0
+    assert np.abs(enmap.grad(phi)).max()>utils.arcmin
+    alpha = lensing.alpha_from_kappa(posmap=enmap.posmap(phi.shape,phi.wcs),phi=phi)
+    ref = enlensing.displace_map(imap,alpha,order=5)
+    omap = lensing.flat_taylens(phi,imap,taylor_order=5)
+    assert np.std(omap-ref) < 1e-2*np.std(ref-imap)
+
+def test_flat_taylens_fields_and_chunks():
+    phi,imap = _fields(n=64)
+    omap = lensing.flat_taylens(phi,imap)
+    # One field per chunk, and each field lensed separately
+    assert np.allclose(omap,lensing.flat_taylens(phi,imap,max_bytes=1),rtol=0,atol=1e-12)
+    for i in range(3):
+        assert np.allclose(omap[i],lensing.flat_taylens(phi,imap[i]),rtol=0,atol=1e-12)
+
+def _sims(n=64,pol=True):
+    # FlatLensingSims with white 2D spectra, set up as in __init__ but
+    # without needing a theory object
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(n,n),res=1.*utils.arcmin,proj='car')
+    ncomp = 3 if pol else 1
+    sims = lensing.FlatLensingSims.__new__(lensing.FlatLensingSims)
+    sims.modlmap = enmap.modlmap(shape,wcs)
+    sims.mgen = maps.MapGen((ncomp,)+shape if pol else shape,wcs,np.eye(ncomp)[:,:,None,None]*np.ones(shape)*1e-7)
+    ps_kk = np.ones((1,1)+shape)*1e-9
+    sims.kgen = maps.MapGen(shape,wcs,ps_kk)
+    sims.ngen = maps.MapGen((ncomp,)+shape if pol else shape,wcs,np.eye(ncomp)[:,:,None,None]*np.ones(shape)*1e-9)
+    sims.posmap = enmap.posmap(shape,wcs)
+    sims.kbeam = maps.gauss_beam(sims.modlmap,1.5)
+    sims._fixed = False
+    sims._kphi = np.zeros(shape)
+    np.divide(2.,sims.modlmap*(sims.modlmap+1.),out=sims._kphi,where=sims.modlmap>0)
+    return sims
+
+def test_get_sims_matches_per_sim_pipeline():
+    for pol in [True,False]:
+        sims = _sims(pol=pol)
+        unlensed,kappa,lensed,observed = sims.get_sims(3,seed=7)
+        knoise = sims.ngen.get_maps(3,seed=[7,2],harm=True)
+        for i in range(3):
+            alpha = lensing.alpha_from_kappa(kappa[i],posmap=sims.posmap)
+            ref = enlensing.displace_map(unlensed[i],alpha,order=5)
+            assert np.allclose(lensed[i],ref,rtol=0,atol=1e-12*np.abs(ref).max())
+            noise = enmap.harm2map(knoise[i]) if pol else enmap.ifft(knoise[i]).real
+            ref = maps.filter_map(ref,sims.kbeam) + noise
+            assert np.allclose(observed[i],ref,rtol=0,atol=1e-12*np.abs(ref).max())
+
+def test_get_sims_reproducible():
+    sims = _sims()
+    a = sims.get_sims(2,seed=3)
+    b = sims.get_sims(2,seed=3)
+    c = sims.get_sims(2,seed=4)
+    for x,y,z in zip(a,b,c):
+        assert np.array_equal(x,y)
+        assert not(np.array_equal(x,z))
+
+def test_iter_sims_prefetch():
+    sims = _sims()
+    a = list(sims.iter_sims(5,2,seed=3))
+    b = list(sims.iter_sims(5,2,seed=3,prefetch=False))
+    assert [x[3].shape[0] for x in a]==[2,2,1]
+    for i,(x,y) in enumerate(zip(a,b)):
+        ref = sims.get_sims(len(x[0]),seed=[3,i])
+        for u,v,w in zip(x,y,ref):
+            assert np.array_equal(u,v)
+            assert np.array_equal(u,w)
+
+class _Theory(object):
+    # Smooth power-law spectra in place of a CAMB theory object
+    amps = {'TT':1.,'TE':0.3,'EE':0.1,'BB':0.01,'kk':1e-7}
+    def uCl(self,XY,ell): return self.amps[XY]/(1.+(ell/300.)**2.)
+    def lCl(self,XY,ell): return self.uCl(XY,ell)
+    def gCl(self,XY,ell): return self.uCl(XY,ell)
+
+def _estimator(n=32,**kwargs):
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(n,n),res=2.*utils.arcmin,proj='car')
+    noise = enmap.modlmap(shape,wcs)*0.+1e-3
+    fmask = maps.mask_kspace(shape,wcs,lmin=100,lmax=5000)
+    return lensing.Estimator(shape,wcs,_Theory(),noiseX2dTEB=[noise]*3,noiseY2dTEB=[noise]*3,
+                             fmaskX2dTEB=[fmask]*3,fmaskY2dTEB=[fmask]*3,fmaskKappa=fmask,**kwargs)
+
+def _teb(nsims=2,n=32,seed=1):
+    return np.random.default_rng(seed).standard_normal((3,nsims,n,n))
+
+def test_kappa_from_maps_matches_get_kappa():
+    est = _estimator()
+    T,E,B = _teb()
+    kappas = est.kappa_from_maps(['TT','TE','EE','EB','TB'],T,E,B)
+    for XY in kappas.keys():
+        ref = np.array([est.kappa_from_map(XY,T[i],E[i],B[i]) for i in range(len(T))])
+        assert np.allclose(kappas[XY],ref,rtol=0,atol=1e-12*np.abs(ref).max())
+
+def test_real_fft_matches_full_plane():
+    full = _estimator()
+    half = _estimator(realFFT=True)
+    nx = full.N.Nx//2+1
+    T,E,B = _teb()
+    kfull = full.kappa_from_maps(['TT','EE','EB','TB'],T,E,B)
+    khalf = half.kappa_from_maps(['TT','EE','EB','TB'],T,E,B)
+    for XY in kfull.keys():
+        assert np.allclose(half.AL[XY],full.AL[XY][...,:nx],rtol=1e-10,atol=0)
+        assert np.allclose(khalf[XY],kfull[XY],rtol=0,atol=1e-10*np.abs(kfull[XY]).max())
+    power = full.N.lClFid2d['TT'].real+1e-3
+    with np.errstate(all='ignore'):
+        for XY in ['TT','EE']:
+            ref = getattr(full.N,'super_dumb_N0_'+XY+XY)(power)
+            assert np.allclose(getattr(half.N,'super_dumb_N0_'+XY+XY)(power),ref[...,:nx],rtol=0,atol=1e-10*np.abs(ref).max())
+    with pytest.raises(ValueError):
+        half.N.delensClBB(full.N.Nlkk['EB'])
+
+def test_norm_cache(tmp_path):
+    first = _estimator(normCacheDir=str(tmp_path))
+    files = sorted(os.listdir(tmp_path))
+    assert any(f.startswith('qnorm_TT_') for f in files)
+    second = _estimator(normCacheDir=str(tmp_path))
+    assert sorted(os.listdir(tmp_path))==files
+    for XY in ['TT','EB']:
+        assert isinstance(second.AL[XY],np.memmap)
+        assert isinstance(second.N.Nlkk[XY],np.memmap)
+        assert np.array_equal(second.N.Nlkk[XY],first.N.Nlkk[XY])
+        assert np.array_equal(second.AL[XY],_estimator().AL[XY])
+    key = second.N._norm_cache_key('TT',True)
+    noise = second.N.noiseYY2d['TT'].real*2.
+    second.N.addNoise2DPowerYY('TT',noise,second.fmaskY2dTEB[0])
+    assert second.N._norm_cache_key('TT',True)!=key
+
+def _old_lens_cov(shape,wcs,ucov,alpha_pix,lens_order=5,kbeam=None):
+    # The per-row and per-column displace_map loops lens_cov and lens_cov_pol replaced
+    Scov = np.array(ucov)
+    def efunc(vec):
+        lensed = enmap.enmap(vec.reshape(shape),wcs)
+        if alpha_pix is not None: lensed = enlensing.displace_map(lensed,alpha_pix,order=lens_order)
+        if kbeam is not None: lensed = maps.filter_map(lensed,kbeam)
+        return np.asarray(lensed).reshape(-1)
+    for i in range(Scov.shape[0]): Scov[i,:] = efunc(Scov[i,:].copy())
+    for j in range(Scov.shape[1]): Scov[:,j] = efunc(Scov[:,j].copy())
+    return Scov
+
+def test_lens_cov_matches_displace_map_loops():
+    n = 10
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(n,n),res=utils.arcmin,proj='car')
+    rng = np.random.default_rng(4)
+    alpha_pix = rng.uniform(-2.,2.,size=(2,n,n))
+    kbeam = maps.gauss_beam(enmap.modlmap(shape,wcs),3.)
+    a = rng.standard_normal((n*n,n*n))
+    ucov = enmap.enmap(a@a.T,wcs)
+    for beam in [None,kbeam]:
+        ref = _old_lens_cov(shape,wcs,ucov,alpha_pix,kbeam=beam)
+        assert np.allclose(lensing.lens_cov(shape,wcs,ucov,alpha_pix,kbeam=beam),ref,rtol=0,atol=1e-12*np.abs(ref).max())
+    ref = _old_lens_cov(shape,wcs,ucov,None,kbeam=kbeam)
+    assert np.allclose(lensing.beam_cov(ucov,kbeam),ref,rtol=0,atol=1e-12*np.abs(ref).max())
+    # Polarized: the old code displaced the flattened (ncomp*Npix) rows and columns
+    ncomp = 2
+    a = rng.standard_normal((ncomp*n*n,ncomp*n*n))
+    pcov = (a@a.T).reshape((ncomp,n*n,ncomp,n*n))
+    iucov = np.transpose(pcov,(0,2,1,3))
+    ref = _old_lens_cov((ncomp,n,n),wcs,pcov.reshape((ncomp*n*n,)*2),alpha_pix,kbeam=kbeam)
+    ref = np.transpose(ref.reshape((ncomp,n*n,ncomp,n*n)),(0,2,1,3))
+    out = lensing.lens_cov_pol((ncomp,n,n),wcs,iucov,alpha_pix,kbeam=kbeam)
+    assert np.allclose(out,ref,rtol=0,atol=1e-12*np.abs(ref).max())
@@ -0,0 +1,180 @@
+import numpy as np
+import pytest
+from pixell import enmap, utils
+from orphics import maps, stats
+
+def _geometry(n=32,res=1.):
+    return enmap.geometry(pos=(0,0),shape=(n,n),res=res*utils.arcmin,proj='car')
+
+def test_mapgen_get_maps_scalar_shape():
+    shape,wcs = _geometry()
+    ps = np.ones((1,1)+shape)
+    mg = maps.MapGen(shape,wcs,ps)
+    # A batch of 3 scalar maps must not be treated as T,Q,U
+    omaps = mg.get_maps(3,seed=1)
+    assert omaps.shape==(3,)+shape
+    assert np.allclose(omaps,mg.get_maps(3,seed=1,scalar=True))
+    assert np.array_equal(omaps,mg.get_maps(3,seed=1))
+
+def test_mapgen_memory_cache_opt_in():
+    shape,wcs = _geometry()
+    ps = np.ones((1,1)+shape)
+    maps.MapGen._cache.clear()
+    mg1 = maps.MapGen(shape,wcs,ps)
+    assert len(maps.MapGen._cache)==0
+    assert mg1.covsqrt.flags.writeable
+    mg2 = maps.MapGen(shape,wcs,ps,memory_cache=True)
+    mg3 = maps.MapGen(shape,wcs,ps,memory_cache=True)
+    assert mg3.covsqrt is mg2.covsqrt
+    assert not(mg2.covsqrt.flags.writeable)
+    assert np.array_equal(mg1.covsqrt,mg2.covsqrt)
+    maps.MapGen._cache.clear()
+
+def test_stack_catalog_off_map_chunks():
+    shape,wcs = _geometry(n=64)
+    imap = enmap.enmap(np.random.default_rng(0).standard_normal((2,)+shape),wcs)
+    dec,ra = enmap.pix2sky(shape,wcs,np.array([[20,30,40],[25,35,45]]))/utils.degree
+    # The first chunk is entirely off the map
+    decs = np.append([50.,-50.],dec)
+    ras = np.append([100.,100.],ra)
+    weights = np.array([1.,1.,1.,2.,3.])
+    mstats = stats.Stats()
+    res = maps.stack_catalog(imap,ras,decs,3,weights=weights,chunk_size=2,error="jackknife",
+                             nsamples=3,aperture_radius=2*utils.arcmin,annulus_width=1*utils.arcmin,mstats=mstats)
+    mstats.get_stacks(verbose=False)
+    assert np.allclose(mstats.stacks["stack_sum"]/mstats.stacks["stack_weights"],res['stack'])
+    assert np.array_equal(res['used'],[False,False,True,True,True])
+    assert res['nobj']==3
+    assert res['fluxes'].shape==(3,2)
+    stamps = np.array([imap[:,y-3:y+4,x-3:x+4] for y,x in zip([20,30,40],[25,35,45])])
+    assert np.allclose(res['stack'],np.einsum('i,i...->...',weights[2:],stamps)/6.)
+    res = maps.stack_catalog(imap,ras[:2],decs[:2],3)
+    assert res['nobj']==0
+
+def _mode_coupling_mask(n=48):
+    shape,wcs = _geometry(n=n,res=2.)
+    modrmap = enmap.modrmap(shape,wcs)
+    mask = enmap.enmap((modrmap<16*utils.arcmin).astype(np.float64),wcs)
+    return shape,wcs,mask
+
+def test_mode_coupling_unbiased():
+    shape,wcs,mask = _mode_coupling_mask()
+    modlmap = enmap.modlmap(shape,wcs)
+    edges = np.linspace(0.,modlmap.max()+1.,8)
+    mc = maps.ModeCoupling(mask,edges,apod_deg=8./60.)
+    # White noise has a constant power, which the decoupled bandpowers recover
+    ps = np.ones((1,1)+shape)
+    mg = maps.MapGen(shape,wcs,ps)
+    sims = mg.get_maps(400,seed=1)
+    cents,bandpowers = mc.power(sims)
+    mean = bandpowers.mean(axis=0)
+    err = bandpowers.std(axis=0)/np.sqrt(len(sims))
+    expected = 1.
+    assert np.all(np.abs(mean/expected-1.)<5.*err/expected)
+    # Without decoupling, the masked power is biased low
+    _,p1d = mc.binner.bin(mc.fc.power2d(sims[0]*mc.window)[0])
+    assert np.all(p1d/expected<0.5)
+
+def test_mode_coupling_empty_bins():
+    shape,wcs,mask = _mode_coupling_mask()
+    modlmap = enmap.modlmap(shape,wcs)
+    # Edges past the corner l
+    with pytest.raises(ValueError):
+        maps.ModeCoupling(mask,np.linspace(0.,2*modlmap.max(),8))
+    # Bins narrower than the l spacing
+    with pytest.raises(ValueError):
+        maps.ModeCoupling(mask,np.linspace(0.,modlmap.max(),2000))
+
+def test_ilc_isotropic_1d():
+    shape,wcs = _geometry(n=64)
+    rng = np.random.default_rng(2)
+    signal = enmap.enmap(rng.standard_normal(shape),wcs)
+    imaps = enmap.enmap(np.array([signal+s*rng.standard_normal(shape) for s in [0.5,1.,2.]]),wcs)
+    kmaps = enmap.fft(imaps,normalize='phys')
+    modlmap = enmap.modlmap(shape,wcs)
+    edges = np.linspace(0.,modlmap.max()+1.,6)
+    cents,cov = maps.ilc_empirical_cov_1d(kmaps,edges)
+    assert cov.shape==(3,3,cents.size)
+    assert maps.ilc_empirical_cov(kmaps,edges).shape==(3,3)+shape
+    with pytest.warns(UserWarning):
+        weights = maps.ilc_weights_to_2d(cents,maps.ilc_weights(cov,np.ones(3))[0],modlmap)
+    # The weights of a standard ILC sum to one at every mode, including beyond the last center
+    assert np.allclose(weights.sum(axis=0),1.)
+    with pytest.warns(UserWarning):
+        kilc,noise = maps.ilc(kmaps,cov,np.ones(3),ells=cents)
+    assert kilc.shape==shape
+
+def test_pixcov_sim_batches_and_caches(monkeypatch):
+    shape,wcs = _geometry(n=8)
+    shape = (1,)+shape
+    oshape,owcs = enmap.pad(enmap.zeros(shape,wcs),2).geometry
+    ps = (1./(1.+(enmap.modlmap(oshape,owcs)/3000.)**2.))[None,None]
+    maps.MapGen._cache.clear()
+    sim = maps.pixcov_sim(shape,wcs,ps,20000,seed=1,pad=2,nbatch=3000)
+    exact = maps.pixcov_sim(shape,wcs,ps,0,pad=2,exact=True)
+    assert np.abs(sim-exact).max() < 0.05*np.abs(exact).max()
+    # The second call reuses the cached covsqrt
+    assert len(maps.MapGen._cache)==1
+    monkeypatch.setattr(maps.enmap,'multi_pow',None)
+    assert np.array_equal(sim,maps.pixcov_sim(shape,wcs,ps,20000,seed=1,pad=2,nbatch=3000))
+    maps.MapGen._cache.clear()
+
+def test_fourier_calc_pooled_matches_unpooled():
+    shape,wcs = _geometry()
+    shape = (3,)+shape
+    splits = enmap.enmap(np.random.default_rng(2).standard_normal((4,)+shape),wcs)
+    fc = maps.FourierCalc(shape,wcs)
+    ref = enmap.fft(splits[0])
+    ref[-2:] = enmap.map_mul(fc.rot,ref[-2:])
+    assert np.allclose(fc.iqu2teb(splits[0]),ref,rtol=1e-12,atol=0)
+    # Pooled buffers are copied out, so earlier results survive later transforms
+    k0 = fc.fft(splits[0])
+    k1 = fc.fft(splits[1])
+    assert np.allclose(k0,enmap.fft(splits[0],normalize=False),rtol=1e-12,atol=0)
+    out = np.empty(shape[-2:])
+    assert np.allclose(fc.f2power(k0[0],k1[0],out=out),np.real(np.conjugate(k0[0])*k1[0])*fc.normfact,rtol=1e-12,atol=0)
+    # noise_from_splits and split_calc against the per-split loops they replaced
+    fsplits = splits.astype(np.float32)
+    ksplits = [enmap.fft(s,normalize=False) for s in fsplits]
+    pairs = [(i,j) for i in range(4) for j in range(i+1,4)]
+    auto = sum(fc.power2d(kmap=k)[0] for k in ksplits)/4.
+    cross = sum(fc.power2d(kmap=ksplits[i],kmap2=ksplits[j])[0] for i,j in pairs)/len(pairs)
+    noise,_ = maps.noise_from_splits(splits,fc)
+    assert np.allclose(noise,(auto-cross)/4.,rtol=1e-5,atol=1e-8*np.abs(auto).max())
+    isplits = enmap.enmap(np.array([k[0] for k in ksplits]),wcs)
+    coadd = isplits.mean(axis=0)
+    total,crosses,noise = maps.split_calc(isplits,isplits,coadd,coadd,fc)
+    rnoise = sum(fc.f2power(s-coadd,s-coadd) for s in isplits)/((1.-1./4)*4**2)
+    assert np.allclose(noise,rnoise,rtol=1e-5,atol=0)
+    assert np.allclose(crosses,fc.f2power(coadd,coadd)-rnoise,rtol=1e-5,atol=1e-5*np.abs(rnoise).max())
+
+def test_ilc_weights_match_cinv_ilc():
+    shape,wcs = _geometry(n=32)
+    modlmap = enmap.modlmap(shape,wcs)
+    rng = np.random.default_rng(3)
+    # Signal with two foregrounds and white noise, symmetric under k -> -k
+    A = rng.uniform(0.5,2.,size=(4,2))
+    cl = lambda p: 1./(1.+(modlmap/1000.)**p)
+    cov = np.ones((4,4))[...,None,None]*cl(2.) + np.einsum('ia,ja,a...->ij...',A,A,np.array([cl(1.),cl(3.)]))
+    cov[np.arange(4),np.arange(4)] += rng.uniform(0.1,1.,size=4)[:,None,None]
+    cinv = np.moveaxis(np.linalg.inv(np.moveaxis(cov,(0,1),(-2,-1))),(-2,-1),(0,1))
+    kmaps = enmap.enmap(rng.standard_normal((4,)+shape)+1j*rng.standard_normal((4,)+shape),wcs)
+    ones = np.ones(4)
+    kilc,noise = maps.ilc(kmaps,cov,ones,nblock=100)
+    assert np.allclose(kilc,maps.silc(kmaps,cinv,ones),rtol=1e-10,atol=0)
+    assert np.allclose(noise,maps.silc_noise(cinv,ones),rtol=1e-10,atol=0)
+    for hermitian in [True,False]:
+        kilc,noise = maps.ilc(kmaps,cov,ones,A[:,0],hermitian=hermitian,nblock=100)
+        assert np.allclose(kilc,maps.cilc(kmaps,cinv,ones,A[:,0]),rtol=1e-10,atol=1e-12)
+        assert np.allclose(noise,maps.cilc_noise(cinv,ones,A[:,0]),rtol=1e-10,atol=0)
+
+def test_stationary_pixcov_polarized():
+    shape,wcs = _geometry(n=6)
+    shape = (3,)+shape
+    oshape,owcs = enmap.pad(enmap.zeros(shape,wcs),2).geometry
+    cl = 1./(1.+(enmap.modlmap(oshape,owcs)/3000.)**2.)
+    ps = np.einsum('ij,...->ij...',np.array([[1.,.3,0],[.3,.5,0],[0,0,.2]]),cl)
+    # Exact covariance, including the E/B to Q/U rotation, against simulations
+    exact = maps.stationary_pixcov(shape,wcs,ps,pad=2)
+    sim = maps.pixcov_sim(shape,wcs,ps,40000,seed=1,pad=2,nbatch=5000,memory_cache=False)
+    assert np.abs(sim-exact).max() < 0.04*np.abs(exact).max()
@@ -0,0 +1,100 @@
+import os, sys, subprocess, textwrap
+import pytest
+
+pytestmark = pytest.mark.skipif(not(hasattr(os,'fork')),reason="ProcessComm needs fork")
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _run(code,**env):
+    # Forked ranks run in a separate interpreter so that they never continue the test session
+    env = dict(os.environ,DISABLE_MPI="true",PYTHONPATH=root,**env)
+    return subprocess.run([sys.executable,'-c',textwrap.dedent(code)],env=env,capture_output=True,text=True,timeout=120)
+
+def test_import_does_not_fork():
+    res = _run("""
+        import os
+        from orphics import mpi
+        print(os.getpid(),mpi.MPI.COMM_WORLD.Get_size())
+        """,ORPHICS_LOCAL_PROCS="3")
+    assert res.returncode==0, res.stderr
+    lines = res.stdout.splitlines()
+    assert len(lines)==1 and lines[0].split()[1]=='1'
+
+def test_process_comm_collectives():
+    res = _run("""
+        import numpy as np
+        from orphics import mpi
+        comm = mpi.comm_world()
+        assert comm is mpi.comm_world()
+        rank,size = comm.Get_rank(),comm.Get_size()
+        assert size==3
+        ok = comm.bcast('hello' if rank==0 else None)=='hello'
+        ok &= comm.allgather(rank)==[0,1,2]
+        ok &= np.array_equal(comm.allgatherv(np.arange(rank+1)),[0,0,1,0,1,2])
+        total = np.zeros(4)
+        comm.Allreduce(np.full(4,rank+1.),total,op=comm.SUM)
+        ok &= np.all(total==6.)
+        if rank==1: comm.send({'a':np.arange(3)},dest=2,tag=5)
+        if rank==2: ok &= np.array_equal(comm.recv(source=1,tag=5)['a'],np.arange(3))
+        tasks = [t for t in mpi.DynamicTasks(20,comm)]
+        alltasks = sorted(sum(comm.allgather(tasks),[]))
+        ok &= alltasks==list(range(20))
+        oks = comm.gather(bool(ok))
+        comm.Barrier()
+        if rank==0: print(oks)
+        else: import os; os._exit(0)
+        """,ORPHICS_LOCAL_PROCS="3")
+    assert res.returncode==0, res.stderr
+    assert res.stdout.splitlines()[-1]=="[True, True, True]"
+
+_stats_code = """
+    import numpy as np
+    from orphics import mpi, stats
+    comm = mpi.comm_world()
+    rank = comm.Get_rank()
+    rng = np.random.default_rng(rank)
+    # Uneven numbers of vectors per rank
+    vectors = rng.standard_normal((5+7*rank,4))+rank
+    stacks = rng.standard_normal((3,3,3))
+    results = {{}}
+    for mode in ['default','{mode}']:
+        st = stats.Stats(comm,**({{}} if mode=='default' else {{mode:True}}))
+        for v in vectors:
+            st.add_to_stats('v',v)
+        for s in stacks:
+            st.add_to_stack('s',s)
+        st.get_stats(verbose=False)
+        st.get_stacks(verbose=False)
+        results[mode] = st
+    # The other ranks exit normally, which flushes their message queues
+    if rank==0:
+        a,b = results['default'],results['{mode}']
+        ok = all(np.allclose(a.stats['v'][key],b.stats['v'][key]) for key in a.stats['v'])
+        ok &= sum(a.numobj['v'])==sum(b.numobj['v'])==5+12+19
+        ok &= np.allclose(a.stacks['s'],b.stacks['s'])
+        print(ok)
+    """
+
+def test_online_stats_across_processes():
+    res = _run(_stats_code.format(mode='online'),ORPHICS_LOCAL_PROCS="3")
+    assert res.returncode==0, res.stderr
+    assert res.stdout.splitlines()[-1]=="True"
+
+def test_collective_stats_across_processes():
+    res = _run(_stats_code.format(mode='collective'),ORPHICS_LOCAL_PROCS="3")
+    assert res.returncode==0, res.stderr
+    assert res.stdout.splitlines()[-1]=="True"
+
+def test_distribute_defaults_to_comm_world():
+    res = _run("""
+        from orphics import mpi
+        comm,rank,my_tasks = mpi.distribute(10,verbose=False)
+        assert comm is mpi.comm_world() and comm.Get_size()==2
+        dcomm,_,dtasks = mpi.distribute_dynamic(10,verbose=False)
+        assert dcomm is comm
+        tasks = comm.gather((list(my_tasks),list(dtasks)))
+        comm.Barrier()
+        if rank==0: print(sorted(sum([t[0] for t in tasks],[]))==list(range(10)),sorted(sum([t[1] for t in tasks],[]))==list(range(10)))
+        else: import os; os._exit(0)
+        """,ORPHICS_LOCAL_PROCS="2")
+    assert res.returncode==0, res.stderr
+    assert res.stdout.splitlines()[-1]=="True True"
@@ -0,0 +1,184 @@
+import os
+import numpy as np
+import pytest
+pytest.importorskip("h5py")
+from pixell import enmap, utils
+from orphics import pixcov
+
+def _inputs():
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(64,64),res=0.5*utils.arcmin,proj='car')
+    ivar = enmap.enmap(1.+np.random.default_rng(0).uniform(size=shape),wcs)
+    coords = np.array([[0.,0.],[3*utils.arcmin,-4*utils.arcmin],[-5*utils.arcmin,6*utils.arcmin]])
+    return coords,ivar
+
+def _save(output_dir,hole_radius,packed,coords=None,ivar=None,**kwargs):
+    if coords is None: coords,ivar = _inputs()
+    os.makedirs(output_dir,exist_ok=True)
+    pixcov.inpaint_uncorrelated_save_geometries(coords,hole_radius,ivar,str(output_dir),include_signal=False,
+                                                pol=False,verbose_every_nsrcs=0,packed=packed,**kwargs)
+
+def _assert_same(g1,g2):
+    assert sorted(g1.keys())==sorted(g2.keys())
+    for task in g1:
+        for key in ['covsqrt','meanmul','shape','m1','m2']:
+            assert np.array_equal(g1[task][key],g2[task][key])
+
+def test_packed_archive_round_trip(tmp_path):
+    _save(tmp_path/"packed",1.5*utils.arcmin,True)
+    _save(tmp_path/"files",1.5*utils.arcmin,False)
+    assert pixcov.GeometryArchive.exists(str(tmp_path/"packed"))
+    assert not(pixcov.GeometryArchive.exists(str(tmp_path/"files")))
+    g1 = pixcov.preload_geometries(str(tmp_path/"packed"),verbose_every_nsrcs=0)
+    g2 = pixcov.preload_geometries(str(tmp_path/"files"),verbose_every_nsrcs=0)
+    assert len(g1)==3
+    _assert_same(g1,g2)
+    cache = pixcov.GeometryCache(str(tmp_path/"packed"))
+    for task in g1:
+        assert np.array_equal(cache[task]['covsqrt'],g1[task]['covsqrt'])
+
+def test_unpacked_rerun_replaces_stale_archive(tmp_path):
+    _save(tmp_path/"ref",1.5*utils.arcmin,False)
+    # An older packed run with a different hole radius, then a per-source rerun
+    _save(tmp_path/"rerun",1.*utils.arcmin,True)
+    _save(tmp_path/"rerun",1.5*utils.arcmin,False)
+    assert not(pixcov.GeometryArchive.exists(str(tmp_path/"rerun")))
+    assert not(os.path.exists(str(tmp_path/"rerun"/pixcov.GEOMETRY_ARCHIVE)))
+    ref = pixcov.preload_geometries(str(tmp_path/"ref"),verbose_every_nsrcs=0)
+    _assert_same(ref,pixcov.preload_geometries(str(tmp_path/"rerun"),verbose_every_nsrcs=0))
+    cache = pixcov.GeometryCache(str(tmp_path/"rerun"))
+    for task in ref:
+        assert np.array_equal(cache[task]['m1'],ref[task]['m1'])
+
+def test_stamp_key_exact_for_integers():
+    m1 = np.array([3,4,5])
+    # Integer hole pixels must never be quantized together
+    assert pixcov._stamp_key(0.5,m1)!=pixcov._stamp_key(0.5,np.array([3,4,6]))
+    assert pixcov._stamp_key(0.5,m1)==pixcov._stamp_key(None,m1)
+    x = np.array([1.,2.,3.])
+    assert pixcov._stamp_key(1e-3,x)==pixcov._stamp_key(1e-3,x*(1+1e-9))
+    assert pixcov._stamp_key(None,x)!=pixcov._stamp_key(None,x*(1+1e-9))
+
+def test_nearby_ivar_shares_geometry(tmp_path):
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(64,64),res=0.5*utils.arcmin,proj='car')
+    ivar = enmap.enmap(1.+1e-9*np.random.default_rng(1).uniform(size=shape),wcs)
+    # Two pixel-centred sources, whose stamps differ only by the ivar noise
+    coords = enmap.pix2sky(shape,wcs,np.array([[20,20],[20,44]]).T).T
+    _save(tmp_path/"exact",1.5*utils.arcmin,True,coords,ivar)
+    _save(tmp_path/"rtol",1.5*utils.arcmin,True,coords,ivar,cache_rtol=1e-3)
+    exact = pixcov.preload_geometries(str(tmp_path/"exact"),verbose_every_nsrcs=0)
+    shared = pixcov.preload_geometries(str(tmp_path/"rtol"),verbose_every_nsrcs=0)
+    assert not(np.array_equal(exact[0]['covsqrt'],exact[1]['covsqrt']))
+    assert np.array_equal(shared[0]['covsqrt'],shared[1]['covsqrt'])
+    assert np.allclose(shared[1]['covsqrt'],exact[1]['covsqrt'],rtol=1e-6,atol=0)
+
+def _catalog():
+    # Overlapping sources, and one whose stamp leaves the map
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(64,64),res=0.5*utils.arcmin,proj='car')
+    ivar = enmap.enmap(1.+np.random.default_rng(3).uniform(size=shape),wcs)
+    coords = np.array([[0.,0.],[1.,-1.5],[-2.,1.],[8.,8.],[15.5,-3.]])*utils.arcmin
+    imap = enmap.enmap(np.random.default_rng(4).standard_normal(shape),wcs)
+    return coords,ivar,imap
+
+def _old_inpaint(imap,output_dir,geometries,draw=None):
+    # The per-source loop of inpaint_uncorrelated_from_saved_geometries before
+    # the geometry cache, stack inpainting and threading were added. draw(task,n)
+    # returns the random numbers for a source (None for no random realization).
+    imap = imap.copy()
+    coords = np.loadtxt(f'{output_dir}/source_inpaint_coords.txt')
+    tasks = np.loadtxt(f'{output_dir}/source_inpaint_task_indices.txt').astype(int)
+    ncomp,hole_radius,context_fraction = np.loadtxt(f'{output_dir}/source_inpaint_attributes.dat',unpack=True,delimiter=',')
+    pixboxes = enmap.neighborhood_pixboxes(imap.shape[-2:],imap.wcs,coords,hole_radius*utils.arcmin*(1+context_fraction))
+    for i,task in enumerate(tasks):
+        ithumb = imap.extract_pixbox(pixboxes[i])
+        g = geometries[task]
+        cstamp = ithumb.reshape(-1)
+        sim = np.dot(g['meanmul'],cstamp[g['m2']])
+        if draw is not None: sim = sim + np.dot(g['covsqrt'],draw(task,g['m1'].size))
+        ithumb.reshape(-1)[g['m1']] = sim
+        imap = enmap.insert_at(imap,pixboxes[i],ithumb)
+    return imap
+
+def test_geometry_cache_matches_preloaded(tmp_path):
+    coords,ivar,imap = _catalog()
+    for packed in [True,False]:
+        odir = tmp_path/str(packed)
+        _save(odir,1.5*utils.arcmin,packed,coords,ivar)
+        g = pixcov.preload_geometries(str(odir),verbose_every_nsrcs=0)
+        ref = _old_inpaint(imap,str(odir),g)
+        # A budget of about two geometries forces evictions and reloads
+        cache = pixcov.GeometryCache(str(odir),max_bytes=2*sum(x.nbytes for x in g[0].values()))
+        for geometries in [None,g,cache,cache]:
+            omap = pixcov.inpaint_uncorrelated_from_saved_geometries(imap,str(odir),geometries=geometries,
+                                                                     do_random=False,verbose_every_nsrcs=0)
+            assert np.allclose(omap,ref,rtol=0,atol=1e-12)
+        assert cache.nbytes<=cache.max_bytes and cache.misses>len(g)
+        omap = pixcov.inpaint_uncorrelated_from_saved_geometries(imap,str(odir),geometries=pixcov.GeometryCache(str(odir),float32=True),
+                                                                 do_random=False,verbose_every_nsrcs=0)
+        assert np.allclose(omap,ref,rtol=0,atol=1e-5)
+
+def test_inpaint_stack_matches_per_map(tmp_path):
+    coords,ivar,imap = _catalog()
+    _save(tmp_path,1.5*utils.arcmin,True,coords,ivar)
+    g = pixcov.preload_geometries(str(tmp_path),verbose_every_nsrcs=0)
+    imaps = enmap.enmap(np.random.default_rng(5).standard_normal((3,)+imap.shape),imap.wcs)
+    omaps = pixcov.inpaint_stack_from_saved_geometries(imaps,str(tmp_path),do_random=False,verbose_every_nsrcs=0)
+    for i in range(3):
+        assert np.allclose(omaps[i],_old_inpaint(imaps[i],str(tmp_path),g),rtol=0,atol=1e-12)
+    # The first map of a seeded stack gets the same realization as on its own
+    omaps = pixcov.inpaint_stack_from_saved_geometries(imaps,str(tmp_path),seed=7,verbose_every_nsrcs=0)
+    omap = pixcov.inpaint_uncorrelated_from_saved_geometries(imaps[0],str(tmp_path),seed=7,verbose_every_nsrcs=0)
+    assert np.allclose(omaps[0],omap,rtol=0,atol=1e-12)
+
+def test_seeded_threaded_inpaint_matches_serial(tmp_path):
+    coords,ivar,imap = _catalog()
+    _save(tmp_path,1.5*utils.arcmin,True,coords,ivar)
+    g = pixcov.preload_geometries(str(tmp_path),verbose_every_nsrcs=0)
+    ref = _old_inpaint(imap,str(tmp_path),g,draw=lambda task,n: pixcov.source_rng(7,task).standard_normal(n))
+    for nthreads in [1,4]:
+        omap = pixcov.inpaint_uncorrelated_from_saved_geometries(imap,str(tmp_path),seed=7,nthreads=nthreads,verbose_every_nsrcs=0)
+        assert np.allclose(omap,ref,rtol=0,atol=1e-12)
+    # Overlapping sources are inpainted in later waves, in catalog order
+    pixboxes = enmap.neighborhood_pixboxes(imap.shape,imap.wcs,coords,2.5*utils.arcmin)
+    waves = pixcov._pixbox_waves(pixboxes,pixcov._pixbox_slices(imap.shape,pixboxes))
+    assert [list(w) for w in waves]==[[0,3],[1],[2],[4]]
+
+def test_pixbox_extract_insert_matches_enmap():
+    coords,ivar,imap = _catalog()
+    imap = enmap.enmap(np.random.default_rng(6).standard_normal((3,)+imap.shape),imap.wcs)
+    for nthreads in [1,4]:
+        stamps,pixboxes = pixcov.extract_cutouts_array(imap,coords,2.5*utils.arcmin,nthreads=nthreads)
+        assert stamps.shape[:2]==(len(coords),3)
+        for stamp,pixbox in zip(stamps,pixboxes):
+            assert np.array_equal(stamp,enmap.extract_pixbox(imap,pixbox))
+        # Pasting modified stamps back, with later overlapping stamps winning
+        stamps = stamps + np.arange(len(coords))[:,None,None,None]+1.
+        ref = imap.copy()
+        for stamp,pixbox in zip(stamps,pixboxes):
+            ref = enmap.insert_at(ref,pixbox,enmap.enmap(stamp,imap.wcs))
+        omap = pixcov.insert_pixboxes(imap.copy(),stamps,pixboxes,nthreads=nthreads)
+        assert np.array_equal(omap,ref)
+
+def _old_corr_to_mat(corr,ny,nx):
+    res = enmap.zeros([ny,nx,ny,nx],dtype=corr.dtype)
+    for i in range(ny):
+        tmp = np.roll(corr, i, 0)[:ny,:]
+        for j in range(nx):
+            res[i,j] = np.roll(tmp, j, 1)[:,:nx]
+    return res
+
+def test_fcov_to_rcorr_matches_roll_loops():
+    shape,wcs = enmap.geometry(pos=(0,0),shape=(12,10),res=0.5*utils.arcmin,proj='car')
+    rng = np.random.default_rng(8)
+    modlmap = enmap.modlmap(shape,wcs)
+    mix = rng.uniform(size=(3,3))
+    p2d = np.einsum('ia,ja,...->ij...',mix,mix,1./(1.+(modlmap/2000.)**2.))
+    p2d_in = p2d.copy()
+    ocorr = pixcov.fcov_to_rcorr(shape,wcs,p2d,12,10)
+    assert np.array_equal(p2d,p2d_in)
+    scaled = p2d*np.prod(shape)/enmap.area(shape,wcs)
+    for i in range(3):
+        for j in range(3):
+            corrfun = pixcov.map_ifft(scaled[i,j]+0j)/np.prod(shape)**0.5
+            ref = _old_corr_to_mat(pixcov.corrfun_thumb(corrfun,12,10),12,10).reshape((120,120))
+            assert np.allclose(ocorr[i,j],ref,rtol=0,atol=1e-14*np.abs(ref).max())
+    assert np.allclose(pixcov.fcov_to_rcorr(shape,wcs,p2d,12,10,dtype=np.float32),ocorr,rtol=1e-6,atol=1e-6*np.abs(ocorr).max())
@@ -0,0 +1,104 @@
+import numpy as np
+from orphics import stats
+
+def _binner():
+    rng = np.random.default_rng(0)
+    modrmap = rng.uniform(0.,10.,size=(20,30))
+    # The last bin lies beyond modrmap.max()
+    edges = np.array([0.,2.,5.,9.,12.,15.])
+    return rng,modrmap,edges,stats.bin2D(modrmap,edges)
+
+def test_bin2D_matches_brute_force():
+    rng,modrmap,edges,binner = _binner()
+    data = rng.standard_normal((2,)+modrmap.shape)
+    cents,res,err,count = binner.bin(data,err=True,get_count=True)
+    assert cents.shape==(edges.size-1,)
+    assert res.shape==err.shape==count.shape==(2,edges.size-1)
+    for i in range(edges.size-1):
+        sel = (modrmap>edges[i]) & (modrmap<=edges[i+1])
+        if not(sel.any()):
+            assert np.all(np.isnan(res[:,i]))
+            continue
+        x = data[:,sel]
+        assert np.allclose(res[:,i],x.mean(axis=-1))
+        assert np.allclose(err[:,i],x.std(axis=-1,ddof=1)/np.sqrt(sel.sum()))
+        assert np.allclose(count[:,i],sel.sum())
+
+def test_bin2D_weighted_errors():
+    rng,modrmap,edges,binner = _binner()
+    data = rng.standard_normal(modrmap.shape)
+    # Uniform weights reduce to the unweighted errors
+    _,res,err = binner.bin(data,err=True)
+    _,wres,werr,wcount = binner.bin(data,weights=np.full(modrmap.shape,3.),err=True,get_count=True)
+    assert np.allclose(res,wres,equal_nan=True)
+    assert np.allclose(err,werr,equal_nan=True)
+    weights = rng.uniform(0.5,2.,size=modrmap.shape)
+    _,wres,werr = binner.bin(data,weights=weights,err=True)
+    sel = (modrmap>edges[1]) & (modrmap<=edges[2])
+    w,x = weights[sel],data[sel]
+    mean = (w*x).sum()/w.sum()
+    neff = w.sum()**2/(w**2).sum()
+    assert np.isclose(wres[1],mean)
+    assert np.isclose(werr[1],np.sqrt((w*(x-mean)**2).sum()/w.sum()/(neff-1)))
+
+def _fill(st,vectors,stacks,tasks=None):
+    for i,(v,s) in enumerate(zip(vectors,stacks)):
+        st.add_to_stats('v',v)
+        st.add_to_stats('w',v[:2]**2)
+        st.add_to_stack('s',s)
+        if tasks is not None: st.task_done(tasks[i])
+
+def _data(n=40):
+    rng = np.random.default_rng(5)
+    return rng.standard_normal((n,4))+np.arange(4),rng.standard_normal((n,3,3))
+
+def _assert_stats_close(a,b):
+    assert sorted(a.keys())==sorted(b.keys())
+    for label in a:
+        for key in a[label]:
+            assert np.allclose(a[label][key],b[label][key]), (label,key)
+
+def test_online_and_collective_match_default():
+    vectors,stacks = _data()
+    results = {}
+    for mode in ['default','online','collective']:
+        st = stats.Stats(online=mode=='online',collective=mode=='collective')
+        _fill(st,vectors,stacks)
+        st.get_stats(verbose=False)
+        st.get_stacks(verbose=False)
+        results[mode] = st
+    for mode in ['online','collective']:
+        _assert_stats_close(results['default'].stats,results[mode].stats)
+        assert np.allclose(results['default'].stacks['s'],results[mode].stacks['s'])
+    assert np.allclose(results['default'].stats['v']['mean'],vectors.mean(axis=0))
+    assert np.allclose(results['online'].stats['v']['cov'],np.cov(vectors.T))
+
+def test_checkpoint_restart(tmp_path):
+    vectors,stacks = _data()
+    # Task ids need not be integers
+    tasks = [('sim',i) for i in range(len(vectors))]
+    for online in [False,True]:
+        ref = stats.Stats(online=online)
+        _fill(ref,vectors,stacks)
+        ref.get_stats(verbose=False)
+        ref.get_stacks(verbose=False)
+
+        cdir = str(tmp_path/f"online_{online}")
+        st = stats.Stats(online=online,checkpoint_dir=cdir,checkpoint_every=4)
+        _fill(st,vectors[:22],stacks[:22],tasks[:22])
+        # The job dies after task 21, after the checkpoint at task 19
+        st = stats.Stats(online=online,checkpoint_dir=cdir,checkpoint_every=4)
+        assert st.finished_tasks==tasks[:20]
+        remaining = st.remaining_tasks(tasks)
+        assert remaining==tasks[20:]
+        _fill(st,vectors[20:],stacks[20:],remaining)
+        st.get_stats(verbose=False)
+        st.get_stacks(verbose=False)
+        _assert_stats_close(ref.stats,st.stats)
+        assert np.allclose(ref.stacks['s'],st.stacks['s'])
+        if not(online):
+            # Each shard holds only the vectors added since the previous checkpoint
+            nshards = len(vectors)//4
+            for shard in range(nshards):
+                with np.load(f"{cdir}/mstats_checkpoint_rank_0_vectors_{shard}.npz") as f:
+                    assert f['vectors_0'].shape==(4,4)